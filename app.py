@@ -1,25 +1,59 @@
 import os
+import io
+import abc
 import json
 import uuid
 import time
+import asyncio
+import functools
 import threading
-import queue
+import concurrent.futures
 import base64
 import sys
-import inspect
 import secrets
+import hashlib
+import heapq
+import math
+import itertools
+import atexit
+import shutil
+import signal
+import sqlite3
 import re
+import traceback
 from loguru import logger
 from pathlib import Path
+from collections import OrderedDict, namedtuple, deque
 import uuid
 import requests
 from flask import Flask, request, Response, jsonify, stream_with_context, render_template, redirect, session
 from curl_cffi import requests as curl_requests
+from curl_cffi import CurlInfo
 from werkzeug.middleware.proxy_fix import ProxyFix
-from xStatsigIDGenerator import XStatsigIDGenerator
+from xStatsigIDGenerator import XStatsigIDGenerator, meta_cache
 import random
 import string
 
+# 启动耗时从模块开始导入时计起
+STARTUP_STARTED_AT = time.perf_counter()
+
+# 上游 NDJSON 解析优先使用更快的可选 JSON 库，未安装时回退到标准库
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps_bytes = orjson.dumps
+    JSON_BACKEND = "orjson"
+except ImportError:
+    try:
+        import msgspec
+        json_loads = msgspec.json.Decoder().decode
+        json_dumps_bytes = msgspec.json.Encoder().encode
+        JSON_BACKEND = "msgspec"
+    except ImportError:
+        json_loads = json.loads
+        json_dumps_bytes = lambda obj: json.dumps(obj).encode('utf-8')
+        JSON_BACKEND = "json"
+
 CORE_WORDS = [
     '__value', '_data-enctype', '_data-margin', '_style', '_transform', '_value',
     'className', 'color', 'currentTime', 'dataset', 'disabled', 'enctype',
@@ -74,72 +108,112 @@ def generate_fallback_id():
     return fallback_id
 
 class Logger:
-    def __init__(self, level="INFO", colorize=True, format=None):
+    """
+    loguru 的薄封装。
+    先按级别过滤，未启用的级别直接返回，不做任何格式化；调用位置由 loguru 在
+    确认需要输出后自行获取（opt(depth=1)），不再每次手动遍历栈帧。
+    enqueue 开启时由 loguru 的后台线程写出，请求线程只负责入队。
+    """
+
+    def __init__(self, level="INFO", colorize=True, format=None, json_lines=False, enqueue=True):
         logger.remove()
 
         if format is None:
             format = (
                 "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | "
                 "<level>{level: <8}</level> | "
-                "<cyan>{extra[filename]}</cyan>:<cyan>{extra[function]}</cyan>:<cyan>{extra[lineno]}</cyan> | "
-                "<level>{message}</level>"
+                "<cyan>{file.name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> | "
+                "<level>[{extra[source]}] {message}</level>"
             )
 
-        logger.add(
-            sys.stderr,
-            level=level,
-            format=format,
-            colorize=colorize,
-            backtrace=True,
-            diagnose=True
-        )
+        if json_lines:
+            logger.add(
+                self._json_sink,
+                level=level,
+                format="{message}",
+                enqueue=enqueue,
+                backtrace=False,
+                diagnose=False
+            )
+        else:
+            logger.add(
+                sys.stderr,
+                level=level,
+                format=format,
+                colorize=colorize,
+                enqueue=enqueue,
+                backtrace=True,
+                diagnose=False
+            )
+        if enqueue:
+            # 退出时等待队列中的日志写完
+            atexit.register(logger.remove)
 
         self.logger = logger
+        self.min_level = logger.level(level).no
+        self._levels = {name: logger.level(name).no for name in ("DEBUG", "INFO", "WARNING", "ERROR")}
+        self._sources = {}
 
-    def _get_caller_info(self):
-        frame = inspect.currentframe()
-        try:
-            caller_frame = frame.f_back.f_back
-            full_path = caller_frame.f_code.co_filename
-            function = caller_frame.f_code.co_name
-            lineno = caller_frame.f_lineno
+    @staticmethod
+    def _json_sink(message):
+        record = message.record
+        entry = {
+            "time": record["time"].isoformat(timespec="milliseconds"),
+            "level": record["level"].name,
+            "source": record["extra"].get("source"),
+            "message": record["message"],
+            "caller": f"{record['file'].name}:{record['function']}:{record['line']}"
+        }
+        if record["exception"] is not None:
+            entry["exception"] = "".join(traceback.format_exception(*record["exception"]))
+        sys.stderr.write(json.dumps(entry, ensure_ascii=False) + "\n")
 
-            filename = os.path.basename(full_path)
+    def _for(self, source):
+        """每个来源只绑定一次，之后的调用不再创建新的 logger 对象"""
+        bound = self._sources.get(source)
+        if bound is None:
+            bound = self._sources[source] = self.logger.opt(depth=1).bind(source=source)
+        return bound
 
-            return {
-                'filename': filename,
-                'function': function,
-                'lineno': lineno
-            }
-        finally:
-            del frame
+    def enabled(self, level):
+        """供调用方在拼接开销较大的日志前判断级别"""
+        return self._levels[level] >= self.min_level
 
     def info(self, message, source="API"):
-        caller_info = self._get_caller_info()
-        self.logger.bind(**caller_info).info(f"[{source}] {message}")
+        if self._levels["INFO"] < self.min_level:
+            return
+        self._for(source).info(message)
 
     def error(self, message, source="API"):
-        caller_info = self._get_caller_info()
-
+        if self._levels["ERROR"] < self.min_level:
+            return
         if isinstance(message, Exception):
-            self.logger.bind(**caller_info).exception(f"[{source}] {str(message)}")
+            self._for(source).exception(str(message))
         else:
-            self.logger.bind(**caller_info).error(f"[{source}] {message}")
+            self._for(source).error(message)
 
     def warning(self, message, source="API"):
-        caller_info = self._get_caller_info()
-        self.logger.bind(**caller_info).warning(f"[{source}] {message}")
+        if self._levels["WARNING"] < self.min_level:
+            return
+        self._for(source).warning(message)
 
     def debug(self, message, source="API"):
-        caller_info = self._get_caller_info()
-        self.logger.bind(**caller_info).debug(f"[{source}] {message}")
+        if self._levels["DEBUG"] < self.min_level:
+            return
+        self._for(source).debug(message)
 
     async def request_logger(self, request):
-        caller_info = self._get_caller_info()
-        self.logger.bind(**caller_info).info(f"请求: {request.method} {request.path}", "Request")
+        self.info(f"请求: {request.method} {request.path}", "Request")
 
-logger = Logger(level="INFO")
-DATA_DIR = Path("/data")
+# DEBUG 级别下完整请求体的采样比例（0~1）
+LOG_PAYLOAD_SAMPLE = float(os.environ.get("LOG_PAYLOAD_SAMPLE", 1))
+
+logger = Logger(
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+    json_lines=os.environ.get("LOG_FORMAT", "text").lower() == "json",
+    enqueue=os.environ.get("LOG_ENQUEUE", "true").lower() == "true"
+)
+DATA_DIR = Path(os.environ.get("DATA_DIR") or "/data")
 
 if not DATA_DIR.exists():
     DATA_DIR.mkdir(parents=True, exist_ok=True)
@@ -162,33 +236,91 @@ CONFIG = {
         "IS_CUSTOM_SSO": os.environ.get("IS_CUSTOM_SSO", "false").lower() == "true",
         "BASE_URL": "https://grok.com",
         "API_KEY": os.environ.get("API_KEY", "sk-123456"),
-        "SIGNATURE_COOKIE": None,
         "PICGO_KEY": os.environ.get("PICGO_KEY") or None,
         "TUMY_KEY": os.environ.get("TUMY_KEY") or None,
         "RETRY_TIME": 1000,
-        "PROXY": os.environ.get("PROXY") or None
+        "PROXY": os.environ.get("PROXY") or None,
+        # 出站连接池：最多保留的会话数（按 代理 × 浏览器指纹 × 事件循环 区分）与空闲回收秒数
+        "POOL_MAX_SESSIONS": int(os.environ.get("HTTP_POOL_MAX_SESSIONS", 8)),
+        "POOL_IDLE_TIMEOUT": float(os.environ.get("HTTP_POOL_IDLE_TIMEOUT", 300)),
+        # 每个会话同时进行的传输数上限，超出的请求在 curl_cffi 内部排队；流式对话会长时间占用名额
+        "POOL_MAX_CLIENTS": int(os.environ.get("HTTP_POOL_MAX_CLIENTS", 1024)),
+        # 单次对话中图片/文本附件并发上传的上限（每个请求各自计数）
+        "UPLOAD_CONCURRENCY": int(os.environ.get("UPLOAD_CONCURRENCY", 4)),
+        # 所有请求共享的上传线程数
+        "UPLOAD_POOL_SIZE": int(os.environ.get("UPLOAD_POOL_SIZE", 32)),
+        # 上传结果缓存：条目上限（0 关闭）与有效期（秒）
+        "UPLOAD_CACHE_SIZE": int(os.environ.get("UPLOAD_CACHE_SIZE", 512)),
+        "UPLOAD_CACHE_TTL": float(os.environ.get("UPLOAD_CACHE_TTL", 3600)),
+        # 后台生成 x_statsig_id 的总时间预算（秒），0 表示只使用本地回退 ID
+        "STATSIG_PROVISION_BUDGET": float(os.environ.get("STATSIG_PROVISION_BUDGET", 30)),
+        # grok.com meta 内容与指纹的缓存有效期（秒），过期后后台刷新
+        "STATSIG_META_TTL": float(os.environ.get("STATSIG_META_TTL", 21600)),
+        # 开启后自主生成的 x_statsig_id 改为逐请求取用，从预生成的 ID 池中获取
+        "STATSIG_PER_REQUEST": os.environ.get("STATSIG_PER_REQUEST", "false").lower() == "true",
+        "STATSIG_POOL_BATCH": int(os.environ.get("STATSIG_POOL_BATCH", 64)),
+        "STATSIG_POOL_MAX_AGE": float(os.environ.get("STATSIG_POOL_MAX_AGE", 60)),
+        # 对冲请求：首个令牌迟迟不返回响应头时换一个令牌再发一路，先返回合法首行的一路胜出
+        "HEDGE_REQUESTS": os.environ.get("HEDGE_REQUESTS", "false").lower() == "true",
+        # 对冲等待时间取最近响应头耗时的该分位数（秒，限制在最小值与上游连接超时之间）；样本不足时用 HEDGE_DELAY
+        "HEDGE_PERCENTILE": float(os.environ.get("HEDGE_PERCENTILE", 95)),
+        "HEDGE_DELAY": float(os.environ.get("HEDGE_DELAY", 3)),
+        "HEDGE_MIN_DELAY": float(os.environ.get("HEDGE_MIN_DELAY", 0.5)),
+        # 每个模型同时进行中的对话请求上限，如 "20" 或 "grok-3:20,grok-4:8,*:10"，0 表示不限制
+        "MODEL_MAX_IN_FLIGHT": os.environ.get("MODEL_MAX_IN_FLIGHT", "0"),
+        # 暂无名额时每个模型最多排队的请求数，以及最长等待秒数（客户端可用 X-Queue-Timeout 缩短）
+        "ADMISSION_QUEUE_SIZE": int(os.environ.get("ADMISSION_QUEUE_SIZE", 64)),
+        "ADMISSION_TIMEOUT": float(os.environ.get("ADMISSION_TIMEOUT", 10))
     },
     "ADMIN": {
         "MANAGER_SWITCH": os.environ.get("MANAGER_SWITCH") or None,
         "PASSWORD": os.environ.get("ADMINPASSWORD") or None 
     },
     "SERVER": {
-        "COOKIE": None,
         "CF_CLEARANCE":os.environ.get("CF_CLEARANCE") or None,
-        "PORT": int(os.environ.get("PORT", 5200))
+        "PORT": int(os.environ.get("PORT", 5200)),
+        # flask: 内置 WSGI 服务；asgi: 基于 asyncio 的异步服务（需安装 uvicorn）
+        "MODE": os.environ.get("SERVER_MODE", "flask").lower(),
+        # ASGI 模式下的工作进程数，大于 1 时令牌池状态必须放在共享存储中
+        "WORKERS": max(1, int(os.environ.get("SERVER_WORKERS", 1)))
     },
     "RETRY": {
         "RETRYSWITCH": False,
         "MAX_ATTEMPTS": 2
     },
     "TOKEN_STATUS_FILE": str(DATA_DIR / "token_status.json"),
+    # 令牌状态后台合并写盘的间隔（秒）
+    "TOKEN_STATUS_FLUSH_INTERVAL": float(os.environ.get("TOKEN_STATUS_FLUSH_INTERVAL", 5)),
+    # 开启后每次计数变更追加一行日志，崩溃重启时重放，最多只丢失一行
+    "TOKEN_STATUS_JOURNAL": os.environ.get("TOKEN_STATUS_JOURNAL", "false").lower() == "true",
+    "TOKEN_STATUS_JOURNAL_FILE": str(DATA_DIR / "token_status.journal"),
+    # 令牌池状态存储：memory 为进程内（默认）；sqlite 为 WAL 模式的本地数据库，供多个 worker 共享
+    "TOKEN_STORE": (os.environ.get("TOKEN_STORE") or ("sqlite" if int(os.environ.get("SERVER_WORKERS", 1)) > 1 else "memory")).lower(),
+    "TOKEN_STORE_PATH": os.environ.get("TOKEN_STORE_PATH") or str(DATA_DIR / "token_pool.db"),
+    # 令牌熔断：上游故障连续失败该次数（鉴权失败则立即）后熔断，冷却时间（秒）从基数起按熔断次数翻倍，不超过上限
+    "TOKEN_BREAKER_THRESHOLD": int(os.environ.get("TOKEN_BREAKER_THRESHOLD", 3)),
+    "TOKEN_BREAKER_COOLDOWN": float(os.environ.get("TOKEN_BREAKER_COOLDOWN", 30)),
+    "TOKEN_BREAKER_MAX_COOLDOWN": float(os.environ.get("TOKEN_BREAKER_MAX_COOLDOWN", 1800)),
+    # 令牌选择策略：health（默认，队首若干个中选最健康的）、round_robin、lru、quota_weighted
+    "TOKEN_SELECTION": os.environ.get("TOKEN_SELECTION", "health").lower(),
+    # health 策略在队首的多少个可用令牌中比较健康分，1 表示总是使用队首令牌
+    "TOKEN_HEALTH_CANDIDATES": max(1, int(os.environ.get("TOKEN_HEALTH_CANDIDATES", 4))),
+    # 按模型优先使用的令牌类型，如 "grok-4:heavy,grok-3:normal"
+    "TOKEN_TYPE_PREFERENCE": os.environ.get("TOKEN_TYPE_PREFERENCE", ""),
+    # 单个令牌同时进行中的请求（流）上限，0 表示不限制
+    "TOKEN_MAX_IN_FLIGHT": int(os.environ.get("TOKEN_MAX_IN_FLIGHT", 0)),
+    "STATSIG_META_FILE": str(DATA_DIR / "statsig_meta.json"),
     "SHOW_THINKING": os.environ.get("SHOW_THINKING") == "true",
     "IS_THINKING": False,
     "IS_IMG_GEN": False,
     "IS_IMG_GEN2": False,
-    "ISSHOW_SEARCH_RESULTS": os.environ.get("ISSHOW_SEARCH_RESULTS", "true").lower() == "true"
+    "ISSHOW_SEARCH_RESULTS": os.environ.get("ISSHOW_SEARCH_RESULTS", "true").lower() == "true",
+    # 同一次上游读取到的多个 token 合并为一个 SSE 数据块下发，不引入额外等待
+    "SSE_COALESCE": os.environ.get("SSE_COALESCE", "true").lower() == "true"
 }
 
+meta_cache.configure(ttl=CONFIG["API"]["STATSIG_META_TTL"], path=CONFIG["STATSIG_META_FILE"])
+
 def generate_statsig_id_fallback():
     """
     使用自主生成方法作为备用方案生成 x_statsig_id
@@ -203,13 +335,16 @@ def generate_statsig_id_fallback():
         # 如果自主生成也失败，返回一个默认值
         return "fallback-statsig-id-" + str(uuid.uuid4())
 
-def get_x_statsig_id_primary():
+def get_x_statsig_id_primary(deadline=None):
     """
     主要策略：优先使用自主生成方法生成 x_statsig_id
+
+    Args:
+        deadline: 获取 meta 内容的截止时间（time.monotonic()），None 表示不限时
     """
     try:
         logger.info("使用主要策略：自主生成 x_statsig_id", "StatsigGenerator")
-        generator = XStatsigIDGenerator()
+        generator = XStatsigIDGenerator(deadline=deadline)
         x_statsig_id = generator.generate_x_statsig_id()
         logger.info("主要策略成功：自主生成 x_statsig_id 完成", "StatsigGenerator")
         return {
@@ -278,38 +413,127 @@ def get_x_statsig_id():
     logger.error("所有策略都失败，使用默认 x_statsig_id", "StatsigStrategy")
     return "fallback-statsig-id-" + str(uuid.uuid4())
 
-# 初始化 x_statsig_id（在应用启动时获取一次）
+# 初始化 x_statsig_id：启动时先用本地回退 ID，正式 ID 在后台生成
 _cached_x_statsig_id = None
 _cached_x_statsig_id_method = None
+_statsig_provision_lock = threading.Lock()
+_statsig_provision_thread = None
+# 最近一次强制刷新（备用策略）的时间，用于避免 403 时反复刷新重试
+_statsig_refreshed_at = float("-inf")
+
+STARTUP_METRICS = {
+    "ready_ms": None,
+    "statsig_provision_ms": None,
+    "statsig_method": None
+}
+
+def _provision_x_statsig_id(budget):
+    """后台线程：在时间预算内自主生成 x_statsig_id，成功后替换启动时的回退 ID"""
+    global _cached_x_statsig_id, _cached_x_statsig_id_method
+    started = time.perf_counter()
+    result = get_x_statsig_id_primary(deadline=time.monotonic() + budget)
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    with _statsig_provision_lock:
+        STARTUP_METRICS["statsig_provision_ms"] = elapsed_ms
+        # 期间若已因请求失败强制切换到备用策略，则保留切换后的结果
+        if result['success'] and _cached_x_statsig_id_method == 'startup_fallback':
+            _cached_x_statsig_id = result['x_statsig_id']
+            _cached_x_statsig_id_method = 'initial'
+        STARTUP_METRICS["statsig_method"] = _cached_x_statsig_id_method
+
+    if result['success']:
+        logger.info(f"后台生成 x_statsig_id 完成，耗时 {elapsed_ms}ms", "StatsigStrategy")
+    else:
+        logger.warning(f"后台生成 x_statsig_id 失败，继续使用本地回退 ID，耗时 {elapsed_ms}ms", "StatsigStrategy")
+
+def start_x_statsig_id_provisioning():
+    """启动后台生成线程（只启动一次），预算为 0 时不生成"""
+    global _statsig_provision_thread
+    budget = CONFIG["API"]["STATSIG_PROVISION_BUDGET"]
+    if budget <= 0 or _statsig_provision_thread is not None:
+        return
+    _statsig_provision_thread = threading.Thread(
+        target=_provision_x_statsig_id, args=(budget,), name="statsig-provision", daemon=True
+    )
+    _statsig_provision_thread.start()
 
 def get_cached_x_statsig_id():
     """
-    获取缓存的 x_statsig_id，如果没有缓存则重新获取
+    获取缓存的 x_statsig_id。
+    首次调用不等待网络：立即返回本地回退 ID，并在后台生成正式 ID。
     """
     global _cached_x_statsig_id, _cached_x_statsig_id_method
     if _cached_x_statsig_id is None:
-        _cached_x_statsig_id = get_x_statsig_id()
-        _cached_x_statsig_id_method = 'initial'
+        with _statsig_provision_lock:
+            if _cached_x_statsig_id is None:
+                _cached_x_statsig_id = generate_fallback_id()
+                _cached_x_statsig_id_method = 'startup_fallback'
+                STARTUP_METRICS["statsig_method"] = _cached_x_statsig_id_method
+        start_x_statsig_id_provisioning()
     return _cached_x_statsig_id
 
 def refresh_x_statsig_id_with_fallback():
     """
     强制刷新 x_statsig_id，使用备用策略（PHP 接口）
     """
-    global _cached_x_statsig_id, _cached_x_statsig_id_method
+    global _cached_x_statsig_id, _cached_x_statsig_id_method, _statsig_refreshed_at
 
     logger.info("强制刷新 x_statsig_id，使用备用策略", "StatsigStrategy")
+    _statsig_refreshed_at = time.monotonic()
     fallback_result = get_x_statsig_id_fallback()
 
     if fallback_result['success']:
-        _cached_x_statsig_id = fallback_result['x_statsig_id']
-        _cached_x_statsig_id_method = 'php_interface'
+        with _statsig_provision_lock:
+            _cached_x_statsig_id = fallback_result['x_statsig_id']
+            _cached_x_statsig_id_method = 'php_interface'
+            STARTUP_METRICS["statsig_method"] = _cached_x_statsig_id_method
         logger.info("成功使用备用策略刷新 x_statsig_id", "StatsigStrategy")
         return _cached_x_statsig_id
     else:
         logger.error("备用策略也失败，保持原有 x_statsig_id", "StatsigStrategy")
         return _cached_x_statsig_id
 
+class StatsigIDPool:
+    """
+    预生成的逐请求 x_statsig_id 池。
+    每批 ID 由 generate_many 一次生成并经 verify_many 校验，取用只是一次 popleft；
+    池空或整批超过最大存活时间时同步补一批，耗时在微秒级。
+    """
+
+    def __init__(self, batch_size, max_age):
+        self.batch_size = max(1, batch_size)
+        self.max_age = max_age
+        self._ids = deque()
+        self._filled_at = 0.0
+        self._lock = threading.Lock()
+        self.refills = 0
+        self.rejected = 0
+
+    def _refill(self):
+        ids = XStatsigIDGenerator().generate_many(self.batch_size)
+        valid = [statsig_id for statsig_id, ok in zip(ids, XStatsigIDGenerator.verify_many(ids)) if ok]
+        self.rejected += len(ids) - len(valid)
+        self._ids = deque(valid)
+        self._filled_at = time.monotonic()
+        self.refills += 1
+
+    def take(self):
+        """取出一个 ID，生成失败时返回 None"""
+        with self._lock:
+            if not self._ids or time.monotonic() - self._filled_at > self.max_age:
+                self._refill()
+            return self._ids.popleft() if self._ids else None
+
+    def snapshot(self):
+        return {
+            "available": len(self._ids),
+            "refills": self.refills,
+            "rejected": self.rejected
+        }
+
+statsig_id_pool = StatsigIDPool(CONFIG["API"]["STATSIG_POOL_BATCH"], CONFIG["API"]["STATSIG_POOL_MAX_AGE"])
+
 def get_default_headers(force_refresh_statsig=False):
     """
     动态生成默认请求头，确保 X-Statsig-Id 总是可用
@@ -321,6 +545,12 @@ def get_default_headers(force_refresh_statsig=False):
         statsig_id = refresh_x_statsig_id_with_fallback()
     else:
         statsig_id = get_cached_x_statsig_id()
+        # 只有自主生成成功（meta 缓存已就绪）后才逐请求取用，回退 ID 保持不变
+        if CONFIG["API"]["STATSIG_PER_REQUEST"] and _cached_x_statsig_id_method == 'initial':
+            try:
+                statsig_id = statsig_id_pool.take() or statsig_id
+            except Exception as e:
+                logger.error(f"从 ID 池获取 x_statsig_id 失败: {e}", "StatsigStrategy")
 
     return {
         'Accept': '*/*',
@@ -345,12 +575,798 @@ def get_default_headers(force_refresh_statsig=False):
 # 为了向后兼容，保留 DEFAULT_HEADERS 变量
 DEFAULT_HEADERS = get_default_headers()
 
+def mask_sso(sso):
+    """日志中只保留 SSO 的前缀，足以区分令牌又不泄露完整凭据"""
+    if not sso:
+        return sso
+    return f"{sso[:12]}…" if len(sso) > 12 else sso
+
+class TokenStatusPersister:
+    """
+    token_status.json 的后台持久化。
+    请求线程只标记脏数据（可选地追加一行日志），后台线程按间隔合并写盘，
+    写盘使用临时文件 + 原子 rename，进程退出时再落一次盘。
+    日志记录的是变更后的字段值而不是增量，重放是幂等的，重复重放不会多算。
+    写盘前把日志轮转为 .old，快照替换成功后才删除；启动时依次重放 .old 与当前日志。
+    """
+
+    def __init__(self, file_path, snapshot_func, lock, interval=5.0, journal_path=None):
+        self.file_path = file_path
+        self.snapshot_func = snapshot_func
+        self.lock = lock
+        self.interval = interval
+        self.journal_path = journal_path
+        self.rotated_journal_path = f"{journal_path}.old" if journal_path else None
+        self._journal_file = None
+        # 后台线程与退出时的 flush 可能同时进行，轮转与删除 .old 需要串行
+        self._flush_lock = threading.Lock()
+        self._dirty = False
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def load(self):
+        """读取快照并重放日志，返回状态字典；文件不存在时返回 None"""
+        status_map = None
+        if Path(self.file_path).exists():
+            with open(self.file_path, 'r', encoding='utf-8') as f:
+                status_map = json.load(f)
+        journals = [path for path in (self.rotated_journal_path, self.journal_path) if path and Path(path).exists()]
+        if journals:
+            status_map = status_map or {}
+            replayed = 0
+            for path in journals:
+                with open(path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:
+                            # 崩溃时最后一行可能只写了一半
+                            continue
+                        self._apply_journal_record(status_map, record)
+                        replayed += 1
+            if replayed:
+                self._dirty = True
+                logger.info(f"已重放 {replayed} 条令牌状态日志", "TokenManager")
+        return status_map
+
+    @staticmethod
+    def _apply_journal_record(status_map, record):
+        sso = record["sso"]
+        if record.get("deleted"):
+            status_map.pop(sso, None)
+            return
+        status_map.setdefault(sso, {})[record["model"]] = record["status"]
+
+    def record(self, sso, model=None, status=None, deleted=False):
+        """追加一条日志并标记脏数据，调用方需持有 self.lock"""
+        if self.journal_path:
+            try:
+                if self._journal_file is None:
+                    self._journal_file = open(self.journal_path, 'a', encoding='utf-8', buffering=1)
+                if deleted:
+                    line = {"sso": sso, "deleted": True}
+                else:
+                    line = {"sso": sso, "model": model, "status": status}
+                self._journal_file.write(json.dumps(line, ensure_ascii=False) + "\n")
+            except Exception as error:
+                logger.error(f"写入令牌状态日志失败: {str(error)}", "TokenManager")
+        self.mark_dirty()
+
+    def mark_dirty(self):
+        self._dirty = True
+        if self._thread is None:
+            with self.lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+                    atexit.register(self.stop)
+
+    def _rotate_journal(self):
+        """调用方需持有 self.lock：快照已包含日志中的全部变更，日志转入 .old，之后的变更写入新日志"""
+        if self._journal_file is not None:
+            self._journal_file.close()
+            self._journal_file = None
+        if not self.journal_path or not Path(self.journal_path).exists():
+            return
+        if Path(self.rotated_journal_path).exists():
+            # 上次写盘失败，.old 中的变更还没有进入快照文件，追加而不是覆盖
+            with open(self.journal_path, 'r', encoding='utf-8') as src, \
+                    open(self.rotated_journal_path, 'a', encoding='utf-8') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.journal_path)
+        else:
+            os.replace(self.journal_path, self.rotated_journal_path)
+
+    def flush(self):
+        if not self._dirty:
+            return
+        with self._flush_lock:
+            try:
+                with self.lock:
+                    self._dirty = False
+                    content = json.dumps(self.snapshot_func(), ensure_ascii=False)
+                    self._rotate_journal()
+
+                tmp_path = f"{self.file_path}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(content)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.file_path)
+                # 快照已落盘，轮转出的日志不再需要
+                if self.rotated_journal_path and Path(self.rotated_journal_path).exists():
+                    os.remove(self.rotated_journal_path)
+                logger.debug("令牌状态已保存到配置文件", "TokenManager")
+            except Exception as error:
+                self._dirty = True
+                logger.error(f"保存令牌状态失败: {str(error)}", "TokenManager")
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+        self.flush()
+
+class DeadlineScheduler:
+    """
+    按截止时间触发的一次性任务调度器，内部是一个最小堆。
+    后台线程只在最近的截止时间醒来；同一个 key 重复调度以最后一次为准，旧的堆项在弹出时丢弃。
+    clock 返回毫秒时间戳，可注入；测试时可不启动线程，直接用 run_due(now) 驱动。
+    """
+
+    # 最长等待时间（秒），防止系统时间跳变或注入的时钟前移后长时间不醒
+    MAX_WAIT = 300
+
+    def __init__(self, handler, clock=None):
+        # handler(keys, now) 在调度线程中执行，keys 为本次到期的全部 key
+        self.handler = handler
+        self.clock = clock or (lambda: int(time.time() * 1000))
+        self._heap = []
+        self._due = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def schedule(self, key, due):
+        with self._cond:
+            if self._due.get(key) == due:
+                return
+            self._due[key] = due
+            heapq.heappush(self._heap, (due, next(self._seq), key))
+            if self._heap[0][2] == key:
+                self._cond.notify()
+
+    def cancel(self, key):
+        with self._cond:
+            self._due.pop(key, None)
+
+    def _discard_stale(self):
+        while self._heap and self._due.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def next_due(self):
+        with self._cond:
+            self._discard_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def run_due(self, now=None):
+        """执行所有截止时间不晚于 now 的任务，返回到期的 key 列表"""
+        now = self.clock() if now is None else now
+        keys = []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                due, _, key = heapq.heappop(self._heap)
+                if self._due.get(key) == due:
+                    del self._due[key]
+                    keys.append(key)
+        if keys:
+            self.handler(keys, now)
+        return keys
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                next_due = self.next_due()
+                wait = self.MAX_WAIT if next_due is None else min(self.MAX_WAIT, (next_due - self.clock()) / 1000)
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+            try:
+                self.run_due()
+            except Exception as error:
+                logger.error(f"定时任务执行失败: {error}", "Scheduler")
+
+    def start(self):
+        """启动调度线程，已在运行时忽略；stop 之后可以再次启动"""
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, name="token-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def __len__(self):
+        return len(self._due)
+
+class TokenRing:
+    """
+    单个模型的令牌轮转结构：OrderedDict 同时充当队列和 token -> 条目 的索引，
+    取队首、按 token 查找、移除、追加都是 O(1)。本身不加锁，由 AuthTokenManager 统一加锁。
+
+    同时按令牌类型维护总额度与已用次数，增删和计数变更时 O(1) 更新，
+    剩余额度查询不再遍历令牌。条目的 RequestCount 必须通过 set_count 修改。
+    """
+
+    def __init__(self, limits=None, entries=None):
+        # 令牌类型 -> 该模型的 RequestFrequency，未配置的类型额度为 0
+        self.limits = limits or {}
+        self._entries = OrderedDict()
+        self.capacity = {}
+        self.used = {}
+        for entry in entries or []:
+            self.add(entry)
+
+    def _account(self, entry, sign):
+        token_type = entry.get("type", "normal")
+        self.capacity[token_type] = self.capacity.get(token_type, 0) + sign * self.limits.get(token_type, 0)
+        self.used[token_type] = self.used.get(token_type, 0) + sign * entry.get("RequestCount", 0)
+
+    def head(self):
+        return next(iter(self._entries.values()), None)
+
+    def get(self, token):
+        return self._entries.get(token)
+
+    def add(self, entry):
+        """追加到队尾，已存在时返回 False"""
+        if entry["token"] in self._entries:
+            return False
+        self._entries[entry["token"]] = entry
+        self._account(entry, 1)
+        return True
+
+    def remove(self, token):
+        entry = self._entries.pop(token, None)
+        if entry is not None:
+            self._account(entry, -1)
+        return entry
+
+    def set_count(self, entry, count):
+        """修改队列中条目的 RequestCount 并同步已用次数"""
+        token_type = entry.get("type", "normal")
+        self.used[token_type] = self.used.get(token_type, 0) + count - entry["RequestCount"]
+        entry["RequestCount"] = count
+
+    def remaining(self, token_type=None):
+        """剩余可用次数，token_type 为 None 时返回所有类型合计"""
+        if token_type is not None:
+            return max(0, self.capacity.get(token_type, 0) - self.used.get(token_type, 0))
+        return max(0, sum(self.capacity.values()) - sum(self.used.values()))
+
+    def candidates(self, predicate, limit):
+        """按队列顺序返回前 limit 个满足 predicate 的条目"""
+        found = []
+        for entry in self._entries.values():
+            if predicate(entry):
+                found.append(entry)
+                if len(found) >= limit:
+                    break
+        return found
+
+    def rotate(self):
+        """把队首移到队尾"""
+        if self._entries:
+            self._entries.move_to_end(next(iter(self._entries)))
+
+    def rotate_past(self, token):
+        """依次把队首移到队尾，直到指定条目也移到队尾，循环顺序保持不变"""
+        while token in self._entries:
+            head = next(iter(self._entries))
+            self._entries.move_to_end(head)
+            if head == token:
+                break
+
+    def move_to_end(self, token):
+        if token in self._entries:
+            self._entries.move_to_end(token)
+
+    def __contains__(self, token):
+        return token in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(list(self._entries.values()))
+
+class TokenHealthTracker:
+    """
+    每个 (模型, 令牌) 的健康状况：响应头耗时、首 token 耗时和错误率的 EWMA，以及熔断状态。
+    熔断打开后在冷却结束前不参与选择；冷却结束即半开，只放行一个探测请求，
+    探测成功恢复正常，失败则以翻倍的冷却时间重新打开。
+    统计只来自本进程的请求。自带一把只保护健康数据的锁，持锁时间极短且不做 I/O，
+    事件循环上记录耗时不必等待 AuthTokenManager 的锁；选令牌时在管理器锁内再取这把锁，顺序固定。
+    """
+
+    ALPHA = 0.2
+    # 错误率对健康分的放大系数：错误率 50% 的令牌按耗时的 3 倍计
+    ERROR_PENALTY = 4
+    # 探测请求在该时间（秒）内没有结果时视为丢失，再放行一个
+    PROBE_TIMEOUT = 60
+
+    def __init__(self, threshold, base_cooldown, max_cooldown, clock=time.monotonic):
+        self.threshold = max(1, threshold)
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.clock = clock
+        self._health = {}
+        self._lock = threading.Lock()
+
+    def _get(self, model, token):
+        health = self._health.get((model, token))
+        if health is None:
+            health = self._health[(model, token)] = {
+                "latency_ms": None,
+                "ttft_ms": None,
+                "error_rate": 0.0,
+                "successes": 0,
+                "failures": 0,
+                "consecutive_failures": 0,
+                "open": False,
+                "trips": 0,
+                "open_until": None,
+                "probe_started": None
+            }
+        return health
+
+    @classmethod
+    def _ewma(cls, current, sample):
+        return sample if current is None else current + cls.ALPHA * (sample - current)
+
+    def state(self, model, token, now=None):
+        """closed / open / half_open"""
+        with self._lock:
+            health = self._health.get((model, token))
+            if health is None or not health["open"]:
+                return "closed"
+            return "open" if (self.clock() if now is None else now) < health["open_until"] else "half_open"
+
+    def admits(self, model, token, now):
+        """是否可以参与选择：熔断冷却中不可以；半开时已有未超时的探测请求也不可以"""
+        with self._lock:
+            health = self._health.get((model, token))
+            if health is None or not health["open"]:
+                return True
+            if now < health["open_until"]:
+                return False
+            return health["probe_started"] is None or now - health["probe_started"] >= self.PROBE_TIMEOUT
+
+    def on_selected(self, model, token, now):
+        """被选中时调用：半开状态下这次请求就是探测请求"""
+        with self._lock:
+            health = self._health.get((model, token))
+            if health is not None and health["open"]:
+                health["probe_started"] = now
+
+    def score(self, model, token):
+        """
+        越小越好：首 token 耗时（没有时用响应头耗时）按错误率放大；没有样本的令牌为 0，优先试用。
+        可以参与选择的熔断令牌（半开）为 -1，优先放行探测请求，否则它的错误率会让它一直轮不到。
+        """
+        with self._lock:
+            health = self._health.get((model, token))
+            if health is None:
+                return 0.0
+            if health["open"]:
+                return -1.0
+            speed = health["ttft_ms"] if health["ttft_ms"] is not None else (health["latency_ms"] or 0.0)
+            return speed * (1 + self.ERROR_PENALTY * health["error_rate"])
+
+    def record_success(self, model, token, latency_ms):
+        """记录一次成功的响应，返回 True 表示熔断因此恢复"""
+        with self._lock:
+            health = self._get(model, token)
+            health["latency_ms"] = self._ewma(health["latency_ms"], latency_ms)
+            health["error_rate"] = self._ewma(health["error_rate"], 0.0)
+            health["successes"] += 1
+            health["consecutive_failures"] = 0
+            recovered = health["open"]
+            health.update(open=False, trips=0, open_until=None, probe_started=None)
+            return recovered
+
+    def record_ttft(self, model, token, ttft_ms):
+        with self._lock:
+            health = self._health.get((model, token))
+            if health is not None:
+                health["ttft_ms"] = self._ewma(health["ttft_ms"], ttft_ms)
+
+    def record_failure(self, model, token, trip=False):
+        """
+        记录一次失败。trip 为 True、连续失败达到阈值或半开探测失败时打开熔断，返回本次冷却秒数；
+        熔断已打开期间到达的其他失败（熔断前发出的请求）只计数，返回 None。
+        """
+        with self._lock:
+            health = self._get(model, token)
+            health["error_rate"] = self._ewma(health["error_rate"], 1.0)
+            health["failures"] += 1
+            health["consecutive_failures"] += 1
+            if health["open"]:
+                if health["probe_started"] is None:
+                    return None
+            elif not trip and health["consecutive_failures"] < self.threshold:
+                return None
+
+            cooldown = min(self.max_cooldown, self.base_cooldown * 2 ** health["trips"])
+            health["trips"] += 1
+            health.update(open=True, open_until=self.clock() + cooldown, probe_started=None)
+            return cooldown
+
+    def forget(self, token):
+        with self._lock:
+            for key in [key for key in self._health if key[1] == token]:
+                del self._health[key]
+
+    def snapshot(self):
+        now = self.clock()
+        summary = {}
+        with self._lock:
+            items = [(key, dict(health)) for key, health in self._health.items()]
+        for (model, token), health in items:
+            summary.setdefault(model, {})[mask_sso(token.split(";")[-1])] = {
+                "state": "closed" if not health["open"] else ("open" if now < health["open_until"] else "half_open"),
+                "latency_ms": None if health["latency_ms"] is None else round(health["latency_ms"], 1),
+                "ttft_ms": None if health["ttft_ms"] is None else round(health["ttft_ms"], 1),
+                "error_rate": round(health["error_rate"], 3),
+                "successes": health["successes"],
+                "failures": health["failures"],
+                "trips": health["trips"],
+                "reopens_in": round(max(0.0, health["open_until"] - now), 1) if health["open"] else None
+            }
+        return summary
+
+class TokenSelectionStrategy(abc.ABC):
+    """
+    令牌选择策略：从轮转队列中选出一个条目。admissible(entry) 判断条目能否参与选择
+    （熔断未打开、不在排除集合中、符合类型偏好），score(entry) 为健康分，越小越好。
+    在 AuthTokenManager 的锁内调用，可以调整队列顺序，不修改计数。
+    """
+
+    name = None
+
+    @abc.abstractmethod
+    def select(self, ring, admissible, score):
+        """返回选中的条目，没有可用条目时返回 None"""
+
+class HealthSelection(TokenSelectionStrategy):
+    """默认策略：集中消耗队首令牌，在队首的若干个可用令牌中选健康分最好的一个"""
+
+    name = "health"
+
+    def __init__(self, candidates):
+        self.candidates = max(1, candidates)
+
+    def select(self, ring, admissible, score):
+        candidates = ring.candidates(admissible, self.candidates)
+        return min(candidates, key=score) if candidates else None
+
+class RoundRobinSelection(TokenSelectionStrategy):
+    """轮询：选中第一个可用令牌后把它和它之前的条目依次移到队尾，下一次从它之后的令牌开始"""
+
+    name = "round_robin"
+
+    def select(self, ring, admissible, score):
+        candidates = ring.candidates(admissible, 1)
+        if not candidates:
+            return None
+        ring.rotate_past(candidates[0]["token"])
+        return candidates[0]
+
+class LeastRecentlyUsedSelection(TokenSelectionStrategy):
+    """最近最少使用：选中第一个可用令牌后只把它移到队尾，被跳过的令牌（熔断、被排除）留在前面，恢复后优先使用"""
+
+    name = "lru"
+
+    def select(self, ring, admissible, score):
+        candidates = ring.candidates(admissible, 1)
+        if not candidates:
+            return None
+        ring.move_to_end(candidates[0]["token"])
+        return candidates[0]
+
+class QuotaWeightedSelection(TokenSelectionStrategy):
+    """按剩余额度加权随机：剩余次数越多越容易被选中，各账号按额度比例消耗。需要遍历全部可用令牌"""
+
+    name = "quota_weighted"
+
+    def select(self, ring, admissible, score):
+        candidates = ring.candidates(admissible, len(ring))
+        if not candidates:
+            return None
+        weights = [max(0, ring.limits.get(entry.get("type", "normal"), 0) - entry["RequestCount"]) for entry in candidates]
+        if not any(weights):
+            # 额度都已用完：返回队首，由调用方移入冷却池
+            return candidates[0]
+        return random.choices(candidates, weights=weights)[0]
+
+TOKEN_SELECTION_STRATEGIES = {
+    strategy.name: strategy
+    for strategy in (HealthSelection, RoundRobinSelection, LeastRecentlyUsedSelection, QuotaWeightedSelection)
+}
+
+def create_token_selection_strategy(name):
+    strategy = TOKEN_SELECTION_STRATEGIES.get(name)
+    if strategy is None:
+        raise ValueError(f"不支持的 TOKEN_SELECTION: {name}")
+    if strategy is HealthSelection:
+        return HealthSelection(CONFIG["TOKEN_HEALTH_CANDIDATES"])
+    return strategy()
+
+def parse_token_type_preference(value):
+    """解析 "grok-4:heavy,grok-3:normal" 形式的按模型令牌类型偏好"""
+    preference = {}
+    for item in (value or "").split(","):
+        model, _, token_type = item.strip().partition(":")
+        if not model:
+            continue
+        if token_type not in ("heavy", "normal"):
+            raise ValueError(f"TOKEN_TYPE_PREFERENCE 中模型 {model} 的令牌类型无效: {token_type}")
+        preference[model] = token_type
+    return preference
+
+class SQLiteTokenStore:
+    """
+    多 worker 共享的令牌池状态，使用 WAL 模式的 SQLite 文件。
+    每个 (SSO, 模型) 一行，计数、冷却时间和状态字段都在这里；
+    检查与递增在一条带条件的 UPDATE 中完成，多个进程并发也不会超出 RequestFrequency。
+    令牌增删、冷却和重置会递增 version，并把受影响行的 row_version 设为新的 version，
+    各 worker 只读取 row_version 大于自己已同步版本的行，增量更新本地轮转队列；
+    删除是软删除（deleted=1），这样其他 worker 也能同步到。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS token_pool (
+                sso TEXT NOT NULL,
+                model TEXT NOT NULL,
+                token TEXT NOT NULL,
+                type TEXT NOT NULL,
+                request_count INTEGER NOT NULL DEFAULT 0,
+                total_request_count INTEGER NOT NULL DEFAULT 0,
+                start_call_time INTEGER,
+                added_time INTEGER NOT NULL,
+                is_valid INTEGER NOT NULL DEFAULT 1,
+                invalidated_time INTEGER,
+                expired_time INTEGER,
+                row_version INTEGER NOT NULL DEFAULT 0,
+                deleted INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (sso, model)
+            )
+        """)
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        # 旧版本创建的表没有增量同步所需的列
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(token_pool)")}
+        for column in ("row_version", "deleted"):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE token_pool ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+        conn.execute("CREATE INDEX IF NOT EXISTS token_pool_row_version ON token_pool (row_version)")
+
+    def _conn(self):
+        # sqlite3 连接不能跨线程共享，每个线程各自持有一个
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self, func):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    @staticmethod
+    def _current_version(conn):
+        row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return row[0] if row else 0
+
+    def _versioned(self, func):
+        """
+        在写事务中执行 func(conn, version)，version 为本次变更使用的新版本号；
+        func 返回受影响的行数，大于 0 时才提交新的 version。返回 func 的结果。
+        """
+        def run(conn):
+            version = self._current_version(conn) + 1
+            changed = func(conn, version)
+            if changed:
+                conn.execute(
+                    "INSERT INTO meta (key, value) VALUES ('version', ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                    (version,)
+                )
+            return changed
+        return self._transaction(run)
+
+    def version(self):
+        return self._current_version(self._conn())
+
+    def changes_since(self, version):
+        """返回 (当前 version, row_version 大于 version 的行)，含已软删除的行；两次读取在同一个读事务中完成"""
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            current = self._current_version(conn)
+            rows = [dict(row) for row in conn.execute(
+                "SELECT * FROM token_pool WHERE row_version > ? ORDER BY added_time, rowid", (version,)
+            )]
+        finally:
+            conn.execute("COMMIT")
+        return current, rows
+
+    def add(self, token, sso, token_type, models, now):
+        def run(conn, version):
+            added = 0
+            for model in models:
+                # 新令牌直接插入；已软删除的令牌重新添加时按新令牌重置
+                added += conn.execute("""
+                    INSERT INTO token_pool (sso, model, token, type, added_time, row_version) VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(sso, model) DO UPDATE SET
+                        token = excluded.token, type = excluded.type, added_time = excluded.added_time,
+                        request_count = 0, total_request_count = 0, start_call_time = NULL,
+                        is_valid = 1, invalidated_time = NULL, expired_time = NULL,
+                        deleted = 0, row_version = excluded.row_version
+                    WHERE deleted = 1
+                """, (sso, model, token, token_type, now, version)).rowcount
+            return added
+        self._versioned(run)
+
+    def delete(self, sso):
+        def run(conn, version):
+            return conn.execute(
+                "UPDATE token_pool SET deleted = 1, row_version = ? WHERE sso = ? AND deleted = 0",
+                (version, sso)
+            ).rowcount
+        self._versioned(run)
+
+    def try_acquire(self, sso, model, limit, now):
+        """未冷却且计数未满时递增计数并返回更新后的行，否则返回 None"""
+        def run(conn):
+            updated = conn.execute("""
+                UPDATE token_pool SET
+                    request_count = request_count + 1,
+                    total_request_count = total_request_count + 1,
+                    start_call_time = COALESCE(start_call_time, ?),
+                    is_valid = CASE WHEN request_count + 1 >= ? THEN 0 ELSE is_valid END,
+                    invalidated_time = CASE WHEN request_count + 1 >= ? THEN ? ELSE invalidated_time END
+                WHERE sso = ? AND model = ? AND deleted = 0 AND expired_time IS NULL AND request_count < ?
+            """, (now, limit, limit, now, sso, model, limit)).rowcount
+            if not updated:
+                return None
+            return dict(conn.execute("SELECT * FROM token_pool WHERE sso = ? AND model = ?", (sso, model)).fetchone())
+        return self._transaction(run)
+
+    def expire(self, sso, model, now):
+        """移入冷却池；已在冷却中的保持原冷却起点"""
+        def run(conn, version):
+            return conn.execute(
+                "UPDATE token_pool SET expired_time = ?, row_version = ? "
+                "WHERE sso = ? AND model = ? AND deleted = 0 AND expired_time IS NULL",
+                (now, version, sso, model)
+            ).rowcount
+        self._versioned(run)
+
+    def reduce(self, sso, model, count):
+        def run(conn, version):
+            return conn.execute("""
+                UPDATE token_pool SET
+                    total_request_count = MAX(0, total_request_count - MIN(request_count, ?)),
+                    request_count = MAX(0, request_count - ?),
+                    row_version = ?
+                WHERE sso = ? AND model = ? AND deleted = 0
+            """, (count, count, version, sso, model)).rowcount
+        self._versioned(run)
+
+    def refund(self, sso, model):
+        """退还一次计数并恢复可用状态；只改计数，不递增 version"""
+        def run(conn):
+            return conn.execute("""
+                UPDATE token_pool SET
+                    request_count = request_count - 1,
+                    total_request_count = MAX(0, total_request_count - 1),
+                    is_valid = 1,
+                    invalidated_time = NULL
+                WHERE sso = ? AND model = ? AND deleted = 0 AND expired_time IS NULL AND request_count > 0
+            """, (sso, model)).rowcount > 0
+        return self._transaction(run)
+
+    def reset_due(self, now, expirations):
+        """
+        按 (模型, 类型, 过期毫秒数) 重置到期的令牌：冷却期满的移回可用池，
+        计数周期已满的清零。返回被重置的行数。
+        """
+        def run(conn, version):
+            changed = 0
+            for model, token_type, expiration in expirations:
+                changed += conn.execute("""
+                    UPDATE token_pool SET
+                        expired_time = NULL, request_count = 0, start_call_time = NULL, added_time = ?,
+                        is_valid = 1, invalidated_time = NULL, total_request_count = 0, row_version = ?
+                    WHERE model = ? AND type = ? AND deleted = 0 AND expired_time IS NOT NULL AND ? - expired_time >= ?
+                """, (now, version, model, token_type, now, expiration)).rowcount
+                changed += conn.execute("""
+                    UPDATE token_pool SET
+                        request_count = 0, start_call_time = NULL,
+                        is_valid = 1, invalidated_time = NULL, total_request_count = 0, row_version = ?
+                    WHERE model = ? AND type = ? AND deleted = 0 AND expired_time IS NULL
+                        AND start_call_time IS NOT NULL AND ? - start_call_time >= ?
+                """, (version, model, token_type, now, expiration)).rowcount
+            return changed
+        return self._versioned(run)
+
+    def rows(self):
+        return [dict(row) for row in self._conn().execute(
+            "SELECT * FROM token_pool WHERE deleted = 0 ORDER BY added_time, rowid"
+        )]
+
+    @staticmethod
+    def status_of(row):
+        return {
+            "isValid": bool(row["is_valid"]),
+            "invalidatedTime": row["invalidated_time"],
+            "totalRequestCount": row["total_request_count"],
+            "type": row["type"]
+        }
+
+    def status_map(self):
+        status_map = {}
+        for row in self.rows():
+            status_map.setdefault(row["sso"], {})[row["model"]] = self.status_of(row)
+        return status_map
+
+def create_token_store():
+    backend = CONFIG["TOKEN_STORE"]
+    if backend == "memory":
+        return None
+    if backend == "sqlite":
+        logger.info(f"令牌池状态使用共享存储: {CONFIG['TOKEN_STORE_PATH']}", "TokenManager")
+        return SQLiteTokenStore(CONFIG["TOKEN_STORE_PATH"])
+    raise ValueError(f"不支持的 TOKEN_STORE: {backend}")
+
 # 替换你现有的 AuthTokenManager 类
 class AuthTokenManager:
     def __init__(self):
         self.token_model_map = {}
         self.expired_tokens = set()
         self.token_status_map = {}
+        # 所有令牌池状态的读写都在这把锁内完成，临界区只做 O(1) 操作
+        self._lock = threading.RLock()
         
         # 1. 定义不同等级的配置
         # 普通账号配置 (你可以根据需要调整)
@@ -375,24 +1391,163 @@ class AuthTokenManager:
         }
 
         self.token_reset_switch = False
-        self.token_reset_timer = None
+        # 各令牌的耗时、错误率与熔断状态，选择时优先健康、响应快的令牌
+        self.health = TokenHealthTracker(
+            CONFIG["TOKEN_BREAKER_THRESHOLD"],
+            CONFIG["TOKEN_BREAKER_COOLDOWN"],
+            CONFIG["TOKEN_BREAKER_MAX_COOLDOWN"]
+        )
+        self.selection = create_token_selection_strategy(CONFIG["TOKEN_SELECTION"])
+        # 令牌 -> 本进程中正在进行的请求数，达到 TOKEN_MAX_IN_FLIGHT 的令牌暂不参与选择
+        self.in_flight = {}
+        # 模型 -> 优先使用的令牌类型，该类型没有可用令牌时再用其他类型
+        self.type_preference = parse_token_type_preference(CONFIG["TOKEN_TYPE_PREFERENCE"])
+        # 冷却结束和计数窗口到期都按各自的截止时间触发，不再整点全量扫描
+        self.scheduler = DeadlineScheduler(self._on_deadlines)
+        self.persister = TokenStatusPersister(
+            CONFIG["TOKEN_STATUS_FILE"],
+            lambda: self.token_status_map,
+            self._lock,
+            interval=CONFIG["TOKEN_STATUS_FLUSH_INTERVAL"],
+            journal_path=CONFIG["TOKEN_STATUS_JOURNAL_FILE"] if CONFIG["TOKEN_STATUS_JOURNAL"] else None
+        )
+        # 多 worker 模式下的共享状态存储；为 None 时令牌池只存在于本进程内存中
+        self.store = create_token_store()
+        self._store_version = None
         self.load_token_status()
 
 
-    def save_token_status(self):
-        try:        
-            with open(CONFIG["TOKEN_STATUS_FILE"], 'w', encoding='utf-8') as f:
-                json.dump(self.token_status_map, f, indent=2, ensure_ascii=False)
+    def _new_ring(self, model, entries=None):
+        """创建模型的轮转队列，额度按令牌类型取自对应配置"""
+        limits = {
+            token_type: config[model]["RequestFrequency"]
+            for token_type, config in (("normal", self.model_normal_config), ("heavy", self.model_heavy_config))
+            if model in config
+        }
+        return TokenRing(limits, entries)
+
+    def _cooldown_time(self, model, token_type):
+        config_to_use = self.model_heavy_config if token_type == "heavy" else self.model_normal_config
+        return config_to_use[model]["ExpirationTime"] if model in config_to_use else None
+
+    def _window_time(self, model):
+        all_configs = {**self.model_normal_config, **self.model_heavy_config}
+        return all_configs[model]["ExpirationTime"] if model in all_configs else None
+
+    def _schedule_cooldown(self, token_info):
+        """冷却池中的令牌在冷却结束时重新加入轮转"""
+        token, model, expired_time, token_type = token_info
+        expiration_time = self._cooldown_time(model, token_type)
+        if expiration_time is not None:
+            self.scheduler.schedule(("cooldown", token_info), expired_time + expiration_time)
+
+    def _schedule_window(self, model, entry):
+        """计数窗口（从首次调用起算）到期时清零"""
+        expiration_time = self._window_time(model)
+        if expiration_time is not None and entry.get("StartCallTime"):
+            self.scheduler.schedule(("window", model, entry["token"]), entry["StartCallTime"] + expiration_time)
+
+    def _schedule_all(self):
+        """按当前状态补齐全部截止时间，调用方需持有 self._lock"""
+        for token_info in self.expired_tokens:
+            self._schedule_cooldown(token_info)
+        for model, ring in self.token_model_map.items():
+            for entry in ring:
+                self._schedule_window(model, entry)
+
+    def save_token_status(self, immediate=False):
+        """标记令牌状态需要保存，由后台线程合并写盘；immediate 为 True 时同步落盘"""
+        if self.store is not None:
+            # 共享存储本身就是持久化的，不再写 token_status.json
+            return
+        self.persister.mark_dirty()
+        if immediate:
+            self.persister.flush()
             logger.info("令牌状态已保存到配置文件", "TokenManager")
-        except Exception as error:
-            logger.error(f"保存令牌状态失败: {str(error)}", "TokenManager")
+
+    def _record_status(self, sso, model):
+        """记录单个令牌状态的变更，调用方需持有 self._lock"""
+        if self.store is None:
+            self.persister.record(sso, model, self.token_status_map[sso][model])
+
+    def _apply_store_row(self, row):
+        """
+        把共享存储中的一行同步到本地视图，调用方需持有 self._lock。
+        已在本地队列中的令牌保持原有轮转顺序，只更新计数；新出现的追加到队尾，冷却中或已删除的移出。
+        """
+        token, model, sso = row["token"], row["model"], row["sso"]
+        ring = self.token_model_map.get(model)
+        for token_info in [info for info in self.expired_tokens if info[0] == token and info[1] == model]:
+            self.expired_tokens.discard(token_info)
+            self.scheduler.cancel(("cooldown", token_info))
+
+        if row["deleted"]:
+            if ring is not None:
+                ring.remove(token)
+            self.scheduler.cancel(("window", model, token))
+            model_status = self.token_status_map.get(sso)
+            if model_status is not None:
+                model_status.pop(model, None)
+                if not model_status:
+                    del self.token_status_map[sso]
+            return
+
+        self.token_status_map.setdefault(sso, {})[model] = SQLiteTokenStore.status_of(row)
+        if row["expired_time"] is not None:
+            if ring is not None:
+                ring.remove(token)
+            self.scheduler.cancel(("window", model, token))
+            token_info = (token, model, row["expired_time"], row["type"])
+            self.expired_tokens.add(token_info)
+            self._schedule_cooldown(token_info)
+            return
+
+        if ring is None:
+            ring = self.token_model_map[model] = self._new_ring(model)
+        entry = ring.get(token)
+        if entry is None:
+            entry = self._new_entry(token, row["type"], row["added_time"])
+            ring.add(entry)
+        ring.set_count(entry, row["request_count"])
+        entry["StartCallTime"] = row["start_call_time"]
+        if entry["StartCallTime"] is None:
+            self.scheduler.cancel(("window", model, token))
+        else:
+            self._schedule_window(model, entry)
+
+    def _refresh_from_store(self):
+        """
+        其他 worker 增删、冷却或重置了令牌时增量同步。读取共享存储不持有 self._lock，
+        只把 row_version 比已同步版本新的行应用到本地视图；并发刷新时较旧的结果直接丢弃。
+        """
+        if self.store is None:
+            return
+        known = self._store_version
+        if known is not None and self.store.version() == known:
+            return
+        # 首次同步读取全部行（旧版本创建的行 row_version 为 0）
+        version, rows = self.store.changes_since(-1 if known is None else known)
+        with self._lock:
+            if self._store_version is not None and version <= self._store_version:
+                return
+            for row in rows:
+                self._apply_store_row(row)
+            self._store_version = version
+
+    def _expire_in_store(self, expired):
+        """把已在本地移入冷却池的 (sso, 模型, 时间) 写入共享存储，调用方不能持有 self._lock"""
+        for sso, model, now in expired:
+            self.store.expire(sso, model, now)
             
     def load_token_status(self):
+        if self.store is not None:
+            self._refresh_from_store()
+            logger.info("已从共享存储加载令牌池状态", "TokenManager")
+            return
         try:
-            token_status_file = Path(CONFIG["TOKEN_STATUS_FILE"])
-            if token_status_file.exists():
-                with open(token_status_file, 'r', encoding='utf-8') as f:
-                    self.token_status_map = json.load(f)
+            token_status_map = self.persister.load()
+            if token_status_map is not None:
+                self.token_status_map = token_status_map
                 logger.info("已从配置文件加载令牌状态", "TokenManager")
         except Exception as error:
             logger.error(f"加载令牌状态失败: {str(error)}", "TokenManager")
@@ -404,65 +1559,74 @@ class AuthTokenManager:
         config_to_use = self.model_heavy_config if token_type == "heavy" else self.model_normal_config
         models_to_add = config_to_use.keys()
 
-        for model in models_to_add:
-            if model not in self.token_model_map:
-                self.token_model_map[model] = []
-            if sso not in self.token_status_map:
-                self.token_status_map[sso] = {}
+        if self.store is not None:
+            # 写入共享存储后增量同步，本地视图与其他 worker 看到的一致
+            self.store.add(token, sso, token_type, models_to_add, int(time.time() * 1000))
+            self._refresh_from_store()
+            return
 
-            if any(entry["token"] == token for entry in self.token_model_map[model]):
-                continue
+        with self._lock:
+            for model in models_to_add:
+                if model not in self.token_model_map:
+                    self.token_model_map[model] = self._new_ring(model)
+                if sso not in self.token_status_map:
+                    self.token_status_map[sso] = {}
 
-            self.token_model_map[model].append({
-                "token": token,
-                "RequestCount": 0,
-                "AddedTime": int(time.time() * 1000),
-                "StartCallTime": None,
-                "type": token_type
-            })
-
-            if model not in self.token_status_map[sso]:
-                self.token_status_map[sso][model] = {
-                    "isValid": True,
-                    "invalidatedTime": None,
-                    "totalRequestCount": 0,
-                    "type": token_type
-                }
+                if not self.token_model_map[model].add(self._new_entry(token, token_type)):
+                    continue
+
+                if model not in self.token_status_map[sso]:
+                    self.token_status_map[sso][model] = {
+                        "isValid": True,
+                        "invalidatedTime": None,
+                        "totalRequestCount": 0,
+                        "type": token_type
+                    }
         if not isinitialization:
-            self.save_token_status()
+            self.save_token_status(immediate=True)
 
-    # set_token 也需要适应分组逻辑 (虽然 chat_completions 没用，但保持完整)
-    def set_token(self, token, token_type="normal"):
-        config_to_use = self.model_heavy_config if token_type == "heavy" else self.model_normal_config
-        models = list(config_to_use.keys())
-        
-        self.token_model_map = {model: [{
+    @staticmethod
+    def _new_entry(token, token_type, added_time=None):
+        return {
             "token": token,
             "RequestCount": 0,
-            "AddedTime": int(time.time() * 1000),
+            "AddedTime": added_time or int(time.time() * 1000),
             "StartCallTime": None,
             "type": token_type
-        }] for model in models}
+        }
 
+    # set_token 也需要适应分组逻辑 (虽然 chat_completions 没用，但保持完整)
+    def set_token(self, token, token_type="normal"):
+        config_to_use = self.model_heavy_config if token_type == "heavy" else self.model_normal_config
+        models = list(config_to_use.keys())
+        
         sso = token.split("sso=")[1].split(";")[0]
-        self.token_status_map[sso] = {model: {
-            "isValid": True,
-            "invalidatedTime": None,
-            "totalRequestCount": 0,
-            "type": token_type
-        } for model in models}
+        with self._lock:
+            self.token_model_map = {model: self._new_ring(model, [self._new_entry(token, token_type)]) for model in models}
+
+            self.token_status_map[sso] = {model: {
+                "isValid": True,
+                "invalidatedTime": None,
+                "totalRequestCount": 0,
+                "type": token_type
+            } for model in models}
 
     def delete_token(self, token):
         try:
             sso = token.split("sso=")[1].split(";")[0]
-            for model in self.token_model_map:
-                self.token_model_map[model] = [entry for entry in self.token_model_map[model] if entry["token"] != token]
-
-            if sso in self.token_status_map:
-                del self.token_status_map[sso]
+            with self._lock:
+                for model_tokens in self.token_model_map.values():
+                    model_tokens.remove(token)
+                self.expired_tokens = {info for info in self.expired_tokens if info[0] != token}
+                self.health.forget(token)
+
+                if sso in self.token_status_map:
+                    del self.token_status_map[sso]
+            if self.store is not None:
+                self.store.delete(sso)
             
-            self.save_token_status()
-            logger.info(f"令牌已成功移除: {token}", "TokenManager")
+            self.save_token_status(immediate=True)
+            logger.info(f"令牌已成功移除: {mask_sso(token.split(';')[-1])}", "TokenManager")
             return True
         except Exception as error:
             logger.error(f"令牌删除失败: {str(error)}")
@@ -471,90 +1635,265 @@ class AuthTokenManager:
     def reduce_token_request_count(self, model_id, count):
         try:
             normalized_model = self.normalize_model_name(model_id)
-            if normalized_model not in self.token_model_map or not self.token_model_map[normalized_model]:
-                return False
-                
-            token_entry = self.token_model_map[normalized_model][0]
-            new_count = max(0, token_entry["RequestCount"] - count)
-            reduction = token_entry["RequestCount"] - new_count
-            token_entry["RequestCount"] = new_count
-            
-            if token_entry["token"]:
-                sso = token_entry["token"].split("sso=")[1].split(";")[0]
+            with self._lock:
+                model_tokens = self.token_model_map.get(normalized_model)
+                token_entry = model_tokens.head() if model_tokens else None
+                if token_entry is None:
+                    return False
+
+                new_count = max(0, token_entry["RequestCount"] - count)
+                reduction = token_entry["RequestCount"] - new_count
+                model_tokens.set_count(token_entry, new_count)
+
+                sso = token_entry["token"].split("sso=")[1].split(";")[0] if token_entry["token"] else None
                 if sso in self.token_status_map and normalized_model in self.token_status_map[sso]:
                     self.token_status_map[sso][normalized_model]["totalRequestCount"] = max(
                         0, self.token_status_map[sso][normalized_model]["totalRequestCount"] - reduction)
+                    self._record_status(sso, normalized_model)
+            if sso and self.store is not None:
+                self.store.reduce(sso, normalized_model, count)
             return True
         except Exception as error:
             logger.error(f"重置校对token请求次数时发生错误: {str(error)}", "TokenManager")
             return False
 
-    def get_next_token_for_model(self, model_id, is_return=False):
-        normalized_model = self.normalize_model_name(model_id)
-
-        if normalized_model not in self.token_model_map or not self.token_model_map[normalized_model]:
-            return None
+    def _has_room(self, token):
+        limit = CONFIG["TOKEN_MAX_IN_FLIGHT"]
+        return not limit or self.in_flight.get(token, 0) < limit
+
+    def _has_busy_tokens(self, model, ring, exclude):
+        """是否还有只因并发数已满而没被选中的令牌，调用方需持有 self._lock"""
+        now = self.health.clock()
+        return bool(ring.candidates(
+            lambda entry: (not exclude or entry["token"] not in exclude)
+            and not self._has_room(entry["token"]) and self.health.admits(model, entry["token"], now),
+            1
+        ))
+
+    def _pick_entry(self, model, ring, exclude):
+        """
+        按选择策略从可放行（熔断未打开、并发数未满、不在 exclude 中）的令牌中选一个，模型配置了类型偏好时
+        先只在该类型中选；都不可放行时返回 None。调用方需持有 self._lock。
+        """
+        now = self.health.clock()
+
+        def admissible(entry):
+            return (
+                (not exclude or entry["token"] not in exclude)
+                and self._has_room(entry["token"])
+                and self.health.admits(model, entry["token"], now)
+            )
 
-        token_entry = self.token_model_map[normalized_model][0]
-        
-        if is_return:
-            return token_entry["token"]
+        def score(entry):
+            return self.health.score(model, entry["token"])
 
-        config_to_use = self.model_heavy_config if token_entry.get("type") == "heavy" else self.model_normal_config
-        
-        if normalized_model not in config_to_use:
-            logger.error(f"模型 {normalized_model} 不在类型为 '{token_entry.get('type')}' 的配置中", "TokenManager")
-            self.remove_token_from_model(normalized_model, token_entry["token"])
-            return self.get_next_token_for_model(model_id, is_return)
+        entry = None
+        preferred_type = self.type_preference.get(model)
+        if preferred_type:
+            entry = self.selection.select(
+                ring, lambda candidate: candidate.get("type", "normal") == preferred_type and admissible(candidate), score
+            )
+        if entry is None:
+            entry = self.selection.select(ring, admissible, score)
+        if entry is not None:
+            self.health.on_selected(model, entry["token"], now)
+        return entry
+
+    def get_next_token_for_model(self, model_id, is_return=False, exclude=None):
+        """
+        选出并计数一个令牌；exclude 中的令牌跳过（对冲请求的另一路不会选到同一个令牌）。
+        熔断打开的令牌不参与选择，其余按 TOKEN_SELECTION 策略选取。
+        选中的令牌进行中请求数加一，请求结束时由 release_in_flight 减一；
+        只因并发数已满而选不出令牌时抛出 TokenPoolBusy，由准入控制排队等待。
+        共享存储模式下，选取在 self._lock 内完成并先占住进行中名额，计数的 sqlite 事务在锁外执行。
+        """
+        normalized_model = self.normalize_model_name(model_id)
+        self._refresh_from_store()
 
-        model_config = config_to_use[normalized_model]
-        
+        while True:
+            expired = []
+            try:
+                with self._lock:
+                    model_tokens = self.token_model_map.get(normalized_model)
+                    if not model_tokens:
+                        return None
+
+                    if is_return:
+                        return model_tokens.head()["token"]
+
+                    if not self.token_reset_switch:
+                        self.start_token_reset_process()
+                        self.token_reset_switch = True
+
+                    token_entry, model_config = self._pick_countable_entry(normalized_model, model_tokens, exclude, expired)
+                    if token_entry is None:
+                        if self._has_busy_tokens(normalized_model, model_tokens, exclude):
+                            raise TokenPoolBusy(f"模型 {normalized_model} 的可用令牌并发数均已达到上限")
+                        return None
+                    token = token_entry["token"]
+                    self.in_flight[token] = self.in_flight.get(token, 0) + 1
+                    if self.store is None:
+                        self._count_locally(normalized_model, token_entry, model_config)
+                        return token
+            finally:
+                if expired:
+                    self._expire_in_store(expired)
+
+            # 检查与递增由共享存储的条件 UPDATE 保证，不会超出 RequestFrequency
+            sso = token.split("sso=")[1].split(";")[0]
+            try:
+                row = self.store.try_acquire(sso, normalized_model, model_config["RequestFrequency"], int(time.time() * 1000))
+            except BaseException:
+                self.release_in_flight(token)
+                raise
+            with self._lock:
+                if row is not None:
+                    self.token_status_map.setdefault(sso, {})[normalized_model] = SQLiteTokenStore.status_of(row)
+                    token_entry = model_tokens.get(token)
+                    if token_entry is not None:
+                        model_tokens.set_count(token_entry, row["request_count"])
+                        token_entry["StartCallTime"] = row["start_call_time"]
+                        self._schedule_window(normalized_model, token_entry)
+                    return token
+                # 计数已被其他 worker 用满，或已被移入冷却池
+                self._release_in_flight_locked(token)
+                expired = self._expire_locally(normalized_model, token)
+            if expired:
+                self._expire_in_store([expired])
+
+    def _pick_countable_entry(self, model, model_tokens, exclude, expired):
+        """
+        选出一个还有额度的条目，返回 (条目, 模型配置)；额度已满或类型不支持该模型的令牌移入冷却池，
+        需要写入共享存储的记录追加到 expired。调用方需持有 self._lock。
+        """
+        while model_tokens:
+            token_entry = self._pick_entry(model, model_tokens, exclude)
+            if token_entry is None:
+                return None, None
+            config_to_use = self.model_heavy_config if token_entry.get("type") == "heavy" else self.model_normal_config
+
+            if model not in config_to_use:
+                logger.error(f"模型 {model} 不在类型为 '{token_entry.get('type')}' 的配置中", "TokenManager")
+            elif token_entry["RequestCount"] < config_to_use[model]["RequestFrequency"]:
+                return token_entry, config_to_use[model]
+
+            store_record = self._expire_locally(model, token_entry["token"])
+            if store_record:
+                expired.append(store_record)
+        return None, None
+
+    def _count_locally(self, model, token_entry, model_config):
+        """内存模式下的计数，调用方需持有 self._lock"""
         if token_entry.get("StartCallTime") is None:
             token_entry["StartCallTime"] = int(time.time() * 1000)
-
-        if not self.token_reset_switch:
-            self.start_token_reset_process()
-            self.token_reset_switch = True
-
-        token_entry["RequestCount"] += 1
-
-        if token_entry["RequestCount"] > model_config["RequestFrequency"]:
-            self.remove_token_from_model(normalized_model, token_entry["token"])
-            next_list = self.token_model_map.get(normalized_model, [])
-            return next_list[0]["token"] if next_list else None
+            self._schedule_window(model, token_entry)
+        self.token_model_map[model].set_count(token_entry, token_entry["RequestCount"] + 1)
 
         sso = token_entry["token"].split("sso=")[1].split(";")[0]
-        if sso in self.token_status_map and normalized_model in self.token_status_map[sso]:
-            self.token_status_map[sso][normalized_model]["totalRequestCount"] += 1
+        if sso in self.token_status_map and model in self.token_status_map[sso]:
+            self.token_status_map[sso][model]["totalRequestCount"] += 1
             if token_entry["RequestCount"] >= model_config["RequestFrequency"]:
-                 self.token_status_map[sso][normalized_model]["isValid"] = False
-                 self.token_status_map[sso][normalized_model]["invalidatedTime"] = int(time.time() * 1000)
-        
-        self.save_token_status()
-        return token_entry["token"]
+                self.token_status_map[sso][model]["isValid"] = False
+                self.token_status_map[sso][model]["invalidatedTime"] = int(time.time() * 1000)
+            self._record_status(sso, model)
+
+    def release_in_flight(self, token):
+        """一次尝试结束，令牌的进行中请求数减一"""
+        with self._lock:
+            self._release_in_flight_locked(token)
+
+    def _release_in_flight_locked(self, token):
+        count = self.in_flight.get(token, 0) - 1
+        if count > 0:
+            self.in_flight[token] = count
+        else:
+            self.in_flight.pop(token, None)
+
+    def get_in_flight_summary(self):
+        with self._lock:
+            return {mask_sso(token.split(";")[-1]): count for token, count in self.in_flight.items()}
 
     def remove_token_from_model(self, model_id, token):
         normalized_model = self.normalize_model_name(model_id)
-        if normalized_model not in self.token_model_map: return False
+        with self._lock:
+            expired = self._expire_locally(normalized_model, token)
+        if expired is False:
+            return False
+        if expired:
+            self._expire_in_store([expired])
+        return True
+
+    def _expire_locally(self, model, token):
+        """
+        把令牌从本地轮转队列移入冷却池，调用方需持有 self._lock。
+        不在队列中时返回 False；共享存储模式下返回需要在锁外写入存储的 (sso, 模型, 时间)，否则返回 None。
+        """
+        model_tokens = self.token_model_map.get(model)
+        removed_entry = model_tokens.remove(token) if model_tokens is not None else None
+        if removed_entry is None:
+            return False
+        now = int(time.time() * 1000)
+        token_info = (removed_entry["token"], model, now, removed_entry.get("type", "normal"))
+        self.expired_tokens.add(token_info)
+        self.scheduler.cancel(("window", model, token))
+        self._schedule_cooldown(token_info)
+        logger.info(f"模型 {model} 的令牌 {mask_sso(token.split(';')[-1])} 已失效并移入冷却池。", "TokenManager")
+        if self.store is not None:
+            return (token.split("sso=")[1].split(";")[0], model, now)
+        return None
 
-        model_tokens = self.token_model_map[normalized_model]
-        token_index = -1
-        for i, entry in enumerate(model_tokens):
-            if entry["token"] == token:
-                token_index = i
-                break
-        
-        if token_index != -1:
-            removed_entry = model_tokens.pop(token_index)
-            self.expired_tokens.add(
-                (removed_entry["token"], normalized_model, int(time.time() * 1000), removed_entry.get("type", "normal"))
-            )
-            logger.info(f"模型 {model_id} 的令牌 {token} 已失效并移入冷却池。", "TokenManager")
-            return True
-        return False
+    def refund_token(self, model_id, token):
+        """
+        退还一次计数：对冲请求中被取消的一方、因上游故障或请求本身被拒而失败的尝试
+        都没有真正消耗令牌，不占 RequestFrequency。
+        令牌已被移入冷却池时不做处理。
+        """
+        normalized_model = self.normalize_model_name(model_id)
+        sso = token.split("sso=")[1].split(";")[0]
+        with self._lock:
+            model_tokens = self.token_model_map.get(normalized_model)
+            token_entry = model_tokens.get(token) if model_tokens else None
+            if token_entry is None or token_entry["RequestCount"] <= 0:
+                return False
+            model_tokens.set_count(token_entry, token_entry["RequestCount"] - 1)
+            status = self.token_status_map.get(sso, {}).get(normalized_model)
+            if status is not None:
+                status["totalRequestCount"] = max(0, status["totalRequestCount"] - 1)
+                status["isValid"] = True
+                status["invalidatedTime"] = None
+                self._record_status(sso, normalized_model)
+        if self.store is not None:
+            self.store.refund(sso, normalized_model)
+        return True
+
+    def record_token_success(self, model_id, token, latency_ms):
+        """上游返回 200 时记录响应头耗时；半开探测成功时关闭熔断"""
+        normalized_model = self.normalize_model_name(model_id)
+        recovered = self.health.record_success(normalized_model, token, latency_ms)
+        if recovered:
+            logger.info(f"模型 {model_id} 的令牌 {mask_sso(token.split(';')[-1])} 探测成功，熔断关闭", "TokenManager")
+
+    def record_token_ttft(self, model_id, token, ttft_ms):
+        normalized_model = self.normalize_model_name(model_id)
+        self.health.record_ttft(normalized_model, token, ttft_ms)
+
+    def record_token_failure(self, model_id, token, trip=False):
+        """
+        记录一次与额度无关的失败（鉴权失败、上游故障）。熔断打开后令牌留在轮转队列中，
+        只在短暂的冷却期内不参与选择，冷却时间按连续熔断次数指数增长，不再整段 ExpirationTime 冷却。
+        """
+        normalized_model = self.normalize_model_name(model_id)
+        cooldown = self.health.record_failure(normalized_model, token, trip)
+        if cooldown is not None:
+            logger.warning(f"模型 {model_id} 的令牌 {mask_sso(token.split(';')[-1])} 熔断，{cooldown:.0f} 秒后放行探测请求", "TokenManager")
+        return cooldown
+
+    def get_health_summary(self):
+        return self.health.snapshot()
 
     def get_expired_tokens(self):
-        return list(self.expired_tokens)
+        with self._lock:
+            return list(self.expired_tokens)
 
     # --- 以下是你版本中独有的、必须保留的辅助方法 ---
     def normalize_model_name(self, model):
@@ -567,107 +1906,249 @@ class AuthTokenManager:
 
     def get_token_count_for_model(self, model_id):
         normalized_model = self.normalize_model_name(model_id)
-        return len(self.token_model_map.get(normalized_model, []))
+        return len(self.token_model_map.get(normalized_model, ()))
 
     def get_remaining_token_request_capacity(self):
-        remaining_capacity_map = {}
+        """各模型剩余可用次数，直接读取轮转队列维护的计数，与令牌数量无关"""
         all_configs = {**self.model_normal_config, **self.model_heavy_config}
-        
-        for model in all_configs.keys():
-            model_tokens = self.token_model_map.get(model, [])
-            if not model_tokens:
-                remaining_capacity_map[model] = 0
-                continue
-                
-            total_capacity = 0
-            for entry in model_tokens:
-                config_to_use = self.model_heavy_config if entry.get("type") == "heavy" else self.model_normal_config
-                if model in config_to_use:
-                    total_capacity += config_to_use[model]["RequestFrequency"]
-            
-            total_used_requests = sum(entry.get("RequestCount", 0) for entry in model_tokens)
-            remaining_capacity_map[model] = max(0, total_capacity - total_used_requests)
-            
-        return remaining_capacity_map
+        with self._lock:
+            return {
+                model: self.token_model_map[model].remaining() if model in self.token_model_map else 0
+                for model in all_configs
+            }
+
+    def get_remaining_capacity_for_model(self, model_id, token_type=None):
+        """单个模型（可按令牌类型）的剩余可用次数"""
+        normalized_model = self.normalize_model_name(model_id)
+        with self._lock:
+            model_tokens = self.token_model_map.get(normalized_model)
+            return model_tokens.remaining(token_type) if model_tokens else 0
+
+    def get_capacity_summary(self):
+        """按模型与令牌类型汇总的额度、已用次数和可用令牌数"""
+        with self._lock:
+            return {
+                model: {
+                    "tokens": len(ring),
+                    "remaining": ring.remaining(),
+                    "by_type": {
+                        token_type: {
+                            "capacity": ring.capacity[token_type],
+                            "used": ring.used.get(token_type, 0),
+                            "remaining": ring.remaining(token_type)
+                        }
+                        for token_type in ring.capacity
+                    }
+                }
+                for model, ring in self.token_model_map.items()
+            }
 
     def get_token_array_for_model(self, model_id):
         normalized_model = self.normalize_model_name(model_id)
-        return self.token_model_map.get(normalized_model, [])
+        with self._lock:
+            return list(self.token_model_map.get(normalized_model, ()))
+
+    def _readmit_expired(self, token_info, now):
+        """冷却结束的令牌以新条目重新加入轮转，调用方需持有 self._lock"""
+        token, model, expired_time, token_type = token_info
+        expiration_time = self._cooldown_time(model, token_type)
+        if expiration_time is None or now - expired_time < expiration_time:
+            return False
+
+        if model not in self.token_model_map: self.token_model_map[model] = self._new_ring(model)
+        self.token_model_map[model].add(self._new_entry(token, token_type, now))
+
+        sso = token.split("sso=")[1].split(";")[0]
+        if sso in self.token_status_map and model in self.token_status_map[sso]:
+            self.token_status_map[sso][model]["isValid"] = True
+            self.token_status_map[sso][model]["invalidatedTime"] = None
+            self.token_status_map[sso][model]["totalRequestCount"] = 0
+            self._record_status(sso, model)
+
+        self.expired_tokens.discard(token_info)
+        return True
+
+    def _reset_window(self, model, token, now):
+        """计数窗口到期的令牌清零，调用方需持有 self._lock"""
+        ring = self.token_model_map.get(model)
+        entry = ring.get(token) if ring else None
+        expiration_time = self._window_time(model)
+        if entry is None or expiration_time is None or not entry.get("StartCallTime"):
+            return False
+        if now - entry["StartCallTime"] < expiration_time:
+            # 窗口已被重新开始，按新的起点重新调度
+            self._schedule_window(model, entry)
+            return False
+
+        ring.set_count(entry, 0)
+        entry["StartCallTime"] = None
+        sso = entry["token"].split("sso=")[1].split(";")[0]
+        if sso in self.token_status_map and model in self.token_status_map[sso]:
+            self.token_status_map[sso][model]["isValid"] = True
+            self.token_status_map[sso][model]["invalidatedTime"] = None
+            self.token_status_map[sso][model]["totalRequestCount"] = 0
+            self._record_status(sso, model)
+        return True
+
+    def _reset_shared_tokens(self, now):
+        expirations = [
+            (model, token_type, config["ExpirationTime"])
+            for token_type, type_config in (("normal", self.model_normal_config), ("heavy", self.model_heavy_config))
+            for model, config in type_config.items()
+        ]
+        # 各 worker 都会执行，条件更新保证重复执行是幂等的
+        self.store.reset_due(now, expirations)
+        self._refresh_from_store()
+
+    def _on_deadlines(self, keys, now):
+        """调度线程回调：处理本次到期的冷却与计数窗口"""
+        if self.store is not None:
+            # 共享存储模式下由一次条件更新处理全部到期项，同步后重新调度
+            self._reset_shared_tokens(now)
+            return
+        readmitted = 0
+        with self._lock:
+            for key in keys:
+                if key[0] == "cooldown":
+                    readmitted += self._readmit_expired(key[1], now)
+                elif key[0] == "window":
+                    self._reset_window(key[1], key[2], now)
+                else:
+                    # 启动时的全量补齐，已到期的项会在下一轮立即处理
+                    self._schedule_all()
+        if readmitted:
+            logger.info(f"{readmitted} 个令牌冷却结束，已重新加入轮转", "TokenManager")
 
     def start_token_reset_process(self):
-        def reset_expired_tokens():
-            now = int(time.time() * 1000)
-            tokens_to_remove = set()
-            
-            for token_info in self.expired_tokens:
-                token, model, expired_time, token_type = token_info
-                
-                config_to_use = self.model_heavy_config if token_type == "heavy" else self.model_normal_config
-                if model not in config_to_use: continue
-                
-                expiration_time = config_to_use[model]["ExpirationTime"]
-
-                if now - expired_time >= expiration_time:
-                    if model not in self.token_model_map: self.token_model_map[model] = []
-                    if not any(e["token"] == token for e in self.token_model_map[model]):
-                        self.token_model_map[model].append({
-                            "token": token, "RequestCount": 0, "AddedTime": now,
-                            "StartCallTime": None, "type": token_type
-                        })
-
-                    sso = token.split("sso=")[1].split(";")[0]
-                    if sso in self.token_status_map and model in self.token_status_map[sso]:
-                        self.token_status_map[sso][model]["isValid"] = True
-                        self.token_status_map[sso][model]["invalidatedTime"] = None
-                        self.token_status_map[sso][model]["totalRequestCount"] = 0
-                    
-                    tokens_to_remove.add(token_info)
-
-            self.expired_tokens -= tokens_to_remove
-
-            all_configs = {**self.model_normal_config, **self.model_heavy_config}
-            for model, tokens in self.token_model_map.items():
-                if model not in all_configs: continue
-                expiration_time = all_configs[model]["ExpirationTime"]
-                for entry in tokens:
-                    if entry.get("StartCallTime") and now - entry["StartCallTime"] >= expiration_time:
-                        entry["RequestCount"] = 0
-                        entry["StartCallTime"] = None
-                        sso = entry["token"].split("sso=")[1].split(";")[0]
-                        if sso in self.token_status_map and model in self.token_status_map[sso]:
-                           self.token_status_map[sso][model]["isValid"] = True
-                           self.token_status_map[sso][model]["invalidatedTime"] = None
-                           self.token_status_map[sso][model]["totalRequestCount"] = 0
-
-        import threading
-        def run_timer():
-            while True:
-                reset_expired_tokens()
-                time.sleep(3600)
-        timer_thread = threading.Thread(target=run_timer, daemon=True)
-        timer_thread.start()
+        """启动冷却与计数窗口的调度线程，并在调度线程中先做一次全量补齐（共享存储模式下即处理停机期间已到期的项）"""
+        self.scheduler.schedule(("sweep",), self.scheduler.clock())
+        self.scheduler.start()
 
     def get_all_tokens(self):
         all_tokens = set()
-        for model_tokens in self.token_model_map.values():
-            for entry in model_tokens:
-                all_tokens.add(entry["token"])
+        with self._lock:
+            for model_tokens in self.token_model_map.values():
+                for entry in model_tokens:
+                    all_tokens.add(entry["token"])
         return list(all_tokens)
 
     def get_current_token(self, model_id):
         normalized_model = self.normalize_model_name(model_id)
-        if normalized_model not in self.token_model_map or not self.token_model_map[normalized_model]:
-            return None
-        return self.token_model_map[normalized_model][0]["token"]
+        with self._lock:
+            model_tokens = self.token_model_map.get(normalized_model)
+            if not model_tokens:
+                return None
+            return model_tokens.head()["token"]
 
     def get_token_status_map(self):
+        if self.store is not None:
+            # 计数由各 worker 直接写入共享存储，这里读最新值
+            return self.store.status_map()
         return self.token_status_map
 
 
 
+def _apply_fallback_statsig_headers(kwargs):
+    """第二次尝试前强制使用备用策略刷新 kwargs 中的 x_statsig_id"""
+    if 'headers' in kwargs:
+        kwargs['headers'].update(get_default_headers(force_refresh_statsig=True))
+    else:
+        kwargs['headers'] = get_default_headers(force_refresh_statsig=True)
+
+# 上游失败分类，每一类对应一种处理策略
+FAILURE_AUTH = "auth"            # 401/403：令牌失效或被风控，立即换令牌
+FAILURE_QUOTA = "quota"          # 429：令牌额度用尽，立即换令牌
+FAILURE_TRANSIENT = "transient"  # 5xx、超时、连接异常：抖动退避后重试，仍失败则换令牌但不冷却
+FAILURE_PAYLOAD = "payload"      # 其余 4xx：请求本身有问题，换令牌也无济于事，直接失败
+
+# x_statsig_id 在该时间（秒）内刷新过时，403 不再刷新重试：刚换过的 ID 仍被拒，问题在令牌
+STATSIG_REFRESH_MIN_INTERVAL = 60
+
+failure_stats = {
+    "by_class": {FAILURE_AUTH: 0, FAILURE_QUOTA: 0, FAILURE_TRANSIENT: 0, FAILURE_PAYLOAD: 0},
+    "policy": {"statsig_refresh": 0, "backoff_retry": 0, "switch_token": 0, "fail_fast": 0}
+}
+
+class UpstreamStatusError(Exception):
+    """上游返回了非 200 状态码"""
+
+    def __init__(self, status_code):
+        super().__init__(f"上游返回状态码 {status_code}")
+        self.status_code = status_code
+
+class UpstreamRequestRejected(ValueError):
+    """上游因请求本身的问题拒绝（payload 类失败），不再换令牌重试，状态码原样返回给客户端"""
+
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+def classify_upstream_failure(status_code=None, error=None):
+    """按状态码或异常判断失败类别，成功（2xx）时返回 None"""
+    if error is not None:
+        status_code = getattr(error, "status_code", None)
+        if status_code is None:
+            # 超时、连接中断、首行无效等网络层异常
+            return FAILURE_TRANSIENT
+    if status_code is None or 200 <= status_code < 300:
+        return None
+    if status_code in (401, 403):
+        return FAILURE_AUTH
+    if status_code == 429:
+        return FAILURE_QUOTA
+    if status_code >= 500 or status_code in (408, 425):
+        return FAILURE_TRANSIENT
+    return FAILURE_PAYLOAD
+
+def transient_backoff(attempt):
+    """第 attempt 次重试前的等待秒数：以 RETRY_TIME 为基数指数增长，取后一半区间内的随机值"""
+    base = CONFIG["API"]["RETRY_TIME"] / 1000 * (2 ** attempt)
+    return base / 2 + random.uniform(0, base / 2)
+
+def _statsig_refresh_may_help():
+    return time.monotonic() - _statsig_refreshed_at >= STATSIG_REFRESH_MIN_INTERVAL
+
+def _plan_upstream_retry(response, error, attempt, max_retries):
+    """
+    根据本次结果决定同一令牌上的下一步：返回 "statsig"（刷新 x_statsig_id 后重试）、
+    "backoff"（抖动退避后重试）或 None（结束，成功结果或失败交给调用方）。
+    """
+    if error is None:
+        # 没有 status_code 属性，直接返回响应
+        if not hasattr(response, 'status_code'):
+            return None
+        status_code = response.status_code
+        failure = classify_upstream_failure(status_code=status_code)
+        if failure is None:
+            if attempt > 0:
+                logger.info(f"重试成功：Grok API 请求成功 (状态码: {status_code})", "SmartRequest")
+            return None
+        detail = f"状态码: {status_code}"
+    else:
+        status_code = getattr(error, "status_code", None)
+        failure = classify_upstream_failure(error=error)
+        detail = f"请求异常: {error}"
+
+    failure_stats["by_class"][failure] += 1
+    action = None
+    if attempt < max_retries - 1:
+        if failure == FAILURE_TRANSIENT:
+            action = "backoff"
+        elif status_code == 403 and _statsig_refresh_may_help():
+            action = "statsig"
+
+    if action is None:
+        logger.warning(f"Grok API 请求失败 ({detail}，类别 {failure})，不在当前令牌上重试", "SmartRequest")
+    else:
+        failure_stats["policy"]["statsig_refresh" if action == "statsig" else "backoff_retry"] += 1
+        logger.warning(f"Grok API 请求失败 ({detail}，类别 {failure})，{'刷新 x_statsig_id 后' if action == 'statsig' else '退避后'}重试", "SmartRequest")
+    return action
+
 def smart_grok_request_with_fallback(request_func, *args, **kwargs):
     """
-    智能 Grok API 请求函数，支持 x_statsig_id 降级重试机制
+    智能 Grok API 请求函数，按失败类别决定是否在同一令牌上重试一次：
+    403 且 x_statsig_id 近期未刷新时换用备用策略刷新后重试，5xx 与网络异常抖动退避后重试，
+    401/429 与其余 4xx 直接返回，由调用方换令牌或直接失败。
 
     Args:
         request_func: 要执行的请求函数
@@ -677,114 +2158,293 @@ def smart_grok_request_with_fallback(request_func, *args, **kwargs):
     Returns:
         请求结果
     """
-    max_retries = 2  # 最多重试2次（主要策略1次 + 备用策略1次）
+    max_retries = 2  # 同一令牌上最多发起 2 次
 
     for attempt in range(max_retries):
         try:
-            # 第一次尝试使用当前的 x_statsig_id（可能是自主生成的）
-            if attempt == 0:
-                logger.info("使用主要策略发起 Grok API 请求", "SmartRequest")
-                response = request_func(*args, **kwargs)
-            else:
-                # 第二次尝试：强制使用备用策略（PHP 接口）刷新 x_statsig_id
-                logger.warning("主要策略失败，使用备用策略重新发起 Grok API 请求", "SmartRequest")
+            response = request_func(*args, **kwargs)
+            error = None
+        except Exception as e:
+            response, error = None, e
+
+        action = _plan_upstream_retry(response, error, attempt, max_retries)
+        if action is None:
+            if error is not None:
+                raise error
+            return response
+        if action == "statsig":
+            _apply_fallback_statsig_headers(kwargs)
+        else:
+            time.sleep(transient_backoff(attempt))
 
-                # 更新 kwargs 中的 headers，强制刷新 x_statsig_id
-                if 'headers' in kwargs:
-                    kwargs['headers'].update(get_default_headers(force_refresh_statsig=True))
-                else:
-                    kwargs['headers'] = get_default_headers(force_refresh_statsig=True)
+    # 理论上不会到达这里
+    return None
 
-                response = request_func(*args, **kwargs)
+async def smart_grok_request_with_fallback_async(request_func, *args, **kwargs):
+    """
+    smart_grok_request_with_fallback 的异步版本，request_func 需返回 awaitable；
+    刷新 x_statsig_id 需要同步访问备用接口，放到线程池中执行
+    """
+    max_retries = 2
 
-            # 检查响应状态码
-            if hasattr(response, 'status_code'):
-                status_code = response.status_code
+    for attempt in range(max_retries):
+        try:
+            response = await request_func(*args, **kwargs)
+            error = None
+        except Exception as e:
+            response, error = None, e
+
+        action = _plan_upstream_retry(response, error, attempt, max_retries)
+        if action is None:
+            if error is not None:
+                raise error
+            return response
+        if action == "statsig":
+            await run_blocking(_apply_fallback_statsig_headers, kwargs)
+        else:
+            await asyncio.sleep(transient_backoff(attempt))
 
-                # 如果是成功状态码，直接返回
-                if 200 <= status_code < 300:
-                    if attempt > 0:
-                        logger.info(f"备用策略成功：Grok API 请求成功 (状态码: {status_code})", "SmartRequest")
-                    else:
-                        logger.info(f"主要策略成功：Grok API 请求成功 (状态码: {status_code})", "SmartRequest")
-                    return response
+    return None
 
-                # 如果是 4xx 或 5xx 错误，且还有重试机会，继续重试
-                elif (400 <= status_code < 600) and attempt < max_retries - 1:
-                    logger.warning(f"Grok API 请求失败 (状态码: {status_code})，尝试使用备用策略", "SmartRequest")
-                    continue
-                else:
-                    # 最后一次重试也失败了
-                    logger.error(f"所有策略都失败：Grok API 请求失败 (状态码: {status_code})", "SmartRequest")
-                    return response
-            else:
-                # 没有 status_code 属性，直接返回响应
-                return response
+async def run_blocking(func, *args, **kwargs):
+    """在默认线程池中执行阻塞调用（上传、图片下载等），避免卡住事件循环"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
 
-        except Exception as e:
-            if attempt < max_retries - 1:
-                logger.warning(f"Grok API 请求异常: {e}，尝试使用备用策略", "SmartRequest")
-                continue
-            else:
-                logger.error(f"所有策略都失败：Grok API 请求异常: {e}", "SmartRequest")
-                raise
+async def run_blocking_shielded(func, *args, **kwargs):
+    """
+    同 run_blocking，但调用方被取消时仍等线程中的调用结束再抛出 CancelledError，
+    调用方清理时能看到它的副作用（如已选定并计数的令牌）。
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait({future})
+        raise
 
-    # 理论上不会到达这里
-    return None
+_stream_loop = None
+_stream_loop_lock = threading.Lock()
 
-class Utils:
-    # 1. 使用 threading.local() 来创建线程安全的存储
-    _local = threading.local()
+def get_stream_loop():
+    """
+    Flask 链路共用的后台事件循环（单线程）。所有流式请求的上游读取和心跳计时都复用它，
+    不再为每个流单独起读线程。
+    """
+    global _stream_loop
+    with _stream_loop_lock:
+        if _stream_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="stream-loop", daemon=True).start()
+            _stream_loop = loop
+        return _stream_loop
+
+def run_on_stream_loop(coro, timeout=None):
+    """在共享事件循环上执行协程并阻塞等待结果（供 Flask 请求线程调用）"""
+    return asyncio.run_coroutine_threadsafe(coro, get_stream_loop()).result(timeout)
+
+class LoopStreamBridge:
+    """
+    让同步代码逐块消费运行在共享事件循环上的异步生成器。
+    next_chunk 超时只表示这段时间没有新数据，挂起中的读取会保留到下一次调用；
+    close 会取消挂起的读取并在事件循环上关闭生成器。
+    """
+    END = object()
 
-    @staticmethod
-    def reset_citation_counter():
-        """为当前线程初始化或重置计数器"""
-        Utils._local.citation_counter = 1
+    def __init__(self, source_stream):
+        self.source_stream = source_stream
+        self.loop = get_stream_loop()
+        self._future = None
+        self._task = None
 
-    @staticmethod
-    def get_citation_counter():
-        """获取当前线程的计数器值"""
-        # 如果当前线程还没有计数器，就初始化一个
-        if not hasattr(Utils._local, 'citation_counter'):
-            Utils._local.citation_counter = 1
-        return Utils._local.citation_counter
+    async def _step(self):
+        self._task = asyncio.current_task()
+        try:
+            return await self.source_stream.__anext__()
+        except StopAsyncIteration:
+            return self.END
+
+    def next_chunk(self, timeout):
+        """返回下一块数据或 END；timeout 秒内没有新数据时返回 None"""
+        if self._future is None:
+            self._future = asyncio.run_coroutine_threadsafe(self._step(), self.loop)
+        done, _ = concurrent.futures.wait([self._future], timeout)
+        if not done:
+            return None
+        future, self._future = self._future, None
+        return future.result()
+
+    async def _aclose(self):
+        task = self._task
+        if task is not None and not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        await self.source_stream.aclose()
+
+    def close(self, timeout=10):
+        if self._future is not None:
+            self._future.cancel()
+            self._future = None
+        try:
+            run_on_stream_loop(self._aclose(), timeout)
+        except Exception as e:
+            logger.warning(f"关闭上游流失败: {e}", "HeartbeatWrapper")
 
-    @staticmethod
-    def increment_citation_counter():
-        """为当前线程的计数器加一"""
-        if not hasattr(Utils._local, 'citation_counter'):
-            Utils._local.citation_counter = 1
-        Utils._local.citation_counter += 1
+class GrokTagFilter:
+    """
+    流式 Grok 标签过滤器，每个流创建一个。
+    纯文本直接透传，只有遇到 '<' 才检查是否为 <xai:tool_usage_card> / <grok:render 的开头；
+    被 token 边界切开的半截标签暂存到下一次 feed，信源编号在流内独立计数。
+    未闭合的 render 标签最多暂存 MAX_RENDER_LENGTH 个字符，超过或流结束时按普通文本输出。
+    """
+    CARD_OPEN = '<xai:tool_usage_card>'
+    CARD_CLOSE = '</xai:tool_usage_card>'
+    RENDER_OPEN = '<grok:render'
+    RENDER_CLOSE = '</grok:render>'
+    CARD_ID_PATTERN = re.compile(r'card_id="([^"]+)"')
+    MAX_RENDER_LENGTH = 4096
+
+    MODE_TEXT = 0
+    MODE_CARD = 1
+    MODE_RENDER = 2
+
+    def __init__(self, citations=None):
+        self.citations = citations if citations is not None else {}
+        self.citation_counter = 1
+        self._mode = self.MODE_TEXT
+        # 尚不能确定的内容：半截开标签 / 工具卡片内可能的半截闭标签 / 未闭合的 render 标签
+        self._pending = ''
+        # 末尾空白先扣住，紧跟工具卡片时需要和卡片一起去掉
+        self._held_ws = ''
+        # 工具卡片结束后，紧随其后的空白一并去掉
+        self._skip_ws = False
+
+    def feed(self, text):
+        if not text:
+            return ''
+        if (self._mode == self.MODE_TEXT and not self._pending and not self._held_ws
+                and not self._skip_ws and '<' not in text and not text[-1].isspace()):
+            return text
+
+        data = self._pending + text if self._pending else text
+        self._pending = ''
+        out = [self._held_ws] if self._held_ws else []
+        self._held_ws = ''
+        pos = 0
+        length = len(data)
+        # out[:keep] 以 render 标签的替换文本结尾，卡片前去空白时不能去掉它
+        keep = 0
+
+        while pos < length:
+            if self._mode == self.MODE_TEXT:
+                lt = data.find('<', pos)
+                if lt < 0:
+                    self._append_text(out, data[pos:])
+                    break
+                if lt > pos:
+                    self._append_text(out, data[pos:lt])
+
+                if data.startswith(self.CARD_OPEN, lt):
+                    # 等价于原来的 \s*<xai:tool_usage_card>：卡片前的空白一并去掉
+                    # 原来先删卡片再替换 render 标签，紧挨卡片的 render 替换文本保留
+                    before = ''.join(out[keep:]).rstrip()
+                    out = out[:keep] + ([before] if before else [])
+                    self._mode = self.MODE_CARD
+                    pos = lt + len(self.CARD_OPEN)
+                elif data.startswith(self.RENDER_OPEN, lt):
+                    self._mode = self.MODE_RENDER
+                    pos = lt
+                else:
+                    tail = data[lt:]
+                    if self.CARD_OPEN.startswith(tail) or self.RENDER_OPEN.startswith(tail):
+                        self._pending = tail
+                        break
+                    self._append_text(out, '<')
+                    pos = lt + 1
+
+            elif self._mode == self.MODE_CARD:
+                end = data.find(self.CARD_CLOSE, pos)
+                if end < 0:
+                    self._pending = data[max(pos, length - len(self.CARD_CLOSE) + 1):]
+                    break
+                self._mode = self.MODE_TEXT
+                self._skip_ws = True
+                pos = end + len(self.CARD_CLOSE)
+
+            else:
+                end = data.find(self.RENDER_CLOSE, pos)
+                if end < 0:
+                    if length - pos <= self.MAX_RENDER_LENGTH:
+                        self._pending = data[pos:]
+                        break
+                    # 太长仍未闭合，不是真正的 render 标签，'<' 按普通文本输出后继续扫描
+                    self._mode = self.MODE_TEXT
+                    self._append_text(out, '<')
+                    pos += 1
+                    continue
+                out.append(self._render_replacement(data[pos:end]))
+                keep = len(out)
+                self._skip_ws = False
+                self._mode = self.MODE_TEXT
+                pos = end + len(self.RENDER_CLOSE)
+
+        kept = ''.join(out[:keep])
+        rest = ''.join(out[keep:])
+        if rest and rest[-1].isspace():
+            stripped = rest.rstrip()
+            self._held_ws = rest[len(stripped):]
+            rest = stripped
+        return kept + rest
+
+    def flush(self):
+        """流结束或切换输出块时调用，吐出暂存的空白与无法构成标签的残留文本"""
+        if self._mode == self.MODE_RENDER:
+            # 没有闭合的 render 标签按普通文本输出，其中的其他标签照常过滤
+            pending = self._pending
+            self._pending = ''
+            self._mode = self.MODE_TEXT
+            out = [self._held_ws] if self._held_ws else []
+            self._held_ws = ''
+            self._append_text(out, '<')
+            return ''.join(out) + self.feed(pending[1:]) + self.flush()
+        result = self._held_ws
+        if self._mode == self.MODE_TEXT:
+            result += self._pending
+        self._held_ws = ''
+        self._pending = ''
+        self._skip_ws = False
+        self._mode = self.MODE_TEXT
+        return result
 
+    def _append_text(self, out, text):
+        if self._skip_ws:
+            text = text.lstrip()
+            if not text:
+                return
+            self._skip_ws = False
+        out.append(text)
+
+    def _render_replacement(self, segment):
+        if not self.citations:
+            # 如果没有信源字典，就按老方法直接移除标签
+            return ' '
+        match = self.CARD_ID_PATTERN.search(segment)
+        if match and match.group(1) in self.citations:
+            replacement = f" [信源 {self.citation_counter}]({self.citations[match.group(1)]})"
+            self.citation_counter += 1
+            return replacement
+        return " [信源信息缺失]"
+
+class Utils:
     @staticmethod
     def safe_filter_grok_tags(text, citations=None):
+        """一次性过滤完整文本（非流式响应使用），流式输出请为每个流创建 GrokTagFilter"""
         if not text or not isinstance(text, str):
             return text
 
-        # 移除工具卡片
-        text = re.sub(r'\s*<xai:tool_usage_card>.*?</xai:tool_usage_card>\s*', '', text, flags=re.DOTALL)
-
-        if citations:
-            # 2. 定义一个内嵌函数来处理替换，它会使用上面线程安全的计数器方法
-            def replace_render_tag(match):
-                card_id = match.group(1)
-                if card_id in citations:
-                    url = citations[card_id]
-                    # 从线程局部存储中获取当前计数
-                    counter = Utils.get_citation_counter()
-                    replacement = f" [信源 {counter}]({url})"
-                    # 增加当前线程的计数
-                    Utils.increment_citation_counter()
-                    return replacement
-                else:
-                    return " [信源信息缺失]"
-            
-            text = re.sub(r'<grok:render.*?card_id="([^"]+)".*?>.*?</grok:render>', replace_render_tag, text, flags=re.DOTALL)
-        else:
-            # 如果没有提供信源字典，就按老方法直接移除标签
-            text = re.sub(r'<grok:render.*?>.*?</grok:render>', ' ', text, flags=re.DOTALL)
-
-        return text
+        tag_filter = GrokTagFilter(citations)
+        return tag_filter.feed(text) + tag_filter.flush()
 
     @staticmethod
     def organize_search_results(search_results):
@@ -814,7 +2474,7 @@ class Utils:
         proxy_options = {}
 
         if proxy:
-            logger.info(f"使用代理: {proxy}", "Server")
+            logger.debug(f"使用代理: {proxy}", "Server")
             
             if proxy.startswith("socks5://"):
                 proxy_options["proxy"] = proxy
@@ -828,6 +2488,306 @@ class Utils:
                 proxy_options["proxies"] = {"https": proxy, "http": proxy}     
         return proxy_options
 
+class RequestContext:
+    """
+    单次对话请求的上下文：选中的 SSO、拼好的 Cookie、代理参数与计时。
+    沿上传、上游请求、流式处理和图片下载一路传递，请求之间不共享任何可变状态。
+    """
+
+    def __init__(self, model, proxy_options=None):
+        self.model = model
+        self.proxy_options = Utils.get_proxy_options() if proxy_options is None else proxy_options
+        self.sso_cookie = None
+        self.cookie = None
+        self.attempt = 0
+        self.started_at = time.monotonic()
+        self.attempt_started_at = None
+        self.response_at = None
+        # 准入排队的优先级（数值小的先）与截止时间（monotonic 秒）
+        self.priority = 0
+        self.deadline = None
+        # 是否占用着模型并发名额、当前令牌是否计入了进行中请求数
+        self.admitted = False
+        self.holds_token = False
+
+    @staticmethod
+    def build_cookie(sso_cookie):
+        cf_clearance = CONFIG["SERVER"]["CF_CLEARANCE"]
+        return f"{sso_cookie};{cf_clearance}" if cf_clearance else sso_cookie
+
+    @property
+    def sso(self):
+        """日志里展示的 sso=xxx 片段"""
+        return self.sso_cookie.split(';')[1] if self.sso_cookie else None
+
+    def fork(self):
+        """对冲请求的另一路：共用模型、代理和请求起始时间，令牌与单次计时各自独立"""
+        leg = RequestContext(self.model, self.proxy_options)
+        leg.started_at = self.started_at
+        leg.priority = self.priority
+        leg.deadline = self.deadline
+        return leg
+
+    def use_token(self, sso_cookie, attempt=0):
+        self.sso_cookie = sso_cookie
+        self.cookie = self.build_cookie(sso_cookie)
+        self.attempt = attempt
+        self.attempt_started_at = time.monotonic()
+        self.response_at = None
+
+    def upload_cookie(self):
+        """上传附件使用的 (SSO, Cookie)：已选定令牌时用它，否则沿用当前队首令牌（不计数）"""
+        sso_cookie = self.sso_cookie or Utils.create_auth_headers(self.model, True)
+        return sso_cookie, self.build_cookie(sso_cookie)
+
+    def mark_response(self):
+        self.response_at = time.monotonic()
+
+    def release_token(self):
+        """本次尝试结束：当前令牌的进行中请求数减一（只减一次），并唤醒等待令牌的请求"""
+        if self.holds_token:
+            self.holds_token = False
+            token_manager.release_in_flight(self.sso_cookie)
+            admission.notify()
+
+    def finish(self):
+        """整个请求结束：释放令牌与模型并发名额，可重复调用"""
+        self.release_token()
+        if self.admitted:
+            self.admitted = False
+            admission.release(token_manager.normalize_model_name(self.model))
+
+    def elapsed_ms(self, since=None):
+        return int((time.monotonic() - (since or self.started_at)) * 1000)
+
+class _PooledSession:
+    __slots__ = ("key", "session", "loop", "last_used", "active", "retired")
+
+    def __init__(self, key, session, loop):
+        self.key = key
+        self.session = session
+        self.loop = loop
+        self.last_used = time.monotonic()
+        self.active = 0
+        self.retired = False
+
+class HttpSessionPool:
+    """
+    出站连接池：按 (事件循环, 代理, 浏览器指纹) 复用 curl_cffi AsyncSession，
+    使 grok.com / assets.grok.com 的 TCP+TLS 连接在请求之间保持 keep-alive，
+    指纹协商到 HTTP/2 时同一连接上多路复用。
+
+    同步调用方（Flask 请求线程、上传、图片下载）统一在共享事件循环上发起请求，
+    所有线程共用同一份连接缓存。会话按租约计数，淘汰时若仍有进行中的请求，
+    则等最后一个租约归还后再关闭。
+    """
+
+    def __init__(self, max_sessions=8, idle_timeout=300, max_clients=1024):
+        self.max_sessions = max(1, max_sessions)
+        self.idle_timeout = idle_timeout
+        self.max_clients = max(1, max_clients)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._by_session = {}
+        self._http_session = None
+        self.stats = {
+            "sessions_created": 0,
+            "sessions_evicted": 0,
+            "requests": 0,
+            "connections_new": 0,
+            "connections_reused": 0
+        }
+
+    @staticmethod
+    def _proxy_key(proxy_options):
+        return tuple(sorted((name, repr(value)) for name, value in (proxy_options or {}).items()))
+
+    def _close(self, entry):
+        self._by_session.pop(id(entry.session), None)
+        try:
+            entry.loop.call_soon_threadsafe(lambda: entry.loop.create_task(entry.session.close()))
+        except RuntimeError:
+            # 事件循环已关闭，会话随之失效
+            pass
+
+    def _retire(self, entry):
+        self._entries.pop(entry.key, None)
+        entry.retired = True
+        self.stats["sessions_evicted"] += 1
+        if entry.active == 0:
+            self._close(entry)
+
+    def _evict(self, now):
+        """调用方需持有锁：先回收空闲超时的会话，再按 LRU 控制总数"""
+        for entry in list(self._entries.values()):
+            if entry.active == 0 and now - entry.last_used > self.idle_timeout:
+                self._retire(entry)
+        while len(self._entries) > self.max_sessions:
+            self._retire(next(iter(self._entries.values())))
+
+    def acquire_async(self, proxy_options=None, impersonate="chrome133a"):
+        """在当前事件循环上租用会话，用完必须调用 release_async 归还"""
+        loop = asyncio.get_running_loop()
+        key = (id(loop), impersonate, self._proxy_key(proxy_options))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                session = curl_requests.AsyncSession(
+                    loop=loop,
+                    max_clients=self.max_clients,
+                    impersonate=impersonate,
+                    curl_infos=[CurlInfo.NUM_CONNECTS],
+                    **(proxy_options or {})
+                )
+                entry = _PooledSession(key, session, loop)
+                self._entries[key] = entry
+                self._by_session[id(session)] = entry
+                self.stats["sessions_created"] += 1
+            else:
+                self._entries.move_to_end(key)
+            entry.last_used = now
+            entry.active += 1
+            self._evict(now)
+            return entry.session
+
+    def release_async(self, session):
+        with self._lock:
+            entry = self._by_session.get(id(session))
+            if entry is None or entry.session is not session:
+                return
+            entry.active = max(0, entry.active - 1)
+            entry.last_used = time.monotonic()
+            if entry.retired and entry.active == 0:
+                self._close(entry)
+
+    def record(self, response):
+        """按 curl 的 NUM_CONNECTS 统计这次请求是否复用了已有连接"""
+        if response is None:
+            return
+        new_connections = getattr(response, "infos", {}).get(CurlInfo.NUM_CONNECTS)
+        with self._lock:
+            self.stats["requests"] += 1
+            if new_connections == 0:
+                self.stats["connections_reused"] += 1
+            elif new_connections:
+                self.stats["connections_new"] += 1
+
+    async def arequest(self, method, url, proxy_options=None, impersonate="chrome133a", **kwargs):
+        """非流式请求：响应体读完后立即归还会话"""
+        session = self.acquire_async(proxy_options, impersonate)
+        try:
+            response = await session.request(method, url, **kwargs)
+        finally:
+            self.release_async(session)
+        self.record(response)
+        return response
+
+    def request(self, method, url, proxy_options=None, impersonate="chrome133a", **kwargs):
+        """
+        供同步代码使用的非流式请求，参数与 curl_requests.request 一致。
+        不能在共享事件循环线程内调用（异步代码请用 arequest）。
+        """
+        return run_on_stream_loop(self.arequest(method, url, proxy_options, impersonate, **kwargs))
+
+    def http_session(self):
+        """图床上传等非 grok 域名使用的 requests 会话，同样保持连接复用"""
+        with self._lock:
+            if self._http_session is None:
+                self._http_session = requests.Session()
+            return self._http_session
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["sessions_open"] = len(self._entries)
+            stats["sessions_leased"] = sum(entry.active for entry in self._entries.values())
+        reuse_total = stats["connections_new"] + stats["connections_reused"]
+        stats["connection_reuse_rate"] = round(stats["connections_reused"] / reuse_total, 4) if reuse_total else 0.0
+        return stats
+
+http_pool = HttpSessionPool(CONFIG["API"]["POOL_MAX_SESSIONS"], CONFIG["API"]["POOL_IDLE_TIMEOUT"], CONFIG["API"]["POOL_MAX_CLIENTS"])
+class UploadCache:
+    """
+    上传结果缓存：以 (SSO, 内容 SHA-256) 为键缓存 fileMetadataId，带有效期和 LRU 淘汰。
+    客户端每轮都会重发完整对话，同一张图片或同一段超长上下文命中后直接复用 ID，
+    不再做 base64 编码和上传请求。文件只对上传它的 SSO 可见，所以按 SSO 隔离。
+    """
+
+    def __init__(self, max_entries=512, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0}
+
+    @staticmethod
+    def key(sso_cookie, content):
+        return sso_cookie, hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        if self.max_entries <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] > self.ttl:
+                del self._entries[key]
+                self.stats["expired"] += 1
+                entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[0]
+
+    def put(self, key, file_id):
+        if self.max_entries <= 0 or not file_id:
+            return
+        with self._lock:
+            self._entries[key] = (file_id, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evicted"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+upload_cache = UploadCache(CONFIG["API"]["UPLOAD_CACHE_SIZE"], CONFIG["API"]["UPLOAD_CACHE_TTL"])
+upload_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=max(1, CONFIG["API"]["UPLOAD_POOL_SIZE"]),
+    thread_name_prefix="upload"
+)
+
+class UploadBatch:
+    """
+    一次请求内的附件上传，在共享的上传线程池中执行。同一请求同时进行的上传不超过 limit 个，
+    超出时在提交处等待本请求的上传完成，不占用线程池的线程，附件多的请求不会挡住其他请求的上传。
+    """
+
+    def __init__(self, executor, limit):
+        self.executor = executor
+        self._slots = threading.BoundedSemaphore(max(1, limit))
+
+    def _release(self, future):
+        self._slots.release()
+
+    def submit(self, func, *args):
+        self._slots.acquire()
+        try:
+            future = self.executor.submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._release)
+        return future
+
 class GrokApiClient:
     def __init__(self, model_id):
         if model_id not in CONFIG["MODELS"]:
@@ -855,8 +2815,15 @@ class GrokApiClient:
             "fileName": file_name
         }
         
-    def upload_base64_file(self, message, model):
+    def upload_base64_file(self, message, model, ctx):
         try:
+            sso_cookie, cookie = ctx.upload_cookie()
+            cache_key = upload_cache.key(sso_cookie, message)
+            file_id = upload_cache.get(cache_key)
+            if file_id:
+                logger.info(f"文字文件命中上传缓存: {file_id}", "Server")
+                return file_id
+
             message_base64 = base64.b64encode(message.encode('utf-8')).decode('utf-8')
             upload_data = {
                 "fileName": "message.txt",
@@ -865,14 +2832,14 @@ class GrokApiClient:
             }
 
             logger.info("发送文字文件请求", "Server")
-            cookie = f"{Utils.create_auth_headers(model, True)};{CONFIG['SERVER']['CF_CLEARANCE']}"
-            proxy_options = Utils.get_proxy_options()
+            proxy_options = ctx.proxy_options
 
             def make_upload_request(**request_kwargs):
-                return curl_requests.post(
+                return http_pool.request(
+                    "POST",
                     "https://grok.com/rest/app-chat/upload-file",
+                    proxy_options=proxy_options,
                     json=upload_data,
-                    impersonate="chrome133a",
                     **request_kwargs
                 )
 
@@ -891,14 +2858,23 @@ class GrokApiClient:
 
             result = response.json()
             logger.info(f"上传文件成功: {result}", "Server")
-            return result.get("fileMetadataId", "")
+            file_id = result.get("fileMetadataId", "")
+            upload_cache.put(cache_key, file_id)
+            return file_id
 
         except Exception as error:
             logger.error(str(error), "Server")
             raise Exception(f"上传文件失败,状态码:{response.status_code}")
 
-    def upload_base64_image(self, base64_data, url, model):
+    def upload_base64_image(self, base64_data, url, model, ctx):
         try:
+            sso_cookie, cookie = ctx.upload_cookie()
+            cache_key = upload_cache.key(sso_cookie, base64_data)
+            file_id = upload_cache.get(cache_key)
+            if file_id:
+                logger.info(f"图片命中上传缓存: {file_id}", "Server")
+                return file_id
+
             if 'data:image' in base64_data:
                 image_buffer = base64_data.split(',')[1]
             else:
@@ -916,14 +2892,14 @@ class GrokApiClient:
 
             logger.info("发送图片文件请求", "Server")
 
-            proxy_options = Utils.get_proxy_options()
-            cookie = f"{Utils.create_auth_headers(model, True)};{CONFIG['SERVER']['CF_CLEARANCE']}"
+            proxy_options = ctx.proxy_options
 
             def make_image_upload_request(**request_kwargs):
-                return curl_requests.post(
+                return http_pool.request(
+                    "POST",
                     url,
+                    proxy_options=proxy_options,
                     json=upload_data,
-                    impersonate="chrome133a",
                     **request_kwargs
                 )
 
@@ -942,18 +2918,26 @@ class GrokApiClient:
 
             result = response.json()
             logger.info(f"上传图片成功: {result}", "Server")
-            return result.get("fileMetadataId", "")
+            file_id = result.get("fileMetadataId", "")
+            upload_cache.put(cache_key, file_id)
+            return file_id
 
         except Exception as error:
             logger.error(f"上传图片时发生异常: {str(error)}", "Server")
             return ''
 
-    def prepare_chat_request(self, request):
+    @staticmethod
+    def collect_uploads(futures):
+        """按提交顺序取回上传结果，丢弃上传失败（空 ID）的附件"""
+        return [file_id for file_id in (future.result() for future in futures) if file_id]
+
+    def prepare_chat_request(self, request, ctx=None):
         if ((request["model"] == 'grok-4-imageGen' or request["model"] == 'grok-3-imageGen') and
             not CONFIG["API"]["PICGO_KEY"] and not CONFIG["API"]["TUMY_KEY"] and
             request.get("stream", False)):
             raise ValueError("该模型流式输出需要配置PICGO或者TUMY图床密钥!")
 
+        ctx = ctx or RequestContext(request["model"])
         todo_messages = request["messages"]
         if request["model"] in ['grok-4-imageGen', 'grok-3-imageGen', 'grok-3-deepsearch']:
             last_message = todo_messages[-1]
@@ -961,9 +2945,14 @@ class GrokApiClient:
                 raise ValueError('此模型最后一条消息必须是用户消息!')
             todo_messages = [last_message]
         file_attachments = []
-        messages = ''
+        # 最后一条消息里的图片在后台并发上传，结果按附件顺序收集
+        image_uploads = []
+        uploads = UploadBatch(upload_executor, CONFIG["API"]["UPLOAD_CONCURRENCY"])
+        upload_url = f"{CONFIG['API']['BASE_URL']}/rest/app-chat/upload-file"
+        # 消息按块累积：每块为 [角色前缀, 内容片段]，同角色连续消息只追加片段；
+        # message_length 始终等于最终拼接出的文本长度，不再反复重建整个字符串
+        blocks = []
         last_role = None
-        last_content = ''
         message_length = 0
         convert_to_file = False
         last_message_content = ''
@@ -996,48 +2985,50 @@ class GrokApiClient:
                     return remove_think_tags(content["text"])
             return remove_think_tags(self.process_message_content(content))
             
-        for current in todo_messages:
+        last_index = len(todo_messages) - 1
+        for index, current in enumerate(todo_messages):
             role = 'assistant' if current["role"] == 'assistant' else 'user'
-            is_last_message = current == todo_messages[-1]
+            is_last_message = index == last_index
 
             if is_last_message and "content" in current:
                 if isinstance(current["content"], list):
                     for item in current["content"]:
                         if item["type"] == 'image_url':
-                            processed_image = self.upload_base64_image(
-                                item["image_url"]["url"],
-                                f"{CONFIG['API']['BASE_URL']}/rest/app-chat/upload-file",
-                                request["model"]
-                            )
-                            if processed_image:
-                                file_attachments.append(processed_image)
+                            image_uploads.append(uploads.submit(
+                                self.upload_base64_image, item["image_url"]["url"], upload_url, request["model"], ctx
+                            ))
                 elif isinstance(current["content"], dict) and current["content"].get("type") == 'image_url':
-                    processed_image = self.upload_base64_image(
-                        current["content"]["image_url"]["url"],
-                        f"{CONFIG['API']['BASE_URL']}/rest/app-chat/upload-file",
-                        request["model"]
-                    )
-                    if processed_image:
-                        file_attachments.append(processed_image)
+                    image_uploads.append(uploads.submit(
+                        self.upload_base64_image, current["content"]["image_url"]["url"], upload_url, request["model"], ctx
+                    ))
 
             text_content = process_content(current.get("content", ""))
             if is_last_message and convert_to_file:
                 last_message_content = f"{role.upper()}: {text_content or '[图片]'}\n"
                 continue
+            if is_last_message and not text_content and image_uploads:
+                # 纯图片消息是否写入 [图片] 占位取决于是否有图片上传成功，只能在这里等待
+                file_attachments = self.collect_uploads(image_uploads)
             if text_content or (is_last_message and file_attachments):
                 if role == last_role and text_content:
-                    last_content += '\n' + text_content
-                    messages = messages[:messages.rindex(f"{role.upper()}: ")] + f"{role.upper()}: {last_content}\n"
+                    blocks[-1][1].append(text_content)
+                    message_length += 1 + len(text_content)
                 else:
-                    messages += f"{role.upper()}: {text_content or '[图片]'}\n"
-                    last_content = text_content
+                    prefix = f"{role.upper()}: "
+                    display = text_content or '[图片]'
+                    blocks.append([prefix, [display]])
+                    message_length += len(prefix) + len(display) + 1
                     last_role = role
-            message_length += len(messages)
             if message_length >= 40000:
                 convert_to_file = True
-               
+
+        messages = ''.join(prefix + '\n'.join(parts) + '\n' for prefix, parts in blocks)
+        if convert_to_file:
+            # 超长上下文转成文本文件，与仍在进行的图片上传并行
+            file_upload = uploads.submit(self.upload_base64_file, messages, request["model"], ctx)
+        file_attachments = self.collect_uploads(image_uploads)
         if convert_to_file:
-            file_id = self.upload_base64_file(messages, request["model"])
+            file_id = file_upload.result()
             if file_id:
                 file_attachments.insert(0, file_id)
             messages = last_message_content.strip()
@@ -1125,97 +3116,133 @@ class MessageProcessor:
             "usage": None
         }
 
-def process_model_response(response, model):
-    result = {"token": None, "type": None} 
-    AGENT_MODELS = ['grok-4-heavy', 'grok-4', 'grok-3-deepersearch', 'grok-3-deepsearch', 'grok-4-mini-thinking-tahoe']
-
-    if response.get("cachedImageGenerationResponse"):
-        return result 
-
-    message_tag = response.get("messageTag")
-    token = response.get("token")
-    
-    if message_tag == 'heartbeat':
-        result["type"] = 'heartbeat'
-        return result
-
-    if model not in AGENT_MODELS and response.get("modelResponse"):
-        return result
+AGENT_MODELS = ['grok-4-heavy', 'grok-4', 'grok-3-deepersearch', 'grok-3-deepsearch', 'grok-4-mini-thinking-tahoe']
+THINKING_TAGS = {'header', 'summary', 'raw_function_result', 'citedWebSearchResults', 'tool_usage_card'}
 
-    if response.get("modelResponse") and isinstance(response["modelResponse"], dict):
-        final_message = response["modelResponse"].get("message")
-        if final_message:
-            result["token"] = final_message
-            result["type"] = 'content'
-        return result
+# 上游事件类型，由 GrokStreamDecoder 单次分发产生，流式与非流式处理共用
+EVENT_CARD = 'card'
+EVENT_IMAGE_GEN = 'imageGen'
+EVENT_IMAGE = 'image'
+EVENT_HEARTBEAT = 'heartbeat'
+EVENT_MODEL_RESPONSE = 'modelResponse'
+EVENT_THINKING = 'thinking'
+EVENT_TOKEN = 'token'
+# 带有非 final 的 messageTag 的 token：Agent 模型当正文输出，标准模型视为过程信息丢弃
+EVENT_TAGGED_TOKEN = 'taggedToken'
 
-    is_thinking_content = False
-    if model in AGENT_MODELS:
-        THINKING_TAGS = {'header', 'summary', 'raw_function_result', 'citedWebSearchResults', 'tool_usage_card'}
-        if message_tag in THINKING_TAGS or response.get("isThinking") or response.get("messageStepId"):
-            is_thinking_content = True
-    
-    if is_thinking_content:
-        if not CONFIG["SHOW_THINKING"]:
-            return result
-        else:
-            content_to_send = token
-            if response.get('webSearchResults') and CONFIG["ISSHOW_SEARCH_RESULTS"]:
-                content_to_send = Utils.organize_search_results(response['webSearchResults'])
-            
-            if content_to_send:
-                result["token"] = content_to_send
-                result["type"] = 'thinking'
-            return result
-    
-    if token:
-        result["token"] = token
-        result["type"] = 'content'
-        return result
+GrokEvent = namedtuple('GrokEvent', ['kind', 'value', 'response'])
 
-    return result
-def handle_image_response(image_url):
-    max_retries = 2
-    retry_count = 0
-    image_base64_response = None
+class GrokStreamDecoder:
+    """
+    conversations/new 的 NDJSON 增量解码器。
+    直接消费原始字节块（可以在任意位置断开），每行只做一次 JSON 解析，
+    按字段单次分发为 GrokEvent；信源卡片在这里解析一次并记录到 citations。
+    """
 
-    while retry_count < max_retries:
+    def __init__(self):
+        self.citations = {}
+        self._buffer = b""
+
+    def feed(self, data):
+        """输入一块原始字节，返回其中完整行对应的事件列表"""
+        if not data:
+            return []
+        if self._buffer:
+            data = self._buffer + data
+        lines = data.split(b"\n")
+        self._buffer = lines.pop()
+        events = []
+        for line in lines:
+            events.extend(self.decode_line(line))
+        return events
+
+    def feed_eof(self):
+        """上游结束，处理缓冲区中没有换行结尾的最后一行"""
+        line, self._buffer = self._buffer, b""
+        return self.decode_line(line)
+
+    def decode_line(self, line):
+        if not line or line.isspace():
+            return []
         try:
-            proxy_options = Utils.get_proxy_options()
-
-            # 使用智能重试机制发起图片下载请求
-            def make_image_download_request(**request_kwargs):
-                return curl_requests.get(
-                    f"https://assets.grok.com/{image_url}",
-                    impersonate="chrome133a",
-                    **request_kwargs
-                )
-
-            image_base64_response = smart_grok_request_with_fallback(
-                make_image_download_request,
-                headers={
-                    **get_default_headers(),
-                    "Cookie": CONFIG["SERVER"]['COOKIE']
-                },
-                **proxy_options
-            )
-
-            if image_base64_response.status_code == 200:
-                break
+            line_json = json_loads(line)
+            if line_json.get("error"): return []
+            response = (line_json.get("result") or {}).get("response")
+            if not response: return []
+            return self._dispatch(response)
+        except Exception as e:
+            logger.error(f"解析上游数据行时出错: {str(e)}", "Server")
+            return []
 
-            retry_count += 1
-            if retry_count == max_retries:
-                raise Exception(f"上游服务请求失败! status: {image_base64_response.status_code}")
+    def _dispatch(self, response):
+        events = []
 
-            time.sleep(CONFIG["API"]["RETRY_TIME"] / 1000 * retry_count)
+        card = response.get("cardAttachment")
+        if card and card.get("jsonData"):
+            try:
+                card_data = json_loads(card["jsonData"])
+                if card_data.get("id") and card_data.get("url"):
+                    self.citations[card_data["id"]] = card_data["url"]
+                    events.append(GrokEvent(EVENT_CARD, card_data, response))
+            except Exception: pass
+
+        if response.get("doImgGen") or response.get("imageAttachmentInfo"):
+            events.append(GrokEvent(EVENT_IMAGE_GEN, True, response))
+
+        cached_image = response.get("cachedImageGenerationResponse")
+        if cached_image is not None:
+            events.append(GrokEvent(EVENT_IMAGE, cached_image.get("imageUrl"), response))
+            return events
+
+        message_tag = response.get("messageTag")
+        if message_tag == 'heartbeat':
+            events.append(GrokEvent(EVENT_HEARTBEAT, None, response))
+            return events
+
+        model_response = response.get("modelResponse")
+        if model_response:
+            if isinstance(model_response, dict):
+                events.append(GrokEvent(EVENT_MODEL_RESPONSE, model_response.get("message", ""), response))
+            return events
+
+        token = response.get("token")
+        if response.get("isThinking") or response.get("messageStepId") or message_tag in THINKING_TAGS:
+            events.append(GrokEvent(EVENT_THINKING, token, response))
+        elif token is not None:
+            kind = EVENT_TOKEN if message_tag in (None, "final") else EVENT_TAGGED_TOKEN
+            events.append(GrokEvent(kind, token, response))
+        return events
+
+def thinking_content(event):
+    """思考类事件实际要展示的内容：可选替换为整理后的搜索结果"""
+    if event.response.get('webSearchResults') and CONFIG["ISSHOW_SEARCH_RESULTS"]:
+        return Utils.organize_search_results(event.response['webSearchResults'])
+    return event.value
+
+
+def handle_image_response(image_url, ctx):
+    proxy_options = ctx.proxy_options
+
+    # 使用智能重试机制发起图片下载请求，失败重试已按类别在其中处理，这里不再另套重试循环
+    def make_image_download_request(**request_kwargs):
+        return http_pool.request(
+            "GET",
+            f"https://assets.grok.com/{image_url}",
+            proxy_options=proxy_options,
+            **request_kwargs
+        )
 
-        except Exception as error:
-            logger.error(str(error), "Server")
-            retry_count += 1
-            if retry_count == max_retries:
-                raise
+    image_base64_response = smart_grok_request_with_fallback(
+        make_image_download_request,
+        headers={
+            **get_default_headers(),
+            "Cookie": ctx.cookie
+        },
+        **proxy_options
+    )
 
-            time.sleep(CONFIG["API"]["RETRY_TIME"] / 1000 * retry_count)
+    if image_base64_response.status_code != 200:
+        raise Exception(f"上游服务请求失败! status: {image_base64_response.status_code}")
 
     image_buffer = image_base64_response.content
 
@@ -1232,7 +3259,7 @@ def handle_image_response(image_url):
             "X-API-Key": CONFIG["API"]["PICGO_KEY"]
         }
 
-        response_url = requests.post(
+        response_url = http_pool.http_session().post(
             "https://www.picgo.net/api/1/upload",
             files=files,
             headers=headers
@@ -1253,7 +3280,7 @@ def handle_image_response(image_url):
             'Authorization': f"Bearer {CONFIG['API']['TUMY_KEY']}"
         }
 
-        response_url = requests.post(
+        response_url = http_pool.http_session().post(
             "https://tu.my/api/v1/upload",
             files=files,
             headers=headers
@@ -1270,191 +3297,244 @@ def handle_image_response(image_url):
                 logger.error(str(error), "Server")
                 return "生图失败，请查看TUMY图床密钥是否设置正确"
                 
-def handle_non_stream_response(response, model):
-    logger.info("开始处理非流式响应", "Server")
-    stream = response.iter_lines()
-    full_response = ""
-    final_agent_response = None
-    image_url_found = None
-    citations = {}
-
-    AGENT_MODELS = ['grok-4-heavy', 'grok-4', 'grok-3-deepersearch', 'grok-3-deepsearch', 'grok-4-mini-thinking-tahoe']
+class NonStreamResponseCollector:
+    """
+    非流式响应收集器，同步与异步链路共用。
+    只负责消费解码后的事件，不做网络 IO；生图时记录 image_url 交由调用方下载。
+    """
 
-    for chunk in stream:
-        if not chunk: continue
-        try:
-            line_json = json.loads(chunk.decode("utf-8").strip())
-            if line_json.get("error"): continue
+    def __init__(self, model):
+        self.model = model
+        self.is_agent = model in AGENT_MODELS
+        self.decoder = GrokStreamDecoder()
+        self.text_parts = []
+        self.final_agent_response = None
+        self.image_url = None
+
+    def feed(self, data):
+        self._handle_events(self.decoder.feed(data))
+
+    def feed_eof(self):
+        self._handle_events(self.decoder.feed_eof())
+
+    def _handle_events(self, events):
+        for event in events:
+            kind = event.kind
+            if kind == EVENT_IMAGE:
+                self.image_url = event.value
+            elif self.is_agent:
+                if kind == EVENT_MODEL_RESPONSE:
+                    self.final_agent_response = event.value
+            elif kind == EVENT_TOKEN:
+                self.text_parts.append(event.value)
+
+    def result(self):
+        if self.is_agent and self.final_agent_response is not None:
+            return Utils.safe_filter_grok_tags(self.final_agent_response, self.decoder.citations)
+        return Utils.safe_filter_grok_tags(''.join(self.text_parts), self.decoder.citations)
+
+async def handle_non_stream_response(response, model, ctx):
+    logger.info("开始处理非流式响应", "Server")
+    collector = NonStreamResponseCollector(model)
+    first = True
+    async for data in response.aiter_content():
+        if first:
+            first = False
+            token_manager.record_token_ttft(ctx.model, ctx.sso_cookie, ctx.elapsed_ms(ctx.attempt_started_at))
+        collector.feed(data)
+    collector.feed_eof()
+
+    if collector.image_url:
+        return await run_blocking(handle_image_response, collector.image_url, ctx)
+    return collector.result()
+
+class SSEChunkEncoder:
+    """
+    单个流的 SSE 数据块编码器。
+    id / created / model 在流开始时只序列化一次（整个流共用同一个 id，符合 OpenAI 语义），
+    之后每个数据块只需转义 content 字符串并拼接预先生成的前后缀。
+    """
 
-            response_data = line_json.get("result", {}).get("response")
-            if not response_data: continue
+    def __init__(self, model):
+        self.id = f"chatcmpl-{uuid.uuid4()}"
+        self.created = int(time.time())
+        header = json.dumps({
+            "id": self.id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": model
+        })[:-1]
+        self._prefix = f'data: {header}, "choices": [{{"index": 0, "delta": {{"content": '.encode('utf-8')
+        self._suffix = b'}}]}\n\n'
+        self._role_frame = f'data: {header}, "choices": [{{"index": 0, "delta": {{"role": "assistant", "content": ""}}, "finish_reason": null}}]}}\n\n'.encode('utf-8')
+        self._stop_frame = f'data: {header}, "choices": [{{"index": 0, "delta": {{}}, "finish_reason": "stop"}}]}}\n\n'.encode('utf-8')
 
-            if "cardAttachment" in response_data and response_data["cardAttachment"].get("jsonData"):
-                try:
-                    card_data = json.loads(response_data["cardAttachment"]["jsonData"])
-                    if card_data.get("id") and card_data.get("url"):
-                        citations[card_data["id"]] = card_data["url"]
-                except json.JSONDecodeError: pass
+    def role_frame(self):
+        return self._role_frame
 
-            if "cachedImageGenerationResponse" in response_data:
-                image_url_found = response_data["cachedImageGenerationResponse"].get("imageUrl")
+    def encode(self, content):
+        return self._prefix + json_dumps_bytes(content) + self._suffix
 
-            if model in AGENT_MODELS:
-                if response_data.get("modelResponse") and isinstance(response_data["modelResponse"], dict):
-                    final_agent_response = response_data["modelResponse"].get("message", "")
-            else:
-                is_process_info = (
-                    response_data.get("isThinking") or 
-                    response_data.get("messageStepId") or
-                    response_data.get("modelResponse") or
-                    response_data.get("messageTag") not in [None, "final"]
-                )
-                token = response_data.get("token")
-                if token is not None and not is_process_info:
-                    full_response += token
-        
-        except Exception as e:
-            logger.error(f"处理非流式响应行时出错: {str(e)}", "Server")
-            continue
+    def stop_frame(self):
+        return self._stop_frame
 
-    if image_url_found:
-        return handle_image_response(image_url_found)
-    
-    if model in AGENT_MODELS and final_agent_response is not None:
-        return Utils.safe_filter_grok_tags(final_agent_response, citations)
-    
-    return Utils.safe_filter_grok_tags(full_response, citations)
-def handle_stream_response(response, model):
-    
-    Utils.reset_citation_counter()
-    initial_payload = {
-        "id": f"chatcmpl-{uuid.uuid4()}",
-        "object": "chat.completion.chunk",
-        "created": int(time.time()),
-        "model": model,
-        "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]
-    }
-    yield f"data: {json.dumps(initial_payload)}\n\n".encode('utf-8')
+class StreamResponseProcessor:
+    """
+    把上游事件转换为 OpenAI SSE 数据块的状态机，同步与异步链路共用。
+    只负责解析与编码，不做网络 IO；生图时记录 image_url 交由调用方下载。
+    """
 
-    citations = {}
-    AGENT_MODELS = ['grok-4-heavy', 'grok-4', 'grok-3-deepersearch', 'grok-3-deepsearch', 'grok-4-mini-thinking-tahoe']
+    def __init__(self, model):
+        self.model = model
+        self.is_agent = model in AGENT_MODELS
+        self.decoder = GrokStreamDecoder()
+        # 标签过滤器与信源编号按流隔离，异步模式下多个流共用同一线程也互不干扰
+        self.tag_filter = GrokTagFilter(self.decoder.citations)
+        self.encoder = SSEChunkEncoder(model)
+        self._pending_text = []
+        self.is_in_think_block = False
+        self.emitted_content_from_tokens = False
+        self.is_img_gen = False
+        self.image_url = None
+
+    def start(self):
+        if self.is_agent:
+            logger.info(f"使用 Agent 模型专用逻辑处理: {self.model}", "Server")
+        else:
+            logger.info(f"使用标准模型逻辑处理 (严格过滤模式): {self.model}", "Server")
+        return self.encoder.role_frame()
 
-    if model in AGENT_MODELS:
-        def generate_agent():
-            logger.info(f"使用 Agent 模型专用逻辑处理: {model}", "Server")
-            stream = response.iter_lines()
-            is_in_think_block = False
-            emitted_content_from_tokens = False
+    def encode(self, content):
+        return self.encoder.encode(content)
 
-            for chunk in stream:
-                if not chunk: continue
-                try:
-                    line_json = json.loads(chunk.decode("utf-8").strip())
-                    if line_json.get("error"): continue
-                    response_data = line_json.get("result", {}).get("response")
-                    if not response_data: continue
-                    if "cardAttachment" in response_data and response_data["cardAttachment"].get("jsonData"):
-                        try:
-                            card_data = json.loads(response_data["cardAttachment"]["jsonData"])
-                            if card_data.get("id") and card_data.get("url"):
-                                citations[card_data["id"]] = card_data["url"]
-                        except json.JSONDecodeError: pass
-
-                    # 忽略 streaming 末尾重复的整体 modelResponse，除非前面没收到任何 token
-                    if isinstance(response_data.get("modelResponse"), dict):
-                        if emitted_content_from_tokens:
-                            continue
-                        clean_message = Utils.safe_filter_grok_tags(response_data["modelResponse"].get("message", ""), citations)
-                        if clean_message:
-                            if is_in_think_block:
-                                is_in_think_block = False
-                                payload = MessageProcessor.create_chat_response('</think>\n\n', model, True)
-                                yield f"data: {json.dumps(payload)}\n\n".encode('utf-8')
-                            payload = MessageProcessor.create_chat_response(clean_message, model, True)
-                            yield f"data: {json.dumps(payload)}\n\n".encode('utf-8')
-                        continue
-
-                    result = process_model_response(response_data, model)
-                    if result.get("type") == 'heartbeat':
-                        yield b": ping\n\n"
-                        continue
-                    if result.get("token"):
-                        if result.get("type") == 'thinking':
-                            if not is_in_think_block:
-                                is_in_think_block = True
-                                payload = MessageProcessor.create_chat_response('<think>\n', model, True)
-                                yield f"data: {json.dumps(payload)}\n\n".encode('utf-8')
-                            clean_token = Utils.safe_filter_grok_tags(result["token"], citations)
-                            if clean_token:
-                                payload = MessageProcessor.create_chat_response(clean_token, model, True)
-                                yield f"data: {json.dumps(payload)}\n\n".encode('utf-8')
-                        elif result.get("type") == 'content':
-                            if is_in_think_block:
-                                is_in_think_block = False
-                                payload = MessageProcessor.create_chat_response('</think>\n\n', model, True)
-                                yield f"data: {json.dumps(payload)}\n\n".encode('utf-8')
-                            clean_token = Utils.safe_filter_grok_tags(result["token"], citations)
-                            if clean_token:
-                                emitted_content_from_tokens = True
-                                payload = MessageProcessor.create_chat_response(clean_token, model, True)
-                                yield f"data: {json.dumps(payload)}\n\n".encode('utf-8')
-                except Exception as e:
+    def _emit(self, output, content):
+        if CONFIG["SSE_COALESCE"]:
+            self._pending_text.append(content)
+        else:
+            output.append(self.encoder.encode(content))
+
+    def _flush_text(self, output):
+        """把本次上游读取中累积的正文片段合并为一个 SSE 数据块"""
+        if self._pending_text:
+            output.append(self.encoder.encode(''.join(self._pending_text)))
+            self._pending_text = []
+
+    def _flush_filter(self, output):
+        residual = self.tag_filter.flush()
+        if residual:
+            self._emit(output, residual)
+
+    def feed(self, data):
+        """处理一块上游原始字节，返回需要下发给客户端的 SSE 数据块列表"""
+        if self.image_url:
+            return []
+        return self._handle_events(self.decoder.feed(data))
+
+    def feed_eof(self):
+        if self.image_url:
+            return []
+        return self._handle_events(self.decoder.feed_eof())
+
+    def _handle_events(self, events):
+        output = []
+        handle_event = self._handle_agent_event if self.is_agent else self._handle_standard_event
+        for event in events:
+            try:
+                handle_event(event, output)
+            except Exception as e:
+                if self.is_agent:
                     logger.error(f"处理 Agent 流时出错: {str(e)}", "Server")
-                    continue
-            if is_in_think_block:
-                payload = MessageProcessor.create_chat_response('</think>\n\n', model, True)
-                yield f"data: {json.dumps(payload)}\n\n".encode('utf-8')
-            yield b"data: [DONE]\n\n"
-        for chunk in generate_agent():
+                else:
+                    logger.error(f"处理标准流时出错: {str(e)}", "Server")
+            if self.image_url:
+                break
+        self._flush_text(output)
+        return output
+
+    def _close_think_block(self, output):
+        if self.is_in_think_block:
+            self._flush_filter(output)
+            self.is_in_think_block = False
+            self._emit(output, '</think>\n\n')
+
+    def _handle_agent_event(self, event, output):
+        kind = event.kind
+        # 忽略 streaming 末尾重复的整体 modelResponse，除非前面没收到任何 token
+        if kind == EVENT_MODEL_RESPONSE:
+            if self.emitted_content_from_tokens:
+                return
+            self._flush_filter(output)
+            clean_message = self.tag_filter.feed(event.value) + self.tag_filter.flush()
+            if clean_message:
+                self._close_think_block(output)
+                self._emit(output, clean_message)
+        elif kind == EVENT_HEARTBEAT:
+            self._flush_text(output)
+            output.append(b": ping\n\n")
+        elif kind == EVENT_THINKING:
+            if not CONFIG["SHOW_THINKING"]:
+                return
+            content = thinking_content(event)
+            if not content:
+                return
+            if not self.is_in_think_block:
+                self._flush_filter(output)
+                self.is_in_think_block = True
+                self._emit(output, '<think>\n')
+            clean_token = self.tag_filter.feed(content)
+            if clean_token:
+                self._emit(output, clean_token)
+        elif kind == EVENT_TOKEN or kind == EVENT_TAGGED_TOKEN:
+            if not event.value:
+                return
+            self._close_think_block(output)
+            clean_token = self.tag_filter.feed(event.value)
+            if clean_token:
+                self.emitted_content_from_tokens = True
+                self._emit(output, clean_token)
+
+    def _handle_standard_event(self, event, output):
+        kind = event.kind
+        if kind == EVENT_IMAGE_GEN:
+            self.is_img_gen = True
+        elif kind == EVENT_IMAGE:
+            if event.value:
+                self.image_url = event.value
+        elif kind == EVENT_TOKEN and not self.is_img_gen and event.value:
+            clean_token = self.tag_filter.feed(event.value)
+            if clean_token:
+                self._emit(output, clean_token)
+
+    def finish(self):
+        output = []
+        self._flush_filter(output)
+        self._close_think_block(output)
+        self._flush_text(output)
+        output.append(self.encoder.stop_frame())
+        output.append(b"data: [DONE]\n\n")
+        return output
+
+async def handle_stream_response(response, model, ctx):
+    processor = StreamResponseProcessor(model)
+    yield processor.start()
+    first = True
+    async for data in response.aiter_content():
+        for chunk in processor.feed(data):
+            if first:
+                first = False
+                token_manager.record_token_ttft(ctx.model, ctx.sso_cookie, ctx.elapsed_ms(ctx.attempt_started_at))
             yield chunk
+        if processor.image_url:
+            break
     else:
-        def generate_standard_fixed():
-            logger.info(f"使用标准模型逻辑处理 (严格过滤模式): {model}", "Server")
-            stream = response.iter_lines()
-            is_img_gen = False
-            is_img_gen2 = False
-            for chunk in stream:
-                if not chunk: continue
-                try:
-                    line_json = json.loads(chunk.decode("utf-8").strip())
-                    if line_json.get("error"): continue
-                    response_data = line_json.get("result", {}).get("response")
-                    if not response_data: continue
-                    if "cardAttachment" in response_data and response_data["cardAttachment"].get("jsonData"):
-                        try:
-                            card_data = json.loads(response_data["cardAttachment"]["jsonData"])
-                            if card_data.get("id") and card_data.get("url"):
-                                citations[card_data["id"]] = card_data["url"]
-                        except json.JSONDecodeError: pass
-                    if response_data.get("doImgGen") or response_data.get("imageAttachmentInfo"):
-                        is_img_gen = True
-                    if "cachedImageGenerationResponse" in response_data and not is_img_gen2:
-                        image_url = response_data["cachedImageGenerationResponse"].get("imageUrl")
-                        if image_url:
-                            is_img_gen2 = True
-                            image_data = handle_image_response(image_url)
-                            payload = MessageProcessor.create_chat_response(image_data, model, True)
-                            yield f"data: {json.dumps(payload)}\n\n".encode('utf-8')
-                            break 
-                    if is_img_gen and not is_img_gen2:
-                        continue
-                    is_process_info = (
-                        response_data.get("isThinking") or 
-                        response_data.get("messageStepId") or
-                        response_data.get("modelResponse") or
-                        response_data.get("messageTag") not in [None, "final"]
-                    )
-                    token = response_data.get("token")
-                    if token and not is_process_info:
-                        clean_token = Utils.safe_filter_grok_tags(token, citations)
-                        payload = MessageProcessor.create_chat_response(clean_token, model, True)
-                        yield f"data: {json.dumps(payload)}\n\n".encode('utf-8')
-                except Exception as e:
-                    logger.error(f"处理标准流时出错: {str(e)}", "Server")
-                    continue
-            yield b"data: [DONE]\n\n"
-        for chunk in generate_standard_fixed():
+        for chunk in processor.feed_eof():
             yield chunk
+    if processor.image_url:
+        yield processor.encode(await run_blocking(handle_image_response, processor.image_url, ctx))
+    for chunk in processor.finish():
+        yield chunk
+
+
 def initialization():
     sso_array = os.environ.get("SSO", "").split(',')
     sso_heavy_array = os.environ.get("SSO_HEAVY", "").split(',') # 新增 heavy sso 环境变量
@@ -1470,10 +3550,10 @@ def initialization():
         if sso:
             token_manager.add_token(f"sso-rw={sso};sso={sso}", token_type="heavy", isinitialization=True)
 
-    token_manager.save_token_status()
+    token_manager.save_token_status(immediate=True)
 
     all_tokens = token_manager.get_all_tokens() # 假设你有一个 get_all_tokens 方法
-    logger.info(f"成功加载令牌: {json.dumps(all_tokens, indent=2)}", "Server")
+    logger.info(f"成功加载令牌: {json.dumps([mask_sso(token.split(';')[-1]) for token in all_tokens], ensure_ascii=False)}", "Server")
     logger.info(f"令牌加载完成，共加载: {len(all_tokens)}个令牌", "Server")
 
     if CONFIG["API"]["PROXY"]:
@@ -1566,6 +3646,37 @@ def get_tokens():
         return jsonify({"error": 'Unauthorized'}), 401
     return jsonify(token_manager.get_token_status_map())
 
+@app.route('/get/stats', methods=['GET'])
+def get_stats():
+    auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    if auth_token != CONFIG["API"]["API_KEY"]:
+        return jsonify({"error": 'Unauthorized'}), 401
+    return jsonify({
+        "startup": STARTUP_METRICS,
+        "token_capacity": token_manager.get_capacity_summary(),
+        "token_selection": {
+            "strategy": token_manager.selection.name,
+            "type_preference": token_manager.type_preference
+        },
+        "statsig_meta": meta_cache.snapshot(),
+        "statsig_id_pool": statsig_id_pool.snapshot(),
+        "http_pool": http_pool.snapshot(),
+        "upload_cache": upload_cache.snapshot(),
+        "upstream_latency": upstream_latency.snapshot(),
+        "hedging": {
+            "enabled": CONFIG["API"]["HEDGE_REQUESTS"],
+            "delay": hedge_delay(),
+            **hedge_stats
+        },
+        "upstream_failures": failure_stats,
+        "admission": {
+            **admission.snapshot(),
+            "token_max_in_flight": CONFIG["TOKEN_MAX_IN_FLIGHT"],
+            "token_in_flight": token_manager.get_in_flight_summary()
+        },
+        "token_health": token_manager.get_health_summary()
+    })
+
 @app.route('/add/token', methods=['POST'])
 def add_token():
     auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
@@ -1628,60 +3739,744 @@ def get_models():
     
     
 def stream_with_active_heartbeat(source_stream, interval=30):
-    q = queue.Queue()
+    """
+    Flask 链路的心跳包装。source_stream 是异步生成器，运行在共享事件循环上；
+    请求线程只在等待下一块数据时带超时，超时即发送心跳，不再额外起读线程和队列。
+    客户端断开时 Werkzeug 会关闭本生成器，此时取消读取并立即关闭上游连接。
+    """
+    bridge = LoopStreamBridge(source_stream)
+    try:
+        # 立刻写首字节 + 2KB 填充（SSE 注释，客户端不会解析为 JSON）
+        yield (":" + (" " * 2048) + "\n").encode('utf-8')
 
-    def reader_thread():
-        try:
-            for chunk in source_stream:
-                q.put(chunk)
-        except Exception as e:
-            logger.error(f"源数据流发生错误: {e}", "HeartbeatWrapper")
-            q.put(e)
-        finally:
-            q.put(None)
+        while True:
+            try:
+                chunk = bridge.next_chunk(interval)
+            except Exception as e:
+                logger.error(f"源数据流发生错误: {e}", "HeartbeatWrapper")
+                raise
 
-    thread = threading.Thread(target=reader_thread)
-    thread.daemon = True
-    thread.start()
+            if chunk is None:
+                # 主动心跳用 SSE 注释，避免客户端按 OpenAI chunk 解析
+                logger.info("30秒无响应，发送主动心跳", "HeartbeatWrapper")
+                yield b": keep-alive\n\n"
+                continue
+            if chunk is LoopStreamBridge.END:
+                break
+            yield chunk
+    finally:
+        bridge.close()
 
-    # 立刻写首字节 + 2KB 填充（SSE 注释，客户端不会解析为 JSON）
+async def stream_with_active_heartbeat_async(source_stream, interval=30):
+    """
+    stream_with_active_heartbeat 的 ASGI 版本：直接在当前事件循环上
+    把心跳折叠进读取下一块数据的等待超时里。
+    """
     yield (":" + (" " * 2048) + "\n").encode('utf-8')
 
-    last_sent = time.monotonic()
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(source_stream.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=interval)
+            if not done:
+                logger.info("30秒无响应，发送主动心跳", "HeartbeatWrapper")
+                yield b": keep-alive\n\n"
+                continue
+
+            try:
+                chunk = pending.result()
+            except StopAsyncIteration:
+                break
+            except Exception as e:
+                logger.error(f"源数据流发生错误: {e}", "HeartbeatWrapper")
+                raise
+            finally:
+                pending = None
+            yield chunk
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+        await source_stream.aclose()
+
+MAX_SWITCH_ATTEMPTS = 5
+
+def check_chat_authorization(authorization):
+    """校验对话接口的鉴权头，失败时返回 (错误信息, 状态码)，通过时返回 None"""
+    auth_token = authorization.replace('Bearer ', '')
+    if auth_token:
+        if CONFIG["API"]["IS_CUSTOM_SSO"]:
+            result = f"sso={auth_token};sso-rw={auth_token}"
+            token_manager.set_token(result) # 注意：自定义SSO模式会覆盖分组逻辑
+        elif auth_token != CONFIG["API"]["API_KEY"]:
+            return 'Unauthorized', 401
+    else:
+        return 'API_KEY缺失', 401
+    return None
+
+class TokenPoolBusy(Exception):
+    """还有可用令牌，但都已达到 TOKEN_MAX_IN_FLIGHT，需要等正在进行的请求结束"""
 
-    while True:
+class AdmissionRejected(Exception):
+    """等待队列已满或等到截止时间仍无名额，返回 429 并带 Retry-After（秒）"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def _wake_future(loop, future):
+    loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+class _AdmissionWaiter:
+    __slots__ = ("priority", "seq", "wake", "queued", "admitted")
+
+    def __init__(self, priority):
+        self.priority = priority
+        self.seq = None
+        self.wake = None
+        self.queued = False
+        self.admitted = False
+
+def parse_model_limits(value):
+    """解析 "20" 或 "grok-3:20,grok-4:8,*:10" 形式的按模型上限，不带模型名的数值作为默认值（键为 "*"）"""
+    limits = {}
+    for item in (value or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        model, _, limit = item.rpartition(":")
+        limits[model or "*"] = int(limit)
+    return limits
+
+class AdmissionController:
+    """
+    对话请求的准入控制。每个模型同时进行中的请求数不超过 MODEL_MAX_IN_FLIGHT，
+    选令牌时跳过已达 TOKEN_MAX_IN_FLIGHT 的令牌；暂时没有名额时进入该模型的有界等待队列，
+    按优先级（数值小的先）和到达顺序放行，队列已满或等到截止时间仍无名额时立即拒绝。
+    名额释放时只唤醒队首的一个等待者；线程（Flask）与协程（ASGI）可以在同一个队列中等待。
+    clock 返回秒数，截止时间与它使用同一时基，可注入。
+    """
+
+    def __init__(self, model_limits, max_queue, timeout, clock=time.monotonic):
+        self.model_limits = model_limits
+        self.clock = clock
+        self.max_queue = max(0, max_queue)
+        self.timeout = timeout
+        self.in_flight = {}
+        # 模型 -> [(优先级, 到达序号, 等待者)] 小顶堆，离开的等待者延迟删除
+        self._heaps = {}
+        # 模型 -> 正在排队（含已被唤醒、尚未重试完）的请求数
+        self._queued = {}
+        # 模型 -> 最近请求结束的时间，用于估算 Retry-After
+        self._completions = {}
+        self._seq = itertools.count()
+        # 每次 notify 加一；锁外尝试期间若有变化，说明错过了一次唤醒，需要立即重试
+        self._wakeups = 0
+        # 只保护计数与队列，持锁期间不执行 try_acquire
+        self._lock = threading.Lock()
+        self.stats = {"admitted": 0, "queued": 0, "rejected_full": 0, "rejected_timeout": 0}
+
+    def limit(self, model):
+        return self.model_limits.get(model, self.model_limits.get("*", 0))
+
+    def retry_after(self, model):
+        """按该模型最近一分钟的完成速度估算排到名额需要的秒数（1~60），调用方需持有 self._lock"""
+        now = self.clock()
+        recent = sum(1 for finished in self._completions.get(model, ()) if now - finished <= 60)
+        if not recent:
+            return max(1, math.ceil(self.timeout))
+        return min(60, max(1, math.ceil((self._queued.get(model, 0) + 1) * 60 / recent)))
+
+    def _begin(self, model, take_slot, waiter, deadline):
+        """
+        调用方持有 self._lock。新到达的请求在已有人排队时直接排队，不插队；
+        已占有模型名额的重试（take_slot 为 False）不受此限制，也不受队列长度限制。
+        轮到本等待者且模型名额未满时先占住名额，返回本轮的唤醒序号，由调用方在锁外执行 try_acquire；
+        否则把等待者放入队列并返回 None。
+        """
+        if waiter.seq is not None or not take_slot or not self._queued.get(model):
+            limit = self.limit(model) if take_slot else 0
+            if not limit or self.in_flight.get(model, 0) < limit:
+                if take_slot:
+                    self.in_flight[model] = self.in_flight.get(model, 0) + 1
+                return self._wakeups
+        self._enqueue(model, take_slot, waiter, deadline)
+        return None
+
+    def _enqueue(self, model, take_slot, waiter, deadline):
+        """调用方持有 self._lock；队列已满或已到截止时间时抛出 AdmissionRejected"""
+        if waiter.seq is None:
+            if take_slot and self._queued.get(model, 0) >= self.max_queue:
+                self.stats["rejected_full"] += 1
+                raise AdmissionRejected(f"模型 {model} 的并发请求已满，等待队列也已满，请稍后重试", self.retry_after(model))
+            waiter.seq = next(self._seq)
+            self._queued[model] = self._queued.get(model, 0) + 1
+            self.stats["queued"] += 1
+        if self.clock() >= deadline:
+            self.stats["rejected_timeout"] += 1
+            raise AdmissionRejected(f"模型 {model} 的并发请求已满，排队等待超时，请稍后重试", self.retry_after(model))
+
+        heapq.heappush(self._heaps.setdefault(model, []), (waiter.priority, waiter.seq, waiter))
+        waiter.queued = True
+
+    def _admitted(self, waiter):
+        with self._lock:
+            waiter.admitted = True
+            self.stats["admitted"] += 1
+
+    def _unreserve(self, model, take_slot):
+        """调用方持有 self._lock：try_acquire 没有成功，归还 _begin 占住的名额"""
+        if take_slot:
+            self.in_flight[model] -= 1
+            # 占住名额期间可能有新请求因名额已满而排队
+            self._wake_head(model)
+
+    def _busy(self, model, take_slot, waiter, deadline, wakeups):
+        """
+        try_acquire 抛出 TokenPoolBusy：归还名额并排队，返回 False。
+        尝试期间已有令牌或名额释放（唤醒序号变化）时不排队，返回 True 立即重试，避免错过这次唤醒。
+        """
+        with self._lock:
+            self._unreserve(model, take_slot)
+            if self._wakeups != wakeups:
+                return True
+            self._enqueue(model, take_slot, waiter, deadline)
+            return False
+
+    def _leave(self, model, waiter):
+        """等待者离开（准入成功、被拒或出错）；已被唤醒却没有用掉名额时把唤醒传给下一个"""
+        if waiter.seq is None:
+            return
+        with self._lock:
+            self._queued[model] -= 1
+            waiter.wake = None
+            pass_on = not waiter.queued and not waiter.admitted
+        if pass_on:
+            self.notify(model)
+
+    def _deadline(self, deadline):
+        return deadline if deadline is not None else self.clock() + self.timeout
+
+    def admit(self, model, try_acquire, priority=0, deadline=None, take_slot=True):
+        """
+        在当前线程中等待准入，返回 try_acquire() 的结果。try_acquire 抛出 TokenPoolBusy 表示暂无令牌可用；
+        take_slot 为 True 时同时占用一个模型并发名额，由调用方在请求结束时 release；
+        为 False 时是已占有名额的请求在换令牌，只等令牌，排在所有新请求之前。
+        try_acquire 在准入锁之外执行，选令牌（可能含共享存储的事务）不会阻塞名额的释放与唤醒。
+        """
+        deadline = self._deadline(deadline)
+        event = threading.Event()
+        waiter = _AdmissionWaiter(priority if take_slot else -math.inf)
+        waiter.wake = event.set
+        try:
+            while True:
+                with self._lock:
+                    event.clear()
+                    wakeups = self._begin(model, take_slot, waiter, deadline)
+                if wakeups is not None:
+                    try:
+                        result = try_acquire()
+                    except TokenPoolBusy:
+                        if self._busy(model, take_slot, waiter, deadline, wakeups):
+                            continue
+                    except BaseException:
+                        with self._lock:
+                            self._unreserve(model, take_slot)
+                        raise
+                    else:
+                        self._admitted(waiter)
+                        return result
+                event.wait(max(0.0, deadline - self.clock()))
+        finally:
+            self._leave(model, waiter)
+
+    async def admit_async(self, model, try_acquire, priority=0, deadline=None, take_slot=True):
+        """
+        admit 的协程版本，等待期间不占用事件循环。
+        try_acquire 可能执行共享存储的 sqlite 事务（busy 时最长等待 30 秒），每次尝试都放到线程池执行；
+        尝试无法中断，被取消时等它结束再抛出，成功的尝试视为已占用名额，由调用方清理时释放。
+        """
+        deadline = self._deadline(deadline)
+        loop = asyncio.get_running_loop()
+        waiter = _AdmissionWaiter(priority if take_slot else -math.inf)
         try:
-            timeout = max(0, interval - (time.monotonic() - last_sent))
-            chunk = q.get(timeout=timeout) if timeout > 0 else q.get_nowait()
+            while True:
+                woken = loop.create_future()
+                waiter.wake = functools.partial(_wake_future, loop, woken)
+                with self._lock:
+                    wakeups = self._begin(model, take_slot, waiter, deadline)
+                if wakeups is not None:
+                    attempt = loop.run_in_executor(None, try_acquire)
+                    try:
+                        result = await asyncio.shield(attempt)
+                    except asyncio.CancelledError:
+                        await asyncio.wait({attempt})
+                        if attempt.exception() is None:
+                            self._admitted(waiter)
+                        else:
+                            with self._lock:
+                                self._unreserve(model, take_slot)
+                        raise
+                    except TokenPoolBusy:
+                        if self._busy(model, take_slot, waiter, deadline, wakeups):
+                            continue
+                    except BaseException:
+                        with self._lock:
+                            self._unreserve(model, take_slot)
+                        raise
+                    else:
+                        self._admitted(waiter)
+                        return result
+                try:
+                    await asyncio.wait_for(woken, max(0.0, deadline - self.clock()))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._leave(model, waiter)
+
+    def _wake_head(self, model):
+        """调用方持有 self._lock：唤醒该模型队首的一个等待者"""
+        heap = self._heaps.get(model)
+        while heap:
+            _, _, waiter = heapq.heappop(heap)
+            if waiter.queued and waiter.wake is not None:
+                waiter.queued = False
+                waiter.wake()
+                return
+
+    def notify(self, model=None):
+        """有名额释放时唤醒该模型（为 None 时每个模型）队首的一个等待者"""
+        with self._lock:
+            self._wakeups += 1
+            for name in ([model] if model is not None else list(self._heaps)):
+                self._wake_head(name)
+
+    def release(self, model):
+        """请求结束，归还模型并发名额"""
+        with self._lock:
+            self.in_flight[model] = max(0, self.in_flight.get(model, 0) - 1)
+            self._completions.setdefault(model, deque(maxlen=256)).append(self.clock())
+        self.notify(model)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "limits": self.model_limits,
+                "max_queue": self.max_queue,
+                "timeout": self.timeout,
+                "in_flight": {model: count for model, count in self.in_flight.items() if count},
+                "waiting": {model: count for model, count in self._queued.items() if count},
+                **self.stats
+            }
 
-            if chunk is None:
-                break
-            if isinstance(chunk, Exception):
-                raise chunk
+admission = AdmissionController(
+    parse_model_limits(CONFIG["API"]["MODEL_MAX_IN_FLIGHT"]),
+    CONFIG["API"]["ADMISSION_QUEUE_SIZE"],
+    CONFIG["API"]["ADMISSION_TIMEOUT"]
+)
+
+def admission_params(get_header):
+    """从请求头读取排队优先级（X-Priority，数值小的先，默认 0）与截止时间（X-Queue-Timeout 秒，不超过 ADMISSION_TIMEOUT）"""
+    try:
+        priority = int(get_header('x-priority') or 0)
+    except ValueError:
+        priority = 0
+    timeout = CONFIG["API"]["ADMISSION_TIMEOUT"]
+    try:
+        timeout = min(timeout, max(0.0, float(get_header('x-queue-timeout') or timeout)))
+    except ValueError:
+        pass
+    return priority, time.monotonic() + timeout
+
+def _admission_acquire(ctx, attempt, exclude):
+    """准入时执行的选令牌操作；第一次尝试选令牌成功即记下已占用模型名额，请求结束时由 ctx.finish 归还"""
+    def acquire():
+        sso_cookie = acquire_sso_for_attempt(ctx, attempt, exclude)
+        if attempt == 0:
+            ctx.admitted = True
+        return sso_cookie
+    return acquire
+
+def admit_attempt(ctx, attempt, exclude=None):
+    """
+    在当前线程中等待准入并为第 attempt 次尝试选出 SSO；第一次尝试同时占用模型并发名额，
+    之后的尝试已持有名额，只在令牌都忙时等待，截止时间从本次尝试开始重新计算。
+    """
+    return admission.admit(
+        token_manager.normalize_model_name(ctx.model),
+        _admission_acquire(ctx, attempt, exclude),
+        ctx.priority, ctx.deadline if attempt == 0 else None, take_slot=attempt == 0
+    )
+
+async def admit_attempt_async(ctx, attempt, exclude=None):
+    """admit_attempt 的协程版本"""
+    return await admission.admit_async(
+        token_manager.normalize_model_name(ctx.model),
+        _admission_acquire(ctx, attempt, exclude),
+        ctx.priority, ctx.deadline if attempt == 0 else None, take_slot=attempt == 0
+    )
+
+def acquire_sso_for_attempt(ctx, attempt, exclude=None):
+    """
+    为第 attempt 次尝试选出 SSO 并消耗一次计数，写入请求上下文并返回该 SSO。
+    不等待：令牌都达到并发上限时抛出 TokenPoolBusy，需要排队时使用 admit_attempt。
+    """
+    # 选取与计数是一次原子操作，出错时移除的就是实际被计数的那个 SSO
+    current_sso_cookie = token_manager.get_next_token_for_model(ctx.model, exclude=exclude)
+
+    if not current_sso_cookie:
+        raise ValueError(f'模型 {ctx.model} 已无可用令牌可供尝试。')
+
+    ctx.use_token(current_sso_cookie, attempt)
+    ctx.holds_token = True
+    logger.info(
+        f"第 {attempt + 1}/{MAX_SWITCH_ATTEMPTS} 次尝试，准备使用 SSO: {mask_sso(ctx.sso)}，"
+        f"模型剩余可用次数: {token_manager.get_remaining_capacity_for_model(ctx.model)}",
+        "ChatAPI"
+    )
+    if logger.enabled("DEBUG"):
+        logger.debug(f"当前可用模型的全部可用数量: {json.dumps(token_manager.get_remaining_token_request_capacity())}", "Server")
+    return current_sso_cookie
+
+def handle_attempt_failure(ctx, tried, status_code=None, error=None):
+    """
+    按失败类别处理本次尝试使用的令牌：quota 移入冷却池后换下一个；
+    auth 与 transient 退还计数、计入令牌健康统计（auth 立即熔断，transient 连续多次才熔断），
+    本请求内不再选它；payload 退还计数并抛出 UpstreamRequestRejected，不再换令牌重试。
+    """
+    ctx.release_token()
+    failure = classify_upstream_failure(status_code=status_code, error=error)
+    detail = f"状态码: {status_code}" if error is None else f"请求异常: {error}"
+    sso = mask_sso(ctx.sso)
+
+    if failure == FAILURE_QUOTA:
+        failure_stats["policy"]["switch_token"] += 1
+        logger.warning(f"SSO {sso} 请求失败 ({detail}，类别 {failure})，将移入冷却池并尝试下一个。", "ChatAPI")
+        token_manager.remove_token_from_model(ctx.model, ctx.sso_cookie)
+        return
+
+    token_manager.refund_token(ctx.model, ctx.sso_cookie)
+    if failure == FAILURE_PAYLOAD:
+        failure_stats["policy"]["fail_fast"] += 1
+        status_code = status_code if status_code is not None else error.status_code
+        raise UpstreamRequestRejected(status_code, f"上游拒绝了该请求 ({detail})，请检查请求内容")
+
+    failure_stats["policy"]["switch_token"] += 1
+    tried.add(ctx.sso_cookie)
+    logger.warning(f"SSO {sso} 请求失败 ({detail}，类别 {failure})，尝试下一个。", "ChatAPI")
+    token_manager.record_token_failure(ctx.model, ctx.sso_cookie, trip=failure == FAILURE_AUTH)
+
+def log_request_payload(model, payload):
+    """
+    默认只记录请求摘要（长度、哈希、附件数），完整请求体只在 DEBUG 级别按
+    LOG_PAYLOAD_SAMPLE 采样输出，避免每个请求都序列化几十 KB 的对话。
+    """
+    if logger.enabled("INFO"):
+        message = payload.get("message", "")
+        digest = hashlib.sha256(message.encode('utf-8')).hexdigest()[:12]
+        logger.info(
+            f"为模型 {model} 准备的请求: modelName={payload.get('modelName')}, "
+            f"消息长度={len(message)}, sha256={digest}, "
+            f"文件附件={len(payload.get('fileAttachments', []))}, "
+            f"图片生成={payload.get('toolOverrides', {}).get('imageGen', False)}",
+            "ChatAPI"
+        )
+    if logger.enabled("DEBUG") and random.random() < LOG_PAYLOAD_SAMPLE:
+        logger.debug(f"为模型 {model} 准备的请求体: {json.dumps(payload, indent=2)}", "ChatAPI")
+
+# conversations/new 的 (连接超时, 读取超时) 秒数
+CONVERSATION_TIMEOUT = (10, 1800)
+
+def build_conversation_request_kwargs(request_payload):
+    """conversations/new 的公共请求参数，同步与异步客户端共用"""
+    return {
+        "data": json.dumps(request_payload),
+        "impersonate": "chrome133a",
+        "stream": True,
+        "timeout": CONVERSATION_TIMEOUT, # 加上我们之前讨论的防超时设置
+    }
 
-            last_sent = time.monotonic()
+async def close_async_upstream(response, session):
+    """
+    立即中断上游并归还会话租约：取消尚未结束的读取任务会把 curl 句柄移出 multi，
+    连接随之断开，共享会话本身保持可用。
+    """
+    try:
+        stream_task = getattr(response, "astream_task", None) if response is not None else None
+        if stream_task is not None and not stream_task.done():
+            stream_task.cancel()
+            await asyncio.gather(stream_task, return_exceptions=True)
+    finally:
+        http_pool.release_async(session)
+
+async def _iterate_and_close(chunks, response, session):
+    try:
+        async for chunk in chunks:
             yield chunk
+    finally:
+        await chunks.aclose()
+        await close_async_upstream(response, session)
+
+async def open_conversation_async(request_payload, ctx):
+    """
+    用连接池中的 AsyncSession、以 ctx 中选定的 Cookie 发起 conversations/new，返回 (response, session)。
+    必须在目标事件循环内调用；调用方负责用 close_async_upstream 归还，失败时会自行归还。
+    """
+    session = http_pool.acquire_async(ctx.proxy_options)
+    response = None
+    try:
+        async def make_grok_request(**request_kwargs):
+            return await session.post(
+                f"{CONFIG['API']['BASE_URL']}/rest/app-chat/conversations/new",
+                **build_conversation_request_kwargs(request_payload),
+                **request_kwargs
+            )
+
+        response = await smart_grok_request_with_fallback_async(
+            make_grok_request,
+            headers={
+                **get_default_headers(),
+                "Cookie": ctx.cookie
+            },
+            **ctx.proxy_options
+        )
+        ctx.mark_response()
+        http_pool.record(response)
+        latency_ms = ctx.elapsed_ms(ctx.attempt_started_at)
+        upstream_latency.record(latency_ms)
+        if response.status_code == 200:
+            token_manager.record_token_success(ctx.model, ctx.sso_cookie, latency_ms)
+        return response, session
+    except BaseException:
+        await close_async_upstream(response, session)
+        raise
+
+class UpstreamLatencyTracker:
+    """最近若干次 conversations/new 的响应头耗时（毫秒），用于计算对冲等待时间"""
+
+    MIN_SAMPLES = 20
+
+    def __init__(self, size=256):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, elapsed_ms):
+        with self._lock:
+            self._samples.append(elapsed_ms)
+
+    def percentile(self, p):
+        """样本不足 MIN_SAMPLES 时返回 None"""
+        with self._lock:
+            if len(self._samples) < self.MIN_SAMPLES:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    def snapshot(self):
+        return {
+            "samples": len(self._samples),
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95)
+        }
+
+upstream_latency = UpstreamLatencyTracker()
+hedge_stats = {"hedged": 0, "hedge_wins": 0, "refunded": 0}
+
+def hedge_delay():
+    """对冲等待时间（秒）"""
+    percentile_ms = upstream_latency.percentile(CONFIG["API"]["HEDGE_PERCENTILE"])
+    if percentile_ms is None:
+        return CONFIG["API"]["HEDGE_DELAY"]
+    return min(CONVERSATION_TIMEOUT[0], max(CONFIG["API"]["HEDGE_MIN_DELAY"], percentile_ms / 1000))
+
+class PrefetchedResponse:
+    """已预读首行的上游响应：aiter_content 先交还预读的数据，再继续读取剩余部分，其余属性转发给原响应"""
+
+    def __init__(self, response, prefetched, chunks):
+        self._response = response
+        self._prefetched = prefetched
+        self._chunks = chunks
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    async def aiter_content(self):
+        if self._prefetched:
+            yield self._prefetched
+        async for data in self._chunks:
+            yield data
+
+async def read_first_ndjson_line(response):
+    """读到第一行非空 NDJSON 并校验，返回可继续完整读取的 PrefetchedResponse"""
+    chunks = response.aiter_content()
+    buffer = b""
+    async for data in chunks:
+        buffer += data
+        if b"\n" in buffer.lstrip():
+            break
+    stripped = buffer.lstrip()
+    line = stripped.split(b"\n", 1)[0].strip()
+    if not line:
+        raise ValueError("上游在返回首行之前结束")
+    first = json_loads(line)
+    if not isinstance(first, dict) or "error" in first:
+        raise ValueError(f"上游首行不是有效数据: {line[:200]!r}")
+    return PrefetchedResponse(response, buffer, chunks)
+
+def should_hedge(request_payload):
+    """
+    是否对这次请求发起对冲。附件是用首个令牌的账号上传的，换另一个令牌的对冲一路引用不到这些文件，
+    带附件的请求不对冲。
+    """
+    return (
+        CONFIG["API"]["HEDGE_REQUESTS"]
+        and not request_payload.get("fileAttachments")
+        and not request_payload.get("imageAttachments")
+    )
+
+async def _open_hedge_leg(request_payload, leg_ctx, headers_ready):
+    """对冲中的一路：发起请求、确认状态码并预读首行，失败或被取消时自行归还连接"""
+    response, session = await open_conversation_async(request_payload, leg_ctx)
+    try:
+        headers_ready.set()
+        if response.status_code != 200:
+            raise UpstreamStatusError(response.status_code)
+        return await read_first_ndjson_line(response), session
+    except BaseException:
+        await close_async_upstream(response, session)
+        raise
+
+async def _discard_hedge_leg(task, leg_ctx):
+    """取消落败的一路并退还它的计数"""
+    if not task.done():
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    elif not task.cancelled() and task.exception() is None:
+        response, session = task.result()
+        await close_async_upstream(response, session)
+    # 退还计数会写共享存储，放到线程池执行
+    await run_blocking(_refund_hedge_leg, leg_ctx)
+
+def _refund_hedge_leg(leg_ctx):
+    """释放落败一路的令牌并退还计数"""
+    if not leg_ctx.holds_token:
+        return
+    leg_ctx.release_token()
+    if token_manager.refund_token(leg_ctx.model, leg_ctx.sso_cookie):
+        hedge_stats["refunded"] += 1
+
+def _settle_failed_hedge_leg(leg_ctx, error):
+    """另一路已经胜出时，按失败类别处理失败一路的令牌；请求本身被拒的情况不影响胜出的结果"""
+    try:
+        handle_attempt_failure(leg_ctx, set(), error=error)
+    except UpstreamRequestRejected:
+        pass
+
+async def open_conversation_hedged(request_payload, ctx, exclude=frozenset()):
+    """
+    对冲版 open_conversation_async，ctx 中已选定并计数了首个令牌。
+    首个令牌在对冲等待时间内没有返回响应头时，换另一个令牌再发一路；先读到合法首行的一路胜出，
+    另一路立即取消并退还计数，只有胜出的令牌计入 RequestFrequency。
+    exclude 中的令牌不会被选为对冲一路。返回 (胜出一路的 ctx, response, session)。
+    对冲一路失败时由这里按失败类别处理；两路都失败时抛出首个令牌的异常，由调用方按普通失败处理。
+    """
+    headers_ready = asyncio.Event()
+    legs = {asyncio.ensure_future(_open_hedge_leg(request_payload, ctx, headers_ready)): ctx}
+    primary = next(iter(legs))
+    try:
+        delay = hedge_delay()
+        waiter = asyncio.ensure_future(headers_ready.wait())
+        try:
+            await asyncio.wait({primary, waiter}, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
 
-        except queue.Empty:
-            # 主动心跳用 SSE 注释，避免客户端按 OpenAI chunk 解析
-            logger.info("30秒无响应，发送主动心跳", "HeartbeatWrapper")
-            last_sent = time.monotonic()
-            yield b": keep-alive\n\n"
+        if not headers_ready.is_set() and not primary.done():
+            hedge_ctx = ctx.fork()
+            try:
+                # 选令牌与计数可能是共享存储的 sqlite 事务，不在事件循环上执行
+                await run_blocking_shielded(acquire_sso_for_attempt, hedge_ctx, ctx.attempt, exclude={ctx.sso_cookie, *exclude})
+            except (ValueError, TokenPoolBusy):
+                logger.info("没有其他可用令牌，不发起对冲请求", "ChatAPI")
+            except asyncio.CancelledError:
+                # 还没登记到 legs 中，由这里退还已选定的令牌
+                await run_blocking(_refund_hedge_leg, hedge_ctx)
+                raise
+            else:
+                hedge_stats["hedged"] += 1
+                logger.info(f"SSO {mask_sso(ctx.sso)} 在 {delay:.2f}s 内未返回响应头，使用 SSO {mask_sso(hedge_ctx.sso)} 发起对冲请求", "ChatAPI")
+                legs[asyncio.ensure_future(_open_hedge_leg(request_payload, hedge_ctx, asyncio.Event()))] = hedge_ctx
+
+        winner = None
+        pending = set(legs)
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    if task is not primary:
+                        await run_blocking(_settle_failed_hedge_leg, legs[task], task.exception())
+                elif winner is None:
+                    winner = task
+                else:
+                    await _discard_hedge_leg(task, legs[task])
+
+        if winner is None:
+            raise primary.exception()
+        for task in pending:
+            await _discard_hedge_leg(task, legs[task])
+        if winner is not primary:
+            hedge_stats["hedge_wins"] += 1
+            # 模型并发名额随请求走，交给胜出的一路，请求结束时由它归还
+            legs[winner].admitted, ctx.admitted = ctx.admitted, False
+            # 对冲一路胜出时首个令牌可能仍未失败，只处理真正失败的
+            if primary.done() and not primary.cancelled() and primary.exception() is not None:
+                await run_blocking(_settle_failed_hedge_leg, ctx, primary.exception())
+        response, session = winner.result()
+        return legs[winner], response, session
+    except BaseException:
+        # 调用方被取消（如客户端断开）时，所有仍在进行的路都取消并退还计数
+        for task, leg_ctx in legs.items():
+            if not task.done():
+                await _discard_hedge_leg(task, leg_ctx)
+        raise
+
+def prepare_request_payload(grok_client, data, ctx):
+    """构造上游请求体；失败时退还首个令牌的计数（还没有真正发起对话）"""
+    try:
+        return grok_client.prepare_chat_request(data, ctx)
+    except Exception:
+        token_manager.refund_token(ctx.model, ctx.sso_cookie)
+        raise
+
+def build_chat_error_response(error, response_status_code):
+    """返回 (响应体, 状态码, 额外响应头)"""
+    if isinstance(error, AdmissionRejected):
+        # 并发已满：快速返回 429，提示客户端多久后重试
+        return {"error": {
+            "message": str(error),
+            "type": "rate_limit_error"
+        }}, 429, {"Retry-After": str(error.retry_after)}
+    # 上游因请求本身拒绝时原样返回其状态码；认证错误或我们主动抛出的错误可以用 400/500，否则用 500
+    if isinstance(error, UpstreamRequestRejected):
+        response_status_code = error.status_code
+    status_code_to_return = response_status_code if response_status_code != 200 else 500
+    return {"error": {
+        "message": str(error),
+        "type": "server_error"
+    }}, status_code_to_return, {}
 
 @app.route('/v1/chat/completions', methods=['POST'])
 def chat_completions():
     response_status_code = 500
+    ctx = None
+    streaming = False
     try:
         # --- 认证逻辑 (与你的版本完全不变) ---
-        auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
-        if auth_token:
-            if CONFIG["API"]["IS_CUSTOM_SSO"]:
-                result = f"sso={auth_token};sso-rw={auth_token}"
-                token_manager.set_token(result) # 注意：自定义SSO模式会覆盖分组逻辑
-            elif auth_token != CONFIG["API"]["API_KEY"]:
-                return jsonify({"error": 'Unauthorized'}), 401
-        else:
-            return jsonify({"error": 'API_KEY缺失'}), 401
+        auth_error = check_chat_authorization(request.headers.get('Authorization', ''))
+        if auth_error:
+            return jsonify({"error": auth_error[0]}), auth_error[1]
 
         # --- 数据准备 (与你的版本完全不变) ---
         data = request.json
@@ -1689,112 +4484,351 @@ def chat_completions():
         stream = data.get("stream", False)
 
         grok_client = GrokApiClient(model)
-        request_payload = grok_client.prepare_chat_request(data)
-        logger.info(f"为模型 {model} 准备的请求体: {json.dumps(request_payload, indent=2)}", "ChatAPI")
+        ctx = RequestContext(model)
+        ctx.priority, ctx.deadline = admission_params(request.headers.get)
+        # 先通过准入并选定首个令牌，饱和时在上传附件之前就快速返回 429，附件也用同一个令牌上传
+        admit_attempt(ctx, 0)
+        request_payload = prepare_request_payload(grok_client, data, ctx)
+        log_request_payload(model, request_payload)
         
         # --- 核心修改：引入带上限的试错循环 ---
-        MAX_SWITCH_ATTEMPTS = 5 
-
+        # 因上游暂时故障失败过的令牌，本请求内不再选取
+        tried = set()
         for attempt in range(MAX_SWITCH_ATTEMPTS):
-            # 1. "偷看"一下当前将要使用的SSO，方便日志记录和出错时移除
-            current_sso_cookie = token_manager.get_next_token_for_model(model, is_return=True)
-            
-            if not current_sso_cookie:
-                raise ValueError(f'模型 {model} 已无可用令牌可供尝试。')
+            if attempt > 0:
+                admit_attempt(ctx, attempt, exclude=tried)
 
-            logger.info(f"第 {attempt + 1}/{MAX_SWITCH_ATTEMPTS} 次尝试，准备使用 SSO: {current_sso_cookie.split(';')[1]}", "ChatAPI")
-
-            # 2. 正式获取SSO并消耗一次计数
-            CONFIG["API"]["SIGNATURE_COOKIE"] = token_manager.get_next_token_for_model(model)
-
-            # --- 准备请求 (这部分是从你的版本里移到循环内部的) ---
-            logger.info(f"当前令牌: {json.dumps(CONFIG['API']['SIGNATURE_COOKIE'], indent=2)}", "Server")
-            logger.info(f"当前可用模型的全部可用数量: {json.dumps(token_manager.get_remaining_token_request_capacity(), indent=2)}", "Server")
-            
-            if CONFIG['SERVER']['CF_CLEARANCE']:
-                CONFIG["SERVER"]['COOKIE'] = f"{CONFIG['API']['SIGNATURE_COOKIE']};{CONFIG['SERVER']['CF_CLEARANCE']}" 
-            else:
-                CONFIG["SERVER"]['COOKIE'] = CONFIG['API']['SIGNATURE_COOKIE']
+            response = None
+            upstream_session = None
+            handed_off = False
+            failure = None
 
             try:
-                proxy_options = Utils.get_proxy_options()
-
-                # --- 发起请求 (与你的版本完全不变) ---
-                def make_grok_request(**request_kwargs):
-                    return curl_requests.post(
-                        f"{CONFIG['API']['BASE_URL']}/rest/app-chat/conversations/new",
-                        data=json.dumps(request_payload),
-                        impersonate="chrome133a",
-                        stream=True,
-                        timeout=(10, 1800), # 加上我们之前讨论的防超时设置
-                        **request_kwargs
-                    )
-
-                response = smart_grok_request_with_fallback(
-                    make_grok_request,
-                    headers={
-                        **get_default_headers(),
-                        "Cookie": CONFIG["SERVER"]['COOKIE']
-                    },
-                    **proxy_options
-                )
+                # --- 发起请求 ---
+                # 上游请求在共享事件循环上发起，复用连接池；流式读取与心跳也不占用额外线程
+                if should_hedge(request_payload):
+                    ctx, response, upstream_session = run_on_stream_loop(open_conversation_hedged(request_payload, ctx, tried))
+                else:
+                    response, upstream_session = run_on_stream_loop(open_conversation_async(request_payload, ctx))
                 
-                logger.info(f"使用 Cookie: {CONFIG['SERVER']['COOKIE']} 发起请求", "Server")
+                logger.info(f"使用 SSO {mask_sso(ctx.sso)} 发起请求", "Server")
 
                 # 3. --- 结果判断与处理 ---
                 if response.status_code == 200:
                     response_status_code = 200
-                    logger.info(f"SSO {current_sso_cookie.split(';')[1]} 请求成功。当前模型剩余可用令牌数: {token_manager.get_token_count_for_model(model)}", "Server")
+                    logger.info(f"SSO {mask_sso(ctx.sso)} 请求成功，上游响应耗时 {ctx.elapsed_ms(ctx.attempt_started_at)}ms。当前模型剩余可用令牌数: {token_manager.get_token_count_for_model(model)}", "Server")
                     
                     # 请求成功，处理响应并立即返回，结束整个函数
                     if stream:
                         # (这里的代码是我们之前修复好的，带主动心跳和反缓冲头的版本)
-                        sse_gen = stream_with_active_heartbeat(handle_stream_response(response, model), interval=10)
+                        handed_off = True
+                        source_stream = _iterate_and_close(handle_stream_response(response, model, ctx), response, upstream_session)
+                        sse_gen = stream_with_active_heartbeat(source_stream, interval=10)
                         resp = Response(stream_with_context(sse_gen), content_type='text/event-stream; charset=utf-8', direct_passthrough=True)
                         resp.headers['Cache-Control'] = 'no-cache, no-transform'
                         resp.headers['Connection'] = 'keep-alive'
                         resp.headers['X-Accel-Buffering'] = 'no'
+                        # 流结束或客户端断开时由 WSGI 服务关闭响应，此时才释放令牌与并发名额
+                        resp.call_on_close(ctx.finish)
+                        streaming = True
                         return resp
                     else:
-                        content = handle_non_stream_response(response, model)
+                        content = run_on_stream_loop(handle_non_stream_response(response, model, ctx))
                         return jsonify(MessageProcessor.create_chat_response(content, model))
 
-                # 如果请求失败，则记录日志，将当前SSO移入冷却池，然后进入下一次循环
-                logger.warning(
-                    f"SSO {current_sso_cookie.split(';')[1]} 请求失败 (状态码: {response.status_code})，将移入冷却池并尝试下一个。",
-                    "ChatAPI"
-                )
-                token_manager.remove_token_from_model(model, current_sso_cookie)
-                # continue 会自动进入 for 循环的下一次迭代
+                # 如果请求失败，按失败类别处理当前SSO，然后进入下一次循环
+                failure = {"status_code": response.status_code}
             
             except Exception as e:
-                logger.error(f"SSO {current_sso_cookie.split(';')[1]} 遭遇请求异常: {e}，将移入冷却池并尝试下一个。", "ChatAPI")
-                token_manager.remove_token_from_model(model, current_sso_cookie)
-                # continue 会自动进入 for 循环的下一次迭代
+                failure = {"error": e}
+            finally:
+                if upstream_session is not None and not handed_off:
+                    run_on_stream_loop(close_async_upstream(response, upstream_session))
+
+            # 请求本身被拒时抛出 UpstreamRequestRejected 直接失败，否则进入 for 循环的下一次迭代
+            handle_attempt_failure(ctx, tried, **failure)
         
         # 如果 for 循环执行了 5 次都失败了，就会走到这里
         raise ValueError(f'已连续尝试 {MAX_SWITCH_ATTEMPTS} 个不同 SSO 均失败，请稍后重试或检查 SSO 池状态。')
 
     except Exception as error:
         logger.error(str(error), "ChatAPI")
-        # 如果是认证错误或我们主动抛出的错误，可以用 400/500，否则用 500
-        status_code_to_return = response_status_code if 'response_status_code' in locals() and response_status_code != 200 else 500
-        return jsonify(
-            {"error": {
-                "message": str(error),
-                "type": "server_error"
-            }}), status_code_to_return
+        body, status_code_to_return, headers = build_chat_error_response(error, response_status_code)
+        return jsonify(body), status_code_to_return, headers
+    finally:
+        if ctx is not None and not streaming:
+            ctx.finish()
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def catch_all(path):
     return 'api运行正常', 200
 
-if __name__ == '__main__':
-    token_manager = AuthTokenManager()
-    initialization()
+# ---------------------------------------------------------------------------
+# ASGI 服务模式（SERVER_MODE=asgi）
+# /v1/chat/completions 走原生 asyncio 链路：上游使用 curl_cffi AsyncSession，
+# 空闲但未结束的流只占用协程而不是线程；其余路由转交给上面的 Flask 应用处理。
+# ---------------------------------------------------------------------------
+
+SSE_RESPONSE_HEADERS = [
+    (b"content-type", b"text/event-stream; charset=utf-8"),
+    (b"cache-control", b"no-cache, no-transform"),
+    (b"connection", b"keep-alive"),
+    (b"x-accel-buffering", b"no"),
+]
+
+class ClientDisconnected(Exception):
+    pass
+
+async def _asgi_read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ClientDisconnected()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return bytes(body)
+
+async def _asgi_send_json(send, payload, status=200, headers=None):
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+            + [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in (headers or {}).items()]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+async def _asgi_send_stream(receive, send, chunks):
+    """
+    下发 SSE 流，同时监听客户端断开；断开时立即取消读取任务，
+    由 chunks 的 finally 逻辑负责关闭上游连接。
+    """
+    await send({"type": "http.response.start", "status": 200, "headers": SSE_RESPONSE_HEADERS})
+
+    async def pump():
+        async for chunk in chunks:
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def wait_disconnect():
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+
+    pump_task = asyncio.ensure_future(pump())
+    disconnect_task = asyncio.ensure_future(wait_disconnect())
+    try:
+        done, _ = await asyncio.wait({pump_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+        if pump_task in done and pump_task.exception():
+            logger.error(f"流式响应发送失败: {pump_task.exception()}", "ASGI")
+        elif pump_task not in done:
+            logger.info("客户端已断开，取消上游流", "ASGI")
+    finally:
+        for task in (pump_task, disconnect_task):
+            task.cancel()
+        await asyncio.gather(pump_task, disconnect_task, return_exceptions=True)
+        await chunks.aclose()
+
+async def asgi_chat_completions(scope, receive, send):
+    response_status_code = 500
+    ctx = None
+    try:
+        headers = {name.decode('latin1'): value.decode('latin1') for name, value in scope["headers"]}
+        auth_error = check_chat_authorization(headers.get('authorization', ''))
+        if auth_error:
+            await _asgi_send_json(send, {"error": auth_error[0]}, auth_error[1])
+            return
+
+        data = json.loads(await _asgi_read_body(receive) or b"{}")
+        model = data.get("model")
+        stream = data.get("stream", False)
+
+        grok_client = GrokApiClient(model)
+        ctx = RequestContext(model)
+        ctx.priority, ctx.deadline = admission_params(headers.get)
+        await admit_attempt_async(ctx, 0)
+        request_payload = await run_blocking(prepare_request_payload, grok_client, data, ctx)
+        log_request_payload(model, request_payload)
+
+        tried = set()
+        for attempt in range(MAX_SWITCH_ATTEMPTS):
+            if attempt > 0:
+                await admit_attempt_async(ctx, attempt, exclude=tried)
+            session = None
+            response = None
+            handed_off = False
+            failure = None
+
+            try:
+                if should_hedge(request_payload):
+                    ctx, response, session = await open_conversation_hedged(request_payload, ctx, tried)
+                else:
+                    response, session = await open_conversation_async(request_payload, ctx)
+
+                logger.info(f"使用 SSO {mask_sso(ctx.sso)} 发起请求", "Server")
+
+                if response.status_code == 200:
+                    response_status_code = 200
+                    logger.info(f"SSO {mask_sso(ctx.sso)} 请求成功，上游响应耗时 {ctx.elapsed_ms(ctx.attempt_started_at)}ms。当前模型剩余可用令牌数: {token_manager.get_token_count_for_model(model)}", "Server")
+
+                    if stream:
+                        handed_off = True
+                        sse_gen = stream_with_active_heartbeat_async(handle_stream_response(response, model, ctx), interval=10)
+                        await _asgi_send_stream(receive, send, _iterate_and_close(sse_gen, response, session))
+                        return
+
+                    content = await handle_non_stream_response(response, model, ctx)
+                    await _asgi_send_json(send, MessageProcessor.create_chat_response(content, model))
+                    return
+
+                failure = {"status_code": response.status_code}
+
+            except Exception as e:
+                if handed_off:
+                    raise
+                failure = {"error": e}
+            finally:
+                if session is not None and not handed_off:
+                    await close_async_upstream(response, session)
+
+            # 退还计数、移入冷却池会写共享存储，放到线程池执行
+            await run_blocking(handle_attempt_failure, ctx, tried, **failure)
+
+        raise ValueError(f'已连续尝试 {MAX_SWITCH_ATTEMPTS} 个不同 SSO 均失败，请稍后重试或检查 SSO 池状态。')
+
+    except ClientDisconnected:
+        logger.info("客户端在请求体读取完成前断开", "ASGI")
+    except Exception as error:
+        logger.error(str(error), "ChatAPI")
+        if response_status_code == 200:
+            # 响应头已经发出，只能记录日志
+            return
+        body, status_code_to_return, error_headers = build_chat_error_response(error, response_status_code)
+        await _asgi_send_json(send, body, status_code_to_return, error_headers)
+    finally:
+        if ctx is not None:
+            ctx.finish()
+
+def _build_wsgi_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin1")
+        value = value.decode("latin1")
+        if name == "content-type":
+            environ["CONTENT_TYPE"] = value
+        elif name == "content-length":
+            environ["CONTENT_LENGTH"] = value
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+def _call_wsgi_app(environ):
+    state = {}
+    body = []
+
+    def start_response(status, headers, exc_info=None):
+        state["status"] = int(status.split(" ", 1)[0])
+        state["headers"] = [(k.lower().encode("latin1"), v.encode("latin1")) for k, v in headers]
+        return body.append
+
+    iterable = app(environ, start_response)
+    try:
+        body.extend(iterable)
+    finally:
+        if hasattr(iterable, "close"):
+            iterable.close()
+    return state["status"], state["headers"], b"".join(body)
+
+async def _asgi_wsgi_fallback(scope, receive, send):
+    """管理后台、令牌接口等低频路由直接复用 Flask 应用，在线程池中执行"""
+    body = await _asgi_read_body(receive)
+    status, headers, content = await run_blocking(_call_wsgi_app, _build_wsgi_environ(scope, body))
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": content})
+
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                record_startup_ready()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] != "http":
+        return
+
+    try:
+        if scope["method"] == "POST" and scope["path"] == "/v1/chat/completions":
+            await asgi_chat_completions(scope, receive, send)
+        else:
+            await _asgi_wsgi_fallback(scope, receive, send)
+    except ClientDisconnected:
+        pass
+
+def record_startup_ready():
+    """记录从模块导入到开始监听端口的耗时"""
+    STARTUP_METRICS["ready_ms"] = round((time.perf_counter() - STARTUP_STARTED_AT) * 1000, 1)
+    logger.info(f"启动完成，耗时 {STARTUP_METRICS['ready_ms']}ms，x_statsig_id 来源: {STARTUP_METRICS['statsig_method']}", "Server")
+
+def run_server():
+    # docker stop 发送 SIGTERM，转换为正常退出以便 atexit 把令牌状态落盘
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    if CONFIG["SERVER"]["MODE"] == "asgi":
+        try:
+            import uvicorn
+        except ImportError:
+            logger.error("SERVER_MODE=asgi 需要安装 uvicorn: pip install uvicorn", "Server")
+            sys.exit(1)
+        workers = CONFIG["SERVER"]["WORKERS"]
+        if workers > 1:
+            if CONFIG["TOKEN_STORE"] == "memory":
+                logger.error("SERVER_WORKERS 大于 1 时需要共享令牌池存储，请设置 TOKEN_STORE=sqlite", "Server")
+                sys.exit(1)
+            logger.info(f"以 ASGI 模式启动服务，工作进程数: {workers}", "Server")
+            # 多进程需要以模块路径启动，每个 worker 各自导入本模块并连接同一个共享存储
+            uvicorn.run(f"{Path(__file__).stem}:asgi_app", host='0.0.0.0', port=CONFIG["SERVER"]["PORT"],
+                        workers=workers, log_level="warning")
+            return
+        logger.info("以 ASGI 模式启动服务", "Server")
+        uvicorn.run(asgi_app, host='0.0.0.0', port=CONFIG["SERVER"]["PORT"], log_level="warning")
+        return
+
+    if CONFIG["SERVER"]["WORKERS"] > 1:
+        logger.warning("Flask 内置服务只支持单进程，多进程请使用 SERVER_MODE=asgi，或 gunicorn -w N app:app 并设置 TOKEN_STORE=sqlite", "Server")
+
+    record_startup_ready()
 
     app.run(
         host='0.0.0.0',
         port=CONFIG["SERVER"]["PORT"],
         debug=False
     )
+
+if __name__ == '__main__':
+    # 令牌管理器已在模块加载时创建并初始化，这里不能再建一个，否则会有两套持久化与过期调度线程
+    run_server()
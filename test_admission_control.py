@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+AdmissionController 准入控制测试
+覆盖优先级与到达顺序、队列已满与截止时间拒绝、换令牌重试不受模型队列影响，
+以及线程与协程共用同一个等待队列
+"""
+
+import os
+import sys
+import time
+import asyncio
+import threading
+from pathlib import Path
+
+import pytest
+
+# 测试不需要后台生成 x_statsig_id
+os.environ.setdefault("STATSIG_PROVISION_BUDGET", "0")
+
+# 添加项目根目录到 Python 路径
+project_root = Path(__file__).parent
+sys.path.insert(0, str(project_root))
+
+import app as grok_app
+from app import AdmissionController, AdmissionRejected, TokenPoolBusy, RequestContext
+
+MODEL = "grok-3"
+
+
+def wait_until(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "等待条件超时"
+        time.sleep(0.005)
+
+
+def waiting(controller):
+    return controller.snapshot()["waiting"].get(MODEL, 0)
+
+
+def start_waiter(controller, results, name, **kwargs):
+    def run():
+        try:
+            results.append(controller.admit(MODEL, lambda: name, **kwargs))
+        except AdmissionRejected:
+            results.append(("rejected", name))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_waiters_wake_by_priority_then_arrival():
+    controller = AdmissionController({MODEL: 1}, 10, 5)
+    controller.admit(MODEL, lambda: None)
+
+    order = []
+    threads = []
+    for index, (name, priority) in enumerate([("a", 5), ("b", 0), ("c", 5), ("d", 0)], start=1):
+        threads.append(start_waiter(controller, order, name, priority=priority))
+        wait_until(lambda: waiting(controller) == index)
+
+    for admitted in range(1, 5):
+        controller.release(MODEL)
+        wait_until(lambda: len(order) == admitted)
+    for thread in threads:
+        thread.join(1)
+
+    assert order == ["b", "d", "a", "c"]
+    assert waiting(controller) == 0
+    assert controller.snapshot()["in_flight"] == {MODEL: 1}
+
+
+def test_full_queue_rejects_immediately():
+    controller = AdmissionController({MODEL: 1}, 1, 5)
+    controller.admit(MODEL, lambda: None)
+    results = []
+    thread = start_waiter(controller, results, "queued")
+    wait_until(lambda: waiting(controller) == 1)
+
+    started = time.monotonic()
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.admit(MODEL, lambda: None)
+    assert time.monotonic() - started < 0.5
+    assert rejected.value.retry_after >= 1
+    assert controller.stats["rejected_full"] == 1
+
+    controller.release(MODEL)
+    thread.join(1)
+    assert results == ["queued"]
+
+
+def test_deadline_expiry_rejects_and_leaves_queue():
+    controller = AdmissionController({MODEL: 1}, 10, 5)
+    controller.admit(MODEL, lambda: None)
+
+    with pytest.raises(AdmissionRejected):
+        controller.admit(MODEL, lambda: None, deadline=time.monotonic() + 0.1)
+    assert controller.stats["rejected_timeout"] == 1
+    assert waiting(controller) == 0
+
+    controller.release(MODEL)
+    assert controller.admit(MODEL, lambda: "next") == "next"
+
+
+def test_new_arrival_does_not_jump_queue():
+    """已有请求在排队时，新到达的请求不直接尝试，即使此刻恰好有令牌空出"""
+    controller = AdmissionController({}, 10, 5)
+    busy = [True]
+
+    def try_acquire():
+        if busy[0]:
+            raise TokenPoolBusy()
+        return "token"
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(controller.admit(MODEL, try_acquire)), daemon=True)
+    thread.start()
+    wait_until(lambda: waiting(controller) == 1)
+
+    busy[0] = False
+    with pytest.raises(AdmissionRejected):
+        controller.admit(MODEL, try_acquire, deadline=time.monotonic())
+
+    controller.notify(MODEL)
+    thread.join(1)
+    assert results == ["token"]
+
+
+def test_retry_bypasses_model_queue_and_stale_deadline():
+    """已占有模型名额的重试不排在等名额的新请求之后，也不受请求开始时计算的截止时间限制"""
+    controller = AdmissionController({MODEL: 1}, 10, 5)
+    controller.admit(MODEL, lambda: None)
+    results = []
+    thread = start_waiter(controller, results, "new")
+    wait_until(lambda: waiting(controller) == 1)
+
+    assert controller.admit(MODEL, lambda: "retry", deadline=time.monotonic() - 60, take_slot=False) == "retry"
+    assert controller.snapshot()["in_flight"] == {MODEL: 1}
+    assert waiting(controller) == 1
+
+    controller.release(MODEL)
+    thread.join(1)
+    assert results == ["new"]
+
+
+def test_retry_is_admitted_even_when_queue_is_full():
+    controller = AdmissionController({MODEL: 1}, 0, 5)
+    controller.admit(MODEL, lambda: None)
+    with pytest.raises(AdmissionRejected):
+        controller.admit(MODEL, lambda: None)
+    assert controller.admit(MODEL, lambda: "retry", take_slot=False) == "retry"
+
+
+def test_admit_attempt_retry_gets_fresh_deadline(monkeypatch):
+    """请求开始时的截止时间早已过去，换令牌时令牌都忙也应等到令牌空出，而不是返回 429"""
+    controller = AdmissionController({MODEL: 1}, 10, 5)
+    monkeypatch.setattr(grok_app, "admission", controller)
+    busy = [False]
+
+    def fake_acquire(ctx, attempt, exclude=None):
+        if busy[0]:
+            raise TokenPoolBusy()
+        return f"sso-{attempt}"
+
+    monkeypatch.setattr(grok_app, "acquire_sso_for_attempt", fake_acquire)
+
+    ctx = RequestContext(MODEL)
+    ctx.deadline = time.monotonic() + 5
+    assert grok_app.admit_attempt(ctx, 0) == "sso-0"
+    assert ctx.admitted
+
+    ctx.deadline = time.monotonic() - 60
+    busy[0] = True
+    results = []
+    thread = threading.Thread(target=lambda: results.append(grok_app.admit_attempt(ctx, 1)), daemon=True)
+    thread.start()
+    wait_until(lambda: waiting(controller) == 1)
+
+    busy[0] = False
+    controller.notify(MODEL)
+    thread.join(1)
+    assert results == ["sso-1"]
+    assert controller.stats["rejected_timeout"] == 0
+
+    ctx.finish()
+    assert not ctx.admitted
+    assert controller.snapshot()["in_flight"] == {}
+
+
+def test_release_is_not_blocked_by_slow_try_acquire():
+    """选令牌在准入锁之外执行，慢的 try_acquire 不会挡住其他请求归还名额与唤醒"""
+    controller = AdmissionController({MODEL: 2}, 10, 5)
+    controller.admit(MODEL, lambda: None)
+    entered = threading.Event()
+    proceed = threading.Event()
+
+    def slow_acquire():
+        entered.set()
+        proceed.wait(2)
+        return "slow"
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(controller.admit(MODEL, slow_acquire)), daemon=True)
+    thread.start()
+    assert entered.wait(1)
+
+    released = threading.Thread(target=controller.release, args=(MODEL,), daemon=True)
+    released.start()
+    released.join(0.5)
+    assert not released.is_alive()
+    assert controller.snapshot()["in_flight"] == {MODEL: 1}
+
+    proceed.set()
+    thread.join(1)
+    assert results == ["slow"]
+    assert controller.snapshot()["in_flight"] == {MODEL: 1}
+
+
+def test_failed_try_acquire_returns_reserved_slot():
+    controller = AdmissionController({MODEL: 1}, 10, 5)
+
+    def broken():
+        raise ValueError("no tokens")
+
+    with pytest.raises(ValueError):
+        controller.admit(MODEL, broken)
+    assert controller.snapshot()["in_flight"] == {}
+    assert controller.admit(MODEL, lambda: "next") == "next"
+
+
+def test_busy_during_release_retries_instead_of_sleeping():
+    """尝试期间恰好有令牌释放（notify），TokenPoolBusy 后不应排队错过这次唤醒"""
+    controller = AdmissionController({}, 10, 5)
+    calls = []
+
+    def try_acquire():
+        calls.append(1)
+        if len(calls) == 1:
+            controller.notify(MODEL)
+            raise TokenPoolBusy()
+        return "token"
+
+    started = time.monotonic()
+    assert controller.admit(MODEL, try_acquire, deadline=time.monotonic() + 2) == "token"
+    assert time.monotonic() - started < 0.5
+    assert controller.stats["queued"] == 0
+
+
+def test_async_waiter_is_woken_by_thread_release():
+    controller = AdmissionController({MODEL: 1}, 10, 5)
+    controller.admit(MODEL, lambda: None)
+
+    async def main():
+        waiter = asyncio.ensure_future(controller.admit_async(MODEL, lambda: "async"))
+        while waiting(controller) != 1:
+            await asyncio.sleep(0.005)
+        threading.Thread(target=controller.release, args=(MODEL,)).start()
+        return await asyncio.wait_for(waiter, 2)
+
+    assert asyncio.run(main()) == "async"
+
+
+def test_async_deadline_expiry_rejects():
+    controller = AdmissionController({MODEL: 1}, 10, 5)
+    controller.admit(MODEL, lambda: None)
+
+    async def main():
+        await controller.admit_async(MODEL, lambda: None, deadline=time.monotonic() + 0.1)
+
+    with pytest.raises(AdmissionRejected):
+        asyncio.run(main())
+    assert waiting(controller) == 0
+
+
+def test_retry_after_follows_recent_completions():
+    now = [1000.0]
+    controller = AdmissionController({MODEL: 1}, 0, 7, clock=lambda: now[0])
+    controller.admit(MODEL, lambda: None)
+
+    def rejected_retry_after():
+        with pytest.raises(AdmissionRejected) as rejected:
+            controller.admit(MODEL, lambda: None)
+        return rejected.value.retry_after
+
+    # 没有完成记录时按排队超时估算
+    assert rejected_retry_after() == 7
+
+    for _ in range(30):
+        controller.release(MODEL)
+        controller.admit(MODEL, lambda: None)
+    # 每分钟完成 30 个，排到下一个名额约需 2 秒
+    assert rejected_retry_after() == 2
+
+    now[0] += 61
+    assert rejected_retry_after() == 7
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
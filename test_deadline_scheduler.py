@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+DeadlineScheduler 测试
+不启动调度线程，用 run_due(now) 驱动，覆盖到期顺序、取消与重新调度
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# 测试不需要后台生成 x_statsig_id
+os.environ.setdefault("STATSIG_PROVISION_BUDGET", "0")
+
+# 添加项目根目录到 Python 路径
+project_root = Path(__file__).parent
+sys.path.insert(0, str(project_root))
+
+from app import DeadlineScheduler
+
+
+def make_scheduler():
+    fired = []
+    scheduler = DeadlineScheduler(lambda keys, now: fired.append((keys, now)), clock=lambda: 0)
+    return scheduler, fired
+
+
+def test_run_due_fires_in_deadline_order():
+    """只执行已到期的任务，按截止时间先后返回"""
+    scheduler, fired = make_scheduler()
+    scheduler.schedule("c", 300)
+    scheduler.schedule("a", 100)
+    scheduler.schedule("b", 200)
+
+    assert scheduler.next_due() == 100
+    assert scheduler.run_due(50) == []
+    assert fired == []
+
+    assert scheduler.run_due(200) == ["a", "b"]
+    assert fired == [(["a", "b"], 200)]
+    assert scheduler.next_due() == 300
+    assert scheduler.run_due(1000) == ["c"]
+    assert scheduler.next_due() is None
+
+
+def test_cancel_drops_pending_task():
+    scheduler, fired = make_scheduler()
+    scheduler.schedule("a", 100)
+    scheduler.schedule("b", 200)
+    scheduler.cancel("a")
+
+    assert scheduler.next_due() == 200
+    assert scheduler.run_due(1000) == ["b"]
+    assert fired == [(["b"], 1000)]
+
+
+def test_cancel_unknown_key_is_noop():
+    scheduler, _ = make_scheduler()
+    scheduler.cancel("missing")
+    assert scheduler.next_due() is None
+    assert scheduler.run_due(1000) == []
+
+
+def test_reschedule_later_uses_last_deadline():
+    """同一个 key 重复调度以最后一次为准，旧的堆项不会触发"""
+    scheduler, _ = make_scheduler()
+    scheduler.schedule("a", 100)
+    scheduler.schedule("a", 500)
+
+    assert scheduler.next_due() == 500
+    assert scheduler.run_due(100) == []
+    assert scheduler.run_due(500) == ["a"]
+    assert scheduler.run_due(1000) == []
+
+
+def test_reschedule_earlier_fires_once():
+    scheduler, _ = make_scheduler()
+    scheduler.schedule("a", 500)
+    scheduler.schedule("a", 100)
+
+    assert scheduler.next_due() == 100
+    assert scheduler.run_due(100) == ["a"]
+    assert scheduler.next_due() is None
+    assert scheduler.run_due(1000) == []
+
+
+def test_schedule_same_deadline_twice_fires_once():
+    scheduler, fired = make_scheduler()
+    scheduler.schedule("a", 100)
+    scheduler.schedule("a", 100)
+
+    assert scheduler.run_due(100) == ["a"]
+    assert fired == [(["a"], 100)]
+
+
+def test_reschedule_after_cancel():
+    scheduler, _ = make_scheduler()
+    scheduler.schedule("a", 100)
+    scheduler.cancel("a")
+    scheduler.schedule("a", 300)
+
+    assert scheduler.run_due(200) == []
+    assert scheduler.run_due(300) == ["a"]
+
+
+def test_run_due_defaults_to_injected_clock():
+    now = [0]
+    fired = []
+    scheduler = DeadlineScheduler(lambda keys, at: fired.append((keys, at)), clock=lambda: now[0])
+    scheduler.schedule("a", 100)
+
+    assert scheduler.run_due() == []
+    now[0] = 150
+    assert scheduler.run_due() == ["a"]
+    assert fired == [(["a"], 150)]
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
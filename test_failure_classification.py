@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+上游失败分类测试
+表驱动：状态码 / 异常 → 失败类别 → 同一令牌上的重试策略与对令牌的处理
+"""
+
+import os
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+# 测试不需要后台生成 x_statsig_id
+os.environ.setdefault("STATSIG_PROVISION_BUDGET", "0")
+
+# 添加项目根目录到 Python 路径
+project_root = Path(__file__).parent
+sys.path.insert(0, str(project_root))
+
+import app as grok_app
+from app import (
+    FAILURE_AUTH, FAILURE_QUOTA, FAILURE_TRANSIENT, FAILURE_PAYLOAD,
+    RequestContext, UpstreamRequestRejected, UpstreamStatusError,
+    classify_upstream_failure, handle_attempt_failure, _plan_upstream_retry
+)
+
+MODEL = "grok-3"
+TOKEN = "sso-rw=aaaaaaaaaaaa;sso=aaaaaaaaaaaa"
+
+
+@pytest.mark.parametrize("status_code, expected", [
+    (200, None),
+    (204, None),
+    (400, FAILURE_PAYLOAD),
+    (401, FAILURE_AUTH),
+    (403, FAILURE_AUTH),
+    (404, FAILURE_PAYLOAD),
+    (408, FAILURE_TRANSIENT),
+    (413, FAILURE_PAYLOAD),
+    (422, FAILURE_PAYLOAD),
+    (425, FAILURE_TRANSIENT),
+    (429, FAILURE_QUOTA),
+    (500, FAILURE_TRANSIENT),
+    (502, FAILURE_TRANSIENT),
+    (503, FAILURE_TRANSIENT),
+    (504, FAILURE_TRANSIENT),
+    (None, None),
+])
+def test_status_code_classification(status_code, expected):
+    assert classify_upstream_failure(status_code=status_code) == expected
+
+
+@pytest.mark.parametrize("error, expected", [
+    (UpstreamStatusError(403), FAILURE_AUTH),
+    (UpstreamStatusError(429), FAILURE_QUOTA),
+    (UpstreamStatusError(502), FAILURE_TRANSIENT),
+    (UpstreamStatusError(400), FAILURE_PAYLOAD),
+    (UpstreamRequestRejected(422, "bad request"), FAILURE_PAYLOAD),
+    (TimeoutError("read timed out"), FAILURE_TRANSIENT),
+    (ConnectionResetError("reset by peer"), FAILURE_TRANSIENT),
+    (ValueError("上游首行不是有效数据"), FAILURE_TRANSIENT),
+])
+def test_exception_classification(error, expected):
+    assert classify_upstream_failure(error=error) == expected
+
+
+class Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+@pytest.mark.parametrize("status_code, statsig_fresh, attempt, expected", [
+    (200, False, 0, None),
+    (403, False, 0, "statsig"),
+    (403, True, 0, None),
+    (403, False, 1, None),
+    (401, False, 0, None),
+    (429, False, 0, None),
+    (500, False, 0, "backoff"),
+    (503, True, 0, "backoff"),
+    (500, False, 1, None),
+    (400, False, 0, None),
+])
+def test_retry_plan_on_same_token(monkeypatch, status_code, statsig_fresh, attempt, expected):
+    refreshed_at = time.monotonic() if statsig_fresh else float("-inf")
+    monkeypatch.setattr(grok_app, "_statsig_refreshed_at", refreshed_at)
+    assert _plan_upstream_retry(Response(status_code), None, attempt, 2) == expected
+
+
+def test_retry_plan_for_network_error():
+    assert _plan_upstream_retry(None, TimeoutError(), 0, 2) == "backoff"
+    assert _plan_upstream_retry(None, TimeoutError(), 1, 2) is None
+
+
+class RecordingTokenManager:
+    """记录 handle_attempt_failure 对令牌做了什么"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        def record(*args, **kwargs):
+            self.calls.append((name, kwargs.get("trip")) if name == "record_token_failure" else name)
+        return record
+
+
+@pytest.mark.parametrize("status_code, error, actions, excluded", [
+    (429, None, ["remove_token_from_model"], False),
+    (401, None, ["refund_token", ("record_token_failure", True)], True),
+    (403, None, ["refund_token", ("record_token_failure", True)], True),
+    (500, None, ["refund_token", ("record_token_failure", False)], True),
+    (None, TimeoutError("timed out"), ["refund_token", ("record_token_failure", False)], True),
+    (None, UpstreamStatusError(502), ["refund_token", ("record_token_failure", False)], True),
+])
+def test_token_action_per_failure_class(monkeypatch, status_code, error, actions, excluded):
+    manager = RecordingTokenManager()
+    monkeypatch.setattr(grok_app, "token_manager", manager)
+    ctx = RequestContext(MODEL, proxy_options={})
+    ctx.use_token(TOKEN)
+    tried = set()
+
+    handle_attempt_failure(ctx, tried, status_code=status_code, error=error)
+    assert manager.calls == actions
+    assert (TOKEN in tried) == excluded
+
+
+@pytest.mark.parametrize("status_code, error", [
+    (400, None),
+    (None, UpstreamStatusError(413)),
+])
+def test_payload_failure_refunds_and_fails_fast(monkeypatch, status_code, error):
+    manager = RecordingTokenManager()
+    monkeypatch.setattr(grok_app, "token_manager", manager)
+    ctx = RequestContext(MODEL, proxy_options={})
+    ctx.use_token(TOKEN)
+    tried = set()
+
+    with pytest.raises(UpstreamRequestRejected) as rejected:
+        handle_attempt_failure(ctx, tried, status_code=status_code, error=error)
+    assert rejected.value.status_code == (status_code or error.status_code)
+    assert manager.calls == ["refund_token"]
+    assert not tried
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+GrokStreamDecoder NDJSON 增量解码测试
+原始字节块可以在任意位置断开（包括多字节字符中间），结果应与整块输入一致；坏行跳过且不影响后续行
+"""
+
+import os
+import sys
+import json
+from pathlib import Path
+
+import pytest
+
+# 测试不需要后台生成 x_statsig_id
+os.environ.setdefault("STATSIG_PROVISION_BUDGET", "0")
+
+# 添加项目根目录到 Python 路径
+project_root = Path(__file__).parent
+sys.path.insert(0, str(project_root))
+
+from app import (
+    GrokStreamDecoder, EVENT_CARD, EVENT_HEARTBEAT, EVENT_IMAGE, EVENT_IMAGE_GEN,
+    EVENT_MODEL_RESPONSE, EVENT_TAGGED_TOKEN, EVENT_THINKING, EVENT_TOKEN
+)
+
+
+def line(response):
+    return json.dumps({"result": {"response": response}}, ensure_ascii=False).encode("utf-8") + b"\n"
+
+
+STREAM = b"".join([
+    line({"token": "", "messageTag": "heartbeat"}),
+    line({"token": "想一想", "isThinking": True}),
+    line({"token": "你好", "messageTag": "final"}),
+    line({"token": "，世界"}),
+    line({"cardAttachment": {"jsonData": json.dumps({"id": "c1", "url": "https://a.example"})}}),
+    line({"token": "步骤", "messageTag": "raw_function_result"}),
+    line({"token": "工具", "messageTag": "tool_usage"}),
+    line({"modelResponse": {"message": "完整回复"}}),
+])
+
+
+def kinds(events):
+    return [(event.kind, event.value) for event in events]
+
+
+def decode(chunks):
+    decoder = GrokStreamDecoder()
+    events = []
+    for chunk in chunks:
+        events.extend(decoder.feed(chunk))
+    events.extend(decoder.feed_eof())
+    return kinds(events), decoder.citations
+
+
+EXPECTED = [
+    (EVENT_HEARTBEAT, None),
+    (EVENT_THINKING, "想一想"),
+    (EVENT_TOKEN, "你好"),
+    (EVENT_TOKEN, "，世界"),
+    (EVENT_CARD, {"id": "c1", "url": "https://a.example"}),
+    (EVENT_THINKING, "步骤"),
+    (EVENT_TAGGED_TOKEN, "工具"),
+    (EVENT_MODEL_RESPONSE, "完整回复"),
+]
+
+
+def test_whole_stream():
+    events, citations = decode([STREAM])
+    assert events == EXPECTED
+    assert citations == {"c1": "https://a.example"}
+
+
+def test_every_two_way_byte_split():
+    for cut in range(1, len(STREAM)):
+        assert decode([STREAM[:cut], STREAM[cut:]])[0] == EXPECTED, cut
+
+
+def test_byte_by_byte():
+    assert decode([STREAM[i:i + 1] for i in range(len(STREAM))])[0] == EXPECTED
+
+
+def test_partial_line_waits_for_newline():
+    decoder = GrokStreamDecoder()
+    data = line({"token": "abc"})
+    assert decoder.feed(data[:-5]) == []
+    assert kinds(decoder.feed(data[-5:])) == [(EVENT_TOKEN, "abc")]
+
+
+def test_last_line_without_newline_needs_eof():
+    decoder = GrokStreamDecoder()
+    assert decoder.feed(line({"token": "tail"})[:-1]) == []
+    assert kinds(decoder.feed_eof()) == [(EVENT_TOKEN, "tail")]
+    assert decoder.feed_eof() == []
+
+
+@pytest.mark.parametrize("bad", [
+    b'{"result": {"response": {"token": "cut',
+    b"not json at all",
+    b"[1, 2, 3]",
+    b'{"error": {"code": 8, "message": "rate limited"}}',
+    b'{"result": {}}',
+    b"   ",
+    b"",
+])
+def test_malformed_lines_are_skipped(bad):
+    data = line({"token": "before"}) + bad + b"\n" + line({"token": "after"})
+    assert decode([data])[0] == [(EVENT_TOKEN, "before"), (EVENT_TOKEN, "after")]
+
+
+def test_crlf_lines():
+    data = line({"token": "a"}).replace(b"\n", b"\r\n") + line({"token": "b"}).replace(b"\n", b"\r\n")
+    assert decode([data])[0] == [(EVENT_TOKEN, "a"), (EVENT_TOKEN, "b")]
+
+
+def test_image_events():
+    data = line({"imageAttachmentInfo": {"progress": 10}}) + line({"cachedImageGenerationResponse": {"imageUrl": "users/x/img.jpg"}})
+    assert decode([data])[0] == [(EVENT_IMAGE_GEN, True), (EVENT_IMAGE, "users/x/img.jpg")]
+
+
+def test_card_without_url_is_not_a_citation():
+    data = line({"cardAttachment": {"jsonData": json.dumps({"id": "c1"})}}) + line({"cardAttachment": {"jsonData": "{broken"}})
+    events, citations = decode([data])
+    assert events == []
+    assert citations == {}
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+GrokTagFilter 流式标签过滤测试
+任意切分输入的结果都应与一次性正则过滤一致；覆盖未闭合的标签与首尾相接的标签
+"""
+
+import os
+import re
+import sys
+from pathlib import Path
+
+import pytest
+
+# 测试不需要后台生成 x_statsig_id
+os.environ.setdefault("STATSIG_PROVISION_BUDGET", "0")
+
+# 添加项目根目录到 Python 路径
+project_root = Path(__file__).parent
+sys.path.insert(0, str(project_root))
+
+from app import GrokTagFilter, Utils
+
+CITATIONS = {"c1": "https://a.example", "c2": "https://b.example"}
+CARD = '<xai:tool_usage_card><xai:tool_name>web_search</xai:tool_name></xai:tool_usage_card>'
+
+
+def render(card_id):
+    return f'<grok:render card_id="{card_id}" type="render_inline_citation"><argument name="citation_id">0</argument></grok:render>'
+
+
+def regex_filter(text, citations=None):
+    """原来的一次性正则实现，作为流式过滤的参照"""
+    text = re.sub(r'\s*<xai:tool_usage_card>.*?</xai:tool_usage_card>\s*', '', text, flags=re.DOTALL)
+    if not citations:
+        return re.sub(r'<grok:render.*?>.*?</grok:render>', ' ', text, flags=re.DOTALL)
+    counter = [1]
+
+    def replace(match):
+        if match.group(1) not in citations:
+            return " [信源信息缺失]"
+        replacement = f" [信源 {counter[0]}]({citations[match.group(1)]})"
+        counter[0] += 1
+        return replacement
+
+    return re.sub(r'<grok:render.*?card_id="([^"]+)".*?>.*?</grok:render>', replace, text, flags=re.DOTALL)
+
+
+def stream(chunks, citations=None):
+    tag_filter = GrokTagFilter(citations)
+    return ''.join(tag_filter.feed(chunk) for chunk in chunks) + tag_filter.flush()
+
+
+CASES = [
+    "plain text without tags",
+    "a < b and c <d> stay",
+    f"before {CARD} after",
+    f"before\n\n{CARD}\n\nafter",
+    f"see{render('c1')} and{render('c2')}.",
+    f"a{render('c1')}{CARD}hello",
+    f"a{render('c1')} {CARD} hello",
+    f"a {CARD}{render('c2')}b",
+    f"{CARD}{CARD}text{render('c1')}{render('missing')}",
+    f"trailing space {render('c1')}   ",
+]
+
+
+@pytest.mark.parametrize("citations", [None, CITATIONS])
+@pytest.mark.parametrize("text", CASES)
+def test_every_two_way_split_matches_regex(text, citations):
+    expected = regex_filter(text, citations)
+    assert stream([text], citations) == expected
+    for cut in range(1, len(text)):
+        assert stream([text[:cut], text[cut:]], citations) == expected, cut
+
+
+@pytest.mark.parametrize("citations", [None, CITATIONS])
+@pytest.mark.parametrize("text", CASES)
+def test_character_by_character_matches_regex(text, citations):
+    assert stream(list(text), citations) == regex_filter(text, citations)
+
+
+def test_render_tag_before_card_keeps_word_boundary():
+    assert Utils.safe_filter_grok_tags(f"a{render('c1')}{CARD}hello") == "a hello"
+    assert Utils.safe_filter_grok_tags(f"a{render('c1')}{CARD}hello", CITATIONS) == "a [信源 1](https://a.example)hello"
+
+
+def test_unclosed_render_is_emitted_on_flush():
+    tag_filter = GrokTagFilter()
+    assert tag_filter.feed("x <grok:render card_id=") == "x"
+    assert tag_filter.feed('"c1"> and more') == ""
+    assert tag_filter.flush() == ' <grok:render card_id="c1"> and more'
+
+
+def test_unclosed_render_still_filters_cards_after_it():
+    text = f"x <grok:render oops {CARD} y"
+    assert stream([text]) == "x <grok:render oopsy"
+
+
+def test_unclosed_render_is_capped():
+    tag_filter = GrokTagFilter()
+    assert tag_filter.feed("a <grok:render ") == "a"
+    filler = "z" * GrokTagFilter.MAX_RENDER_LENGTH
+    out = tag_filter.feed(filler)
+    assert out == " <grok:render " + filler
+    assert len(tag_filter._pending) == 0
+    assert tag_filter.feed(f"{render('c1')}b") == " b"
+
+
+def test_unclosed_card_is_dropped_on_flush():
+    tag_filter = GrokTagFilter()
+    assert tag_filter.feed("a <xai:tool_usage_card>still running") == "a"
+    assert tag_filter.flush() == ""
+
+
+def test_partial_open_tag_at_end_is_emitted_on_flush():
+    tag_filter = GrokTagFilter()
+    assert tag_filter.feed("a<xai:tool") == "a"
+    assert tag_filter.flush() == "<xai:tool"
+
+
+def test_citation_numbers_continue_across_chunks():
+    tag_filter = GrokTagFilter(CITATIONS)
+    first = tag_filter.feed(f"x{render('c1')}")
+    second = tag_filter.feed(f"y{render('c2')}")
+    assert first + second + tag_filter.flush() == "x [信源 1](https://a.example)y [信源 2](https://b.example)"
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+SQLiteTokenStore 共享存储测试
+两个 store 实例打开同一个数据库文件，模拟多个 worker：计数上限、冷却、退还计数与增量同步
+"""
+
+import os
+import sys
+import sqlite3
+import threading
+from pathlib import Path
+
+import pytest
+
+# 测试不需要后台生成 x_statsig_id
+os.environ.setdefault("STATSIG_PROVISION_BUDGET", "0")
+
+# 添加项目根目录到 Python 路径
+project_root = Path(__file__).parent
+sys.path.insert(0, str(project_root))
+
+import app as grok_app
+from app import AuthTokenManager, SQLiteTokenStore
+
+MODEL = "grok-3"
+SSO = "aaaaaaaaaaaaaaaa"
+TOKEN = f"sso-rw={SSO};sso={SSO}"
+NOW = 1_000_000
+
+
+@pytest.fixture
+def stores(tmp_path):
+    path = str(tmp_path / "token_pool.db")
+    first, second = SQLiteTokenStore(path), SQLiteTokenStore(path)
+    first.add(TOKEN, SSO, "normal", [MODEL, "grok-4"], NOW)
+    return first, second
+
+
+def row_of(store, sso=SSO, model=MODEL):
+    _, rows = store.changes_since(-1)
+    return next(row for row in rows if row["sso"] == sso and row["model"] == model)
+
+
+def test_try_acquire_never_exceeds_limit_across_stores(stores):
+    limit = 5
+    results = []
+    lock = threading.Lock()
+
+    def worker(store):
+        for _ in range(10):
+            row = store.try_acquire(SSO, MODEL, limit, NOW)
+            with lock:
+                results.append(row)
+
+    threads = [threading.Thread(target=worker, args=(store,)) for store in stores for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    acquired = [row for row in results if row is not None]
+    assert len(acquired) == limit
+    assert sorted(row["request_count"] for row in acquired) == list(range(1, limit + 1))
+    final = row_of(stores[1])
+    assert final["request_count"] == limit
+    assert not final["is_valid"] and final["invalidated_time"] == NOW
+
+
+def test_expire_is_seen_by_other_store(stores):
+    first, second = stores
+    version, _ = second.changes_since(-1)
+
+    first.expire(SSO, MODEL, NOW + 10)
+    assert second.try_acquire(SSO, MODEL, 5, NOW + 10) is None
+    assert second.try_acquire(SSO, "grok-4", 5, NOW + 10) is not None
+
+    current, rows = second.changes_since(version)
+    assert current == version + 1
+    assert [(row["model"], row["expired_time"]) for row in rows] == [(MODEL, NOW + 10)]
+
+    # 已在冷却中的保持原冷却起点，也不递增 version
+    first.expire(SSO, MODEL, NOW + 20)
+    assert row_of(second)["expired_time"] == NOW + 10
+    assert second.version() == current
+
+
+def test_refund_only_counts_and_keeps_version(stores):
+    first, second = stores
+    assert first.try_acquire(SSO, MODEL, 1, NOW)["is_valid"] == 0
+    version = second.version()
+
+    assert second.refund(SSO, MODEL)
+    row = row_of(first)
+    assert (row["request_count"], row["total_request_count"], row["is_valid"]) == (0, 0, 1)
+    assert first.version() == version
+
+    assert not second.refund(SSO, MODEL), "计数为 0 时不再退还"
+    first.try_acquire(SSO, MODEL, 5, NOW)
+    first.expire(SSO, MODEL, NOW)
+    assert not second.refund(SSO, MODEL), "冷却中的令牌不退还"
+
+
+def test_delete_and_readd_sync_incrementally(stores):
+    first, second = stores
+    version, rows = second.changes_since(-1)
+    assert len(rows) == 2
+
+    first.try_acquire(SSO, MODEL, 5, NOW)
+    first.delete(SSO)
+    version, rows = second.changes_since(version)
+    assert {(row["model"], row["deleted"]) for row in rows} == {(MODEL, 1), ("grok-4", 1)}
+    assert second.rows() == []
+    assert second.try_acquire(SSO, MODEL, 5, NOW) is None
+    assert not second.refund(SSO, MODEL)
+
+    # 重新添加按新令牌重置，其他 store 增量同步到
+    second.add(TOKEN, SSO, "heavy", [MODEL], NOW + 5)
+    version, rows = first.changes_since(version)
+    assert [(row["model"], row["deleted"], row["request_count"], row["type"]) for row in rows] == [(MODEL, 0, 0, "heavy")]
+
+    # 添加已存在的令牌不产生变更
+    first.add(TOKEN, SSO, "normal", [MODEL], NOW + 6)
+    assert first.changes_since(version) == (version, [])
+
+
+def test_reset_due_returns_expired_tokens_to_pool(stores):
+    first, second = stores
+    first.try_acquire(SSO, MODEL, 5, NOW)
+    first.expire(SSO, MODEL, NOW)
+    second.try_acquire(SSO, "grok-4", 5, NOW)
+
+    expirations = [(MODEL, "normal", 100), ("grok-4", "normal", 200)]
+    assert second.reset_due(NOW + 99, expirations) == 0
+    assert second.reset_due(NOW + 100, expirations) == 1
+    row = row_of(first)
+    assert (row["expired_time"], row["request_count"], row["added_time"]) == (None, 0, NOW + 100)
+    assert row_of(first, model="grok-4")["request_count"] == 1
+
+    assert first.reset_due(NOW + 200, expirations) == 1
+    assert row_of(second, model="grok-4")["request_count"] == 0
+
+
+def test_old_schema_is_migrated(tmp_path):
+    path = str(tmp_path / "token_pool.db")
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE token_pool (
+            sso TEXT NOT NULL, model TEXT NOT NULL, token TEXT NOT NULL, type TEXT NOT NULL,
+            request_count INTEGER NOT NULL DEFAULT 0, total_request_count INTEGER NOT NULL DEFAULT 0,
+            start_call_time INTEGER, added_time INTEGER NOT NULL, is_valid INTEGER NOT NULL DEFAULT 1,
+            invalidated_time INTEGER, expired_time INTEGER, PRIMARY KEY (sso, model)
+        )
+    """)
+    conn.execute("INSERT INTO token_pool (sso, model, token, type, added_time) VALUES (?, ?, ?, 'normal', ?)", (SSO, MODEL, TOKEN, NOW))
+    conn.commit()
+    conn.close()
+
+    store = SQLiteTokenStore(path)
+    _, rows = store.changes_since(-1)
+    assert [(row["sso"], row["row_version"], row["deleted"]) for row in rows] == [(SSO, 0, 0)]
+    assert store.try_acquire(SSO, MODEL, 5, NOW) is not None
+
+
+def test_managers_share_state_through_store(tmp_path, monkeypatch):
+    """两个 AuthTokenManager 模拟两个 worker：一个添加、计数、删除，另一个同步到"""
+    monkeypatch.setitem(grok_app.CONFIG, "TOKEN_STORE", "sqlite")
+    monkeypatch.setitem(grok_app.CONFIG, "TOKEN_STORE_PATH", str(tmp_path / "token_pool.db"))
+    monkeypatch.setitem(grok_app.CONFIG, "TOKEN_STATUS_FILE", str(tmp_path / "token_status.json"))
+    monkeypatch.setitem(grok_app.CONFIG, "TOKEN_STATUS_JOURNAL", False)
+    first, second = AuthTokenManager(), AuthTokenManager()
+
+    first.add_token(TOKEN)
+    assert second.get_next_token_for_model(MODEL) == TOKEN
+    second.release_in_flight(TOKEN)
+    assert row_of(first.store)["request_count"] == 1
+
+    assert first.get_next_token_for_model(MODEL) == TOKEN
+    first.release_in_flight(TOKEN)
+    assert row_of(second.store)["request_count"] == 2
+
+    first.delete_token(TOKEN)
+    assert second.get_next_token_for_model(MODEL) is None
+
+    second.add_token(TOKEN)
+    assert first.get_next_token_for_model(MODEL) == TOKEN
+    first.release_in_flight(TOKEN)
+    for manager in (first, second):
+        manager.persister.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
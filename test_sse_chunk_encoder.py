@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+SSEChunkEncoder 测试
+预先拼好的前后缀加上逐块转义的 content，必须与完整序列化的 OpenAI chunk 等价，且每帧恰好是一个 SSE 事件
+"""
+
+import os
+import sys
+import json
+from pathlib import Path
+
+import pytest
+
+# 测试不需要后台生成 x_statsig_id
+os.environ.setdefault("STATSIG_PROVISION_BUDGET", "0")
+
+# 添加项目根目录到 Python 路径
+project_root = Path(__file__).parent
+sys.path.insert(0, str(project_root))
+
+from app import SSEChunkEncoder
+
+MODEL = "grok-3"
+
+
+def parse_frame(frame):
+    """校验 SSE 帧格式并返回其中的 JSON"""
+    assert isinstance(frame, bytes)
+    assert frame.startswith(b"data: ")
+    assert frame.endswith(b"\n\n")
+    body = frame[len(b"data: "):-2]
+    assert b"\n" not in body and b"\r" not in body, "数据中的换行必须被转义，否则会提前结束 SSE 事件"
+    return json.loads(body.decode("utf-8"))
+
+
+@pytest.mark.parametrize("content", [
+    "hello",
+    "",
+    "你好，世界 🌍",
+    'quotes " and \\ backslash',
+    "line\nbreaks\r\n\n\ndata: fake frame\n\n",
+    "control \x00 \x1f \t chars",
+    "</script><grok:render>",
+    "  ",
+])
+def test_content_frame_matches_full_serialization(content):
+    encoder = SSEChunkEncoder(MODEL)
+    assert parse_frame(encoder.encode(content)) == {
+        "id": encoder.id,
+        "object": "chat.completion.chunk",
+        "created": encoder.created,
+        "model": MODEL,
+        "choices": [{"index": 0, "delta": {"content": content}}]
+    }
+
+
+def test_role_and_stop_frames():
+    encoder = SSEChunkEncoder(MODEL)
+    role = parse_frame(encoder.role_frame())
+    stop = parse_frame(encoder.stop_frame())
+    assert role["choices"] == [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]
+    assert stop["choices"] == [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+    for frame in (role, stop):
+        assert (frame["id"], frame["object"], frame["created"], frame["model"]) == (
+            encoder.id, "chat.completion.chunk", encoder.created, MODEL
+        )
+
+
+def test_stream_shares_one_id_and_streams_differ():
+    first, second = SSEChunkEncoder(MODEL), SSEChunkEncoder(MODEL)
+    ids = {parse_frame(first.encode(str(index)))["id"] for index in range(3)}
+    assert ids == {first.id}
+    assert first.id.startswith("chatcmpl-")
+    assert first.id != second.id
+
+
+def test_model_name_is_escaped():
+    model = 'weird "model"\nname'
+    assert parse_frame(SSEChunkEncoder(model).encode("x"))["model"] == model
+
+
+def test_concatenated_frames_split_into_events():
+    encoder = SSEChunkEncoder(MODEL)
+    contents = ["a\n\nb", "", "c"]
+    stream = encoder.role_frame() + b"".join(encoder.encode(content) for content in contents) + encoder.stop_frame()
+    events = stream.split(b"\n\n")
+    assert events[-1] == b""
+    frames = [parse_frame(event + b"\n\n") for event in events[:-1]]
+    assert [frame["choices"][0]["delta"].get("content") for frame in frames[1:-1]] == contents
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
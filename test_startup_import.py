@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+启动测试：配置了 SSO 时在子进程中导入 app.py
+模块级的 initialization() 会加载令牌并写日志，它用到的函数都必须在调用之前定义
+"""
+
+import os
+import sys
+import subprocess
+from pathlib import Path
+
+import pytest
+
+project_root = Path(__file__).parent
+
+SSO_TOKENS = ["startuptokenaaaaaaaaaaaa", "startuptokenbbbbbbbbbbbb"]
+
+
+def import_app(data_dir, **env):
+    environment = {
+        **os.environ,
+        "DATA_DIR": str(data_dir),
+        "STATSIG_PROVISION_BUDGET": "0",
+        "SSO": ",".join(SSO_TOKENS),
+        "SSO_HEAVY": "",
+        **env
+    }
+    environment.pop("TOKEN_STORE_PATH", None)
+    return subprocess.run(
+        [sys.executable, "-c", "import app"],
+        cwd=project_root, env=environment, capture_output=True, text=True, timeout=60
+    )
+
+
+def test_import_with_sso_configured(tmp_path):
+    result = import_app(tmp_path, TOKEN_STORE="memory")
+    output = result.stdout + result.stderr
+    assert result.returncode == 0, output
+    assert "令牌加载完成，共加载: 2个令牌" in output
+    for token in SSO_TOKENS:
+        assert token not in output, "日志中不应出现完整的 SSO"
+
+
+def test_import_with_tokens_already_in_sqlite_store(tmp_path):
+    first = import_app(tmp_path, TOKEN_STORE="sqlite")
+    assert first.returncode == 0, first.stdout + first.stderr
+    assert (tmp_path / "token_pool.db").exists()
+
+    second = import_app(tmp_path, TOKEN_STORE="sqlite")
+    output = second.stdout + second.stderr
+    assert second.returncode == 0, output
+    for token in SSO_TOKENS:
+        assert token not in output
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
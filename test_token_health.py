@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+TokenHealthTracker 熔断测试
+注入时钟，覆盖 熔断 → 半开探测 → 恢复 / 重新熔断 的完整过程
+"""
+
+import os
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+# 测试不需要后台生成 x_statsig_id
+os.environ.setdefault("STATSIG_PROVISION_BUDGET", "0")
+
+# 添加项目根目录到 Python 路径
+project_root = Path(__file__).parent
+sys.path.insert(0, str(project_root))
+
+from app import AuthTokenManager, TokenHealthTracker
+
+MODEL = "grok-3"
+TOKEN = "sso-rw=a;sso=a"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_tracker(threshold=3, base_cooldown=30, max_cooldown=100):
+    clock = FakeClock()
+    return TokenHealthTracker(threshold, base_cooldown, max_cooldown, clock=clock), clock
+
+
+def test_transient_failures_trip_at_threshold():
+    tracker, clock = make_tracker()
+    assert tracker.record_failure(MODEL, TOKEN) is None
+    assert tracker.record_failure(MODEL, TOKEN) is None
+    assert tracker.state(MODEL, TOKEN) == "closed"
+    assert tracker.admits(MODEL, TOKEN, clock())
+
+    assert tracker.record_failure(MODEL, TOKEN) == 30
+    assert tracker.state(MODEL, TOKEN) == "open"
+    assert not tracker.admits(MODEL, TOKEN, clock())
+
+
+def test_success_resets_consecutive_failures():
+    tracker, _ = make_tracker()
+    tracker.record_failure(MODEL, TOKEN)
+    tracker.record_failure(MODEL, TOKEN)
+    tracker.record_success(MODEL, TOKEN, 200)
+    assert tracker.record_failure(MODEL, TOKEN) is None
+    assert tracker.state(MODEL, TOKEN) == "closed"
+
+
+def test_auth_failure_trips_immediately():
+    tracker, clock = make_tracker()
+    assert tracker.record_failure(MODEL, TOKEN, trip=True) == 30
+    assert not tracker.admits(MODEL, TOKEN, clock())
+
+
+def test_half_open_admits_single_probe_then_closes():
+    tracker, clock = make_tracker()
+    tracker.record_failure(MODEL, TOKEN, trip=True)
+
+    clock.now += 29
+    assert tracker.state(MODEL, TOKEN) == "open"
+    assert not tracker.admits(MODEL, TOKEN, clock())
+
+    clock.now += 1
+    assert tracker.state(MODEL, TOKEN) == "half_open"
+    assert tracker.admits(MODEL, TOKEN, clock())
+    # 半开令牌优先被选中去探测
+    assert tracker.score(MODEL, TOKEN) < tracker.score(MODEL, "sso-rw=b;sso=b")
+
+    tracker.on_selected(MODEL, TOKEN, clock())
+    assert not tracker.admits(MODEL, TOKEN, clock()), "探测进行中不应再放行其他请求"
+
+    assert tracker.record_success(MODEL, TOKEN, 150) is True
+    assert tracker.state(MODEL, TOKEN) == "closed"
+    assert tracker.admits(MODEL, TOKEN, clock())
+    assert tracker.record_failure(MODEL, TOKEN) is None, "恢复后连续失败计数应重新开始"
+
+
+def test_failed_probe_reopens_with_doubled_cooldown():
+    tracker, clock = make_tracker(base_cooldown=30, max_cooldown=100)
+    assert tracker.record_failure(MODEL, TOKEN, trip=True) == 30
+
+    clock.now += 30
+    tracker.on_selected(MODEL, TOKEN, clock())
+    assert tracker.record_failure(MODEL, TOKEN) == 60
+    assert tracker.state(MODEL, TOKEN) == "open"
+
+    clock.now += 60
+    tracker.on_selected(MODEL, TOKEN, clock())
+    assert tracker.record_failure(MODEL, TOKEN) == 100, "冷却时间不超过上限"
+
+    clock.now += 100
+    tracker.on_selected(MODEL, TOKEN, clock())
+    tracker.record_success(MODEL, TOKEN, 100)
+    assert tracker.record_failure(MODEL, TOKEN, trip=True) == 30, "恢复后冷却时间从基数重新开始"
+
+
+def test_failures_while_open_do_not_extend_cooldown():
+    """熔断前发出的请求在熔断期间才失败，只计数，不延长冷却"""
+    tracker, clock = make_tracker()
+    tracker.record_failure(MODEL, TOKEN, trip=True)
+    assert tracker.record_failure(MODEL, TOKEN) is None
+    assert tracker.record_failure(MODEL, TOKEN, trip=True) is None
+
+    clock.now += 30
+    assert tracker.state(MODEL, TOKEN) == "half_open"
+
+
+def test_lost_probe_is_replaced_after_timeout():
+    tracker, clock = make_tracker()
+    tracker.record_failure(MODEL, TOKEN, trip=True)
+    clock.now += 30
+    tracker.on_selected(MODEL, TOKEN, clock())
+
+    clock.now += TokenHealthTracker.PROBE_TIMEOUT - 1
+    assert not tracker.admits(MODEL, TOKEN, clock())
+    clock.now += 1
+    assert tracker.admits(MODEL, TOKEN, clock())
+
+
+def test_forget_clears_state():
+    tracker, clock = make_tracker()
+    tracker.record_failure(MODEL, TOKEN, trip=True)
+    tracker.forget(TOKEN)
+    assert tracker.state(MODEL, TOKEN) == "closed"
+    assert tracker.admits(MODEL, TOKEN, clock())
+    assert tracker.snapshot() == {}
+
+
+def test_recording_does_not_wait_for_token_manager_lock():
+    """事件循环上记录耗时只取健康数据自己的锁，不等待持有管理器锁的选令牌或存储操作"""
+    manager = AuthTokenManager()
+    with manager._lock:
+        worker = threading.Thread(target=lambda: (
+            manager.record_token_success(MODEL, TOKEN, 120),
+            manager.record_token_ttft(MODEL, TOKEN, 80),
+            manager.record_token_failure(MODEL, TOKEN)
+        ), daemon=True)
+        worker.start()
+        worker.join(1)
+        assert not worker.is_alive()
+    [summary] = manager.get_health_summary()[MODEL].values()
+    assert summary["successes"] == 1 and summary["failures"] == 1
+    assert summary["ttft_ms"] == 80
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
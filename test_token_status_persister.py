@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+TokenStatusPersister 持久化测试
+覆盖日志重放、写盘前日志轮转为 .old、写盘失败后的恢复，以及快照文件的原子替换
+"""
+
+import os
+import sys
+import json
+import threading
+from pathlib import Path
+
+import pytest
+
+# 测试不需要后台生成 x_statsig_id
+os.environ.setdefault("STATSIG_PROVISION_BUDGET", "0")
+
+# 添加项目根目录到 Python 路径
+project_root = Path(__file__).parent
+sys.path.insert(0, str(project_root))
+
+import app as grok_app
+from app import TokenStatusPersister
+
+STATUS = {"isValid": True, "invalidatedTime": None, "totalRequestCount": 1, "type": "normal"}
+
+
+class Store:
+    """模拟 AuthTokenManager：状态字典与保护它的锁"""
+
+    def __init__(self, tmp_path, status_map=None):
+        self.status_map = status_map or {}
+        self.lock = threading.RLock()
+        self.file_path = tmp_path / "token_status.json"
+        self.persister = TokenStatusPersister(
+            str(self.file_path), lambda: json.loads(json.dumps(self.status_map)), self.lock,
+            interval=3600, journal_path=str(tmp_path / "token_status.journal")
+        )
+
+    def set(self, sso, model, count):
+        with self.lock:
+            status = self.status_map.setdefault(sso, {})[model] = dict(STATUS, totalRequestCount=count)
+            self.persister.record(sso, model, status)
+
+    def delete(self, sso):
+        with self.lock:
+            self.status_map.pop(sso, None)
+            self.persister.record(sso, deleted=True)
+
+    def reload(self, tmp_path):
+        return TokenStatusPersister(
+            str(self.file_path), dict, threading.RLock(),
+            journal_path=str(tmp_path / "token_status.journal")
+        ).load()
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = Store(tmp_path)
+    yield store
+    store.persister.stop()
+
+
+def journal_lines(path):
+    return Path(path).read_text(encoding="utf-8").splitlines() if Path(path).exists() else []
+
+
+def test_load_without_files_returns_none(store, tmp_path):
+    assert store.reload(tmp_path) is None
+
+
+def test_journal_replays_on_top_of_snapshot(store, tmp_path):
+    store.file_path.write_text(json.dumps({"a": {"grok-3": dict(STATUS, totalRequestCount=5)}, "b": {}}), encoding="utf-8")
+    store.set("a", "grok-3", 6)
+    store.set("a", "grok-3", 7)
+    store.set("c", "grok-4", 1)
+    store.delete("b")
+
+    loaded = store.reload(tmp_path)
+    assert loaded["a"]["grok-3"]["totalRequestCount"] == 7
+    assert loaded["c"]["grok-4"]["totalRequestCount"] == 1
+    assert "b" not in loaded
+
+
+def test_replay_is_idempotent_and_skips_torn_line(store, tmp_path):
+    store.set("a", "grok-3", 3)
+    store.set("a", "grok-3", 4)
+    with open(store.persister.journal_path, "a", encoding="utf-8") as f:
+        f.write('{"sso": "a", "model": "grok-3", "sta')
+
+    first = store.reload(tmp_path)
+    second = store.reload(tmp_path)
+    assert first == second == {"a": {"grok-3": dict(STATUS, totalRequestCount=4)}}
+
+
+def test_flush_writes_snapshot_and_drops_journals(store, tmp_path):
+    store.set("a", "grok-3", 2)
+    assert journal_lines(store.persister.journal_path)
+
+    store.persister.flush()
+    assert json.loads(store.file_path.read_text(encoding="utf-8")) == store.status_map
+    assert not Path(store.persister.journal_path).exists()
+    assert not Path(store.persister.rotated_journal_path).exists()
+    assert not Path(f"{store.file_path}.tmp").exists()
+
+    # 写盘后的变更写入新的日志
+    store.set("a", "grok-3", 3)
+    assert len(journal_lines(store.persister.journal_path)) == 1
+    assert store.reload(tmp_path)["a"]["grok-3"]["totalRequestCount"] == 3
+
+
+def test_failed_snapshot_keeps_rotated_journal(store, tmp_path, monkeypatch):
+    store.set("a", "grok-3", 1)
+    store.persister.flush()
+    store.set("a", "grok-3", 2)
+
+    real_replace = os.replace
+
+    def failing_replace(src, dst):
+        if str(dst) == str(store.file_path):
+            raise OSError("disk full")
+        return real_replace(src, dst)
+
+    monkeypatch.setattr(grok_app.os, "replace", failing_replace)
+    store.persister.flush()
+    assert store.persister._dirty
+
+    # 快照文件保持上一次完整写入的内容，未落盘的变更在 .old 中
+    assert json.loads(store.file_path.read_text(encoding="utf-8"))["a"]["grok-3"]["totalRequestCount"] == 1
+    assert len(journal_lines(store.persister.rotated_journal_path)) == 1
+    assert not Path(store.persister.journal_path).exists()
+
+    # 再次失败时当前日志追加到 .old，而不是覆盖
+    store.set("a", "grok-3", 3)
+    store.persister.flush()
+    assert len(journal_lines(store.persister.rotated_journal_path)) == 2
+    assert store.reload(tmp_path)["a"]["grok-3"]["totalRequestCount"] == 3
+
+    # .old 与当前日志都存在时按先后顺序重放
+    store.set("a", "grok-3", 4)
+    assert store.reload(tmp_path)["a"]["grok-3"]["totalRequestCount"] == 4
+
+    monkeypatch.setattr(grok_app.os, "replace", real_replace)
+    store.persister.flush()
+    assert not Path(store.persister.rotated_journal_path).exists()
+    assert not Path(store.persister.journal_path).exists()
+    assert store.reload(tmp_path)["a"]["grok-3"]["totalRequestCount"] == 4
+
+
+def test_flush_without_changes_does_not_write(store):
+    store.persister.flush()
+    assert not store.file_path.exists()
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+UploadBatch 测试
+每个请求的并发上传数各自受限，附件多的请求不会占满共享线程池
+"""
+
+import os
+import sys
+import time
+import threading
+import concurrent.futures
+from pathlib import Path
+
+import pytest
+
+# 测试不需要后台生成 x_statsig_id
+os.environ.setdefault("STATSIG_PROVISION_BUDGET", "0")
+
+# 添加项目根目录到 Python 路径
+project_root = Path(__file__).parent
+sys.path.insert(0, str(project_root))
+
+from app import UploadBatch
+
+
+@pytest.fixture
+def executor():
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    yield pool
+    pool.shutdown(wait=True)
+
+
+def test_limit_applies_per_request(executor):
+    batch = UploadBatch(executor, 2)
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def upload(index):
+        with lock:
+            running[0] += 1
+            running[1] = max(running[1], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+        return index
+
+    futures = [batch.submit(upload, index) for index in range(6)]
+    assert [future.result(1) for future in futures] == list(range(6))
+    assert running[1] == 2
+
+
+def test_busy_request_does_not_block_another(executor):
+    """一个请求的上传卡住时，另一个请求仍能立即拿到线程"""
+    release = threading.Event()
+    busy = UploadBatch(executor, 2)
+    stuck = [busy.submit(release.wait, 2) for _ in range(2)]
+
+    started = time.monotonic()
+    assert UploadBatch(executor, 2).submit(lambda: "other").result(1) == "other"
+    assert time.monotonic() - started < 0.5
+
+    release.set()
+    for future in stuck:
+        future.result(1)
+
+
+def test_failed_upload_returns_slot(executor):
+    batch = UploadBatch(executor, 1)
+
+    def broken():
+        raise ValueError("upload failed")
+
+    with pytest.raises(ValueError):
+        batch.submit(broken).result(1)
+    assert batch.submit(lambda: "next").result(1) == "next"
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -9,14 +9,163 @@ import secrets
 import requests
 import re
 import json
-from typing import Optional, Dict, Any
+import os
+import threading
+from typing import Optional, Dict, Any, Tuple
+
+
+class MetaContentCache:
+    """
+    进程内共享的 meta 内容与浏览器指纹哈希缓存
+
+    meta 内容几乎不会变化，获取一次后在有效期内直接复用；过期后先继续返回旧值，
+    同时在后台线程刷新。磁盘上保留一份副本，重启后无需再次探测网络。
+    网络探测全部失败时得到的是预设内容，只缓存较短时间，以便尽快重试。
+    """
+
+    FALLBACK_TTL = 300
+
+    def __init__(self, ttl: float = 21600, path: Optional[str] = None):
+        self.ttl = ttl
+        self.path = path
+        self._lock = threading.Lock()
+        self._entry = None
+        self._loaded = False
+        self._refreshing = False
+        self.hits = 0
+        self.fetches = 0
+
+    def configure(self, ttl: Optional[float] = None, path: Optional[str] = None):
+        """设置有效期与持久化文件路径，需在首次生成前调用"""
+        with self._lock:
+            if ttl is not None:
+                self.ttl = ttl
+            if path is not None and path != self.path:
+                self.path = path
+                self._loaded = False
+
+    def _entry_ttl(self, entry: Dict[str, Any]) -> float:
+        if entry["source"] == "network":
+            return self.ttl
+        return min(self.ttl, self.FALLBACK_TTL)
+
+    def _is_fresh(self, entry: Dict[str, Any]) -> bool:
+        return time.time() - entry["fetched_at"] < self._entry_ttl(entry)
+
+    def _load(self):
+        self._loaded = True
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            meta = bytes.fromhex(data["meta"])
+            if len(meta) == 48 and data.get("fingerprint"):
+                self._entry = {
+                    "meta": meta,
+                    "fingerprint": data["fingerprint"],
+                    "fetched_at": float(data["fetched_at"]),
+                    "source": data.get("source", "network")
+                }
+        except Exception as e:
+            print(f"⚠️  读取 meta 缓存失败: {e}")
+
+    def _save(self, entry: Dict[str, Any]):
+        if not self.path:
+            return
+        try:
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    "meta": entry["meta"].hex(),
+                    "fingerprint": entry["fingerprint"],
+                    "fetched_at": entry["fetched_at"],
+                    "source": entry["source"]
+                }, f)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            print(f"⚠️  写入 meta 缓存失败: {e}")
+
+    def _fetch(self, generator: "XStatsigIDGenerator") -> Dict[str, Any]:
+        meta = generator.get_grok_meta_content()
+        entry = {
+            "meta": meta,
+            "fingerprint": generator.generate_browser_fingerprint(),
+            "fetched_at": time.time(),
+            "source": generator.meta_source
+        }
+        self.fetches += 1
+        self._entry = entry
+        self._save(entry)
+        return entry
+
+    def _refresh_in_background(self):
+        try:
+            with self._lock:
+                self._fetch(XStatsigIDGenerator())
+        finally:
+            self._refreshing = False
+
+    def get(self, generator: "XStatsigIDGenerator") -> Tuple[bytes, str]:
+        """
+        返回 (meta 内容, 指纹哈希)
+
+        只有在从未获取过（内存和磁盘都没有）时才在当前线程探测网络，
+        并发的首次调用只会有一个真正发起探测。
+        """
+        entry = self._entry
+        if entry is None:
+            with self._lock:
+                if not self._loaded:
+                    self._load()
+                entry = self._entry or self._fetch(generator)
+        if not self._is_fresh(entry) and not self._refreshing:
+            self._refreshing = True
+            threading.Thread(target=self._refresh_in_background, name="statsig-meta-refresh", daemon=True).start()
+        self.hits += 1
+        return entry["meta"], entry["fingerprint"]
+
+    def snapshot(self) -> Dict[str, Any]:
+        entry = self._entry
+        return {
+            "source": entry["source"] if entry else None,
+            "age": round(time.time() - entry["fetched_at"], 1) if entry else None,
+            "ttl": self._entry_ttl(entry) if entry else self.ttl,
+            "fresh": self._is_fresh(entry) if entry else False,
+            "hits": self.hits,
+            "fetches": self.fetches
+        }
+
+
+# 进程内唯一的缓存实例，所有生成器共享
+meta_cache = MetaContentCache()
+
+# 256 个异或查表，bytes.translate 一次完成整段 payload 的异或
+_XOR_TABLES = [bytes(b ^ key for b in range(256)) for key in range(256)]
+
+# 解码后的总长度：异或key + meta(48) + 时间戳(4) + SHA256片段(16) + 固定值(1)
+_DECODED_LENGTH = 1 + 48 + 4 + 16 + 1
+
 
 class XStatsigIDGenerator:
     """x-statsig-id 生成器"""
     
-    def __init__(self):
+    def __init__(self, deadline: Optional[float] = None):
         self.base_timestamp = int(time.time())  # 使用当前系统时间
         self.grok_url = "https://grok.com"
+        # 获取 meta 内容的截止时间（time.monotonic()），超过后不再发起新的网络探测
+        self.deadline = deadline
+        # 最近一次 get_grok_meta_content 的结果来源：network 或 fallback
+        self.meta_source = None
+
+    def _budget(self, seconds: float) -> float:
+        """把单次探测的超时限制在剩余时间预算内，预算耗尽时抛出 TimeoutError"""
+        if self.deadline is None:
+            return seconds
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("meta 内容获取超出时间预算")
+        return max(1, min(seconds, int(remaining)))
         
     def get_grok_meta_content(self) -> bytes:
         """
@@ -39,10 +188,15 @@ class XStatsigIDGenerator:
         ]
 
         for i, strategy in enumerate(strategies):
+            # 预算耗尽时跳过剩余的网络策略，只保留不需要网络的预设内容
+            if self.deadline is not None and time.monotonic() >= self.deadline and strategy != self._try_cached_content:
+                print(f"   跳过策略 {i+1}: 超出时间预算")
+                continue
             try:
                 print(f"   尝试策略 {i+1}: {strategy.__name__}")
                 result = strategy()
                 if result:
+                    self.meta_source = "fallback" if strategy == self._try_cached_content else "network"
                     return result
             except Exception as e:
                 print(f"   策略 {i+1} 失败: {e}")
@@ -50,6 +204,7 @@ class XStatsigIDGenerator:
 
         # 所有策略都失败，使用备用内容
         print("   ❌ 所有策略都失败，使用备用meta内容")
+        self.meta_source = "fallback"
         fallback = b"backup-grok-meta-content-when-request-fails-ok"
         return fallback + b'\x00' * (48 - len(fallback))
 
@@ -66,8 +221,9 @@ class XStatsigIDGenerator:
 
         for proxy in proxies:
             try:
+                timeout = self._budget(15)
                 curl_command = [
-                    'curl', '-s', '-L', '--max-time', '15',
+                    'curl', '-s', '-L', '--max-time', str(timeout),
                     '--user-agent', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
                     '--header', 'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
                     '--header', 'Accept-Language: en-US,en;q=0.5',
@@ -82,7 +238,7 @@ class XStatsigIDGenerator:
 
                 curl_command.append(self.grok_url)
 
-                result = subprocess.run(curl_command, capture_output=True, text=True, timeout=15)
+                result = subprocess.run(curl_command, capture_output=True, text=True, timeout=timeout)
 
                 if result.returncode == 0 and len(result.stdout) > 1000:
                     print(f"      ✅ curl成功 (代理: {proxy or '无'})")
@@ -106,8 +262,9 @@ class XStatsigIDGenerator:
 
         for ua in user_agents:
             try:
+                timeout = self._budget(10)
                 curl_command = [
-                    'curl', '-s', '-L', '--max-time', '10',
+                    'curl', '-s', '-L', '--max-time', str(timeout),
                     '--user-agent', ua,
                     '--header', 'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
                     '--header', 'Accept-Language: en-US,en;q=0.9',
@@ -117,7 +274,7 @@ class XStatsigIDGenerator:
                     self.grok_url
                 ]
 
-                result = subprocess.run(curl_command, capture_output=True, text=True, timeout=10)
+                result = subprocess.run(curl_command, capture_output=True, text=True, timeout=timeout)
 
                 if result.returncode == 0 and len(result.stdout) > 1000:
                     print(f"      ✅ 不同UA成功")
@@ -137,8 +294,9 @@ class XStatsigIDGenerator:
         session = requests.Session()
 
         # 配置重试策略
+        # 有时间预算时不做自动重试，避免单个策略的重试和退避吃掉整个预算
         retry_strategy = Retry(
-            total=3,
+            total=3 if self.deadline is None else 0,
             backoff_factor=1,
             status_forcelist=[429, 500, 502, 503, 504],
         )
@@ -164,10 +322,10 @@ class XStatsigIDGenerator:
 
         try:
             # 先访问主页建立session
-            session.get('https://x.com', headers=headers, timeout=5)
+            session.get('https://x.com', headers=headers, timeout=self._budget(5))
 
             # 再访问grok
-            response = session.get(self.grok_url, headers=headers, timeout=10)
+            response = session.get(self.grok_url, headers=headers, timeout=self._budget(10))
 
             if response.status_code == 200 and len(response.text) > 1000:
                 print(f"      ✅ session请求成功")
@@ -191,7 +349,7 @@ class XStatsigIDGenerator:
                     response = curl_requests.get(
                         self.grok_url,
                         impersonate=imp,
-                        timeout=10,
+                        timeout=self._budget(10),
                         headers={
                             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
                             'Accept-Language': 'en-US,en;q=0.9',
@@ -225,15 +383,16 @@ class XStatsigIDGenerator:
 
         for url in alternative_urls:
             try:
+                timeout = self._budget(8)
                 curl_command = [
-                    'curl', '-s', '-L', '--max-time', '8',
+                    'curl', '-s', '-L', '--max-time', str(timeout),
                     '--user-agent', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
                     '--header', 'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
                     '--compressed',
                     url
                 ]
 
-                result = subprocess.run(curl_command, capture_output=True, text=True, timeout=8)
+                result = subprocess.run(curl_command, capture_output=True, text=True, timeout=timeout)
 
                 if result.returncode == 0 and len(result.stdout) > 500:
                     print(f"      ✅ 替代端点成功: {url}")
@@ -373,11 +532,8 @@ class XStatsigIDGenerator:
         print(f"   Method: {method}")
         print(f"   Pathname: {pathname}")
         
-        # 1. 获取 grok.com 的 meta content
-        meta_content = self.get_grok_meta_content()
-        
-        # 2. 生成浏览器指纹
-        fingerprint = self.generate_browser_fingerprint()
+        # 1-2. 获取 grok.com 的 meta content 与浏览器指纹（进程内缓存，过期后后台刷新）
+        meta_content, fingerprint = meta_cache.get(self)
         
         # 3. 生成当前时间戳
         current_timestamp = int(time.time())
@@ -410,7 +566,7 @@ class XStatsigIDGenerator:
         
         # 8. 生成异或key并加密
         xor_key = secrets.randbits(8)
-        encrypted_payload = bytes([b ^ xor_key for b in payload_data])
+        encrypted_payload = payload_data.translate(_XOR_TABLES[xor_key])
         
         print(f"🔑 异或信息:")
         print(f"   异或key: 0x{xor_key:02x} ({xor_key})")
@@ -428,6 +584,59 @@ class XStatsigIDGenerator:
         
         return result
     
+    def generate_many(self, n: int, method: str = "GET", pathname: str = "/") -> list:
+        """
+        批量生成 x-statsig-id，不输出任何日志
+
+        meta 内容、指纹和同一秒内的 SHA256 片段只计算一次，
+        每个 ID 只需要一次随机数、一次查表异或和一次 Base64 编码。
+
+        Args:
+            n: 生成数量
+            method: 请求方式 (GET/POST)
+            pathname: 请求路径
+
+        Returns:
+            x-statsig-id 列表
+        """
+        meta_content, fingerprint = meta_cache.get(self)
+        relative_timestamp = int(time.time()) - self.base_timestamp
+        sha_input = f"{method}!{pathname}!{relative_timestamp}{fingerprint}"
+        payload_data = (
+            meta_content
+            + struct.pack('<I', relative_timestamp)
+            + hashlib.sha256(sha_input.encode('utf-8')).digest()[:16]
+            + b'\x03'
+        )
+
+        b64encode = base64.b64encode
+        key_bytes = secrets.token_bytes(n)
+        return [
+            b64encode(key_bytes[i:i + 1] + payload_data.translate(_XOR_TABLES[key_bytes[i]])).decode('ascii')
+            for i in range(n)
+        ]
+
+    @staticmethod
+    def verify_many(statsig_ids: list) -> list:
+        """
+        批量校验 ID 结构（长度与固定值），不输出任何日志
+
+        Returns:
+            与输入一一对应的布尔值列表
+        """
+        results = []
+        for statsig_id in statsig_ids:
+            try:
+                decoded = base64.b64decode(statsig_id, validate=True)
+            except Exception:
+                results.append(False)
+                continue
+            results.append(
+                len(decoded) == _DECODED_LENGTH
+                and decoded[-1] ^ decoded[0] == 3
+            )
+        return results
+
     def verify_generated_id(self, statsig_id: str) -> bool:
         """
         验证生成的ID结构是否正确
@@ -452,9 +661,7 @@ class XStatsigIDGenerator:
             print(f"✅ 异或key: 0x{xor_key:02x} ({xor_key})")
             
             # 异或解密
-            decrypted = bytearray()
-            for i in range(1, len(decoded_bytes)):
-                decrypted.append(decoded_bytes[i] ^ xor_key)
+            decrypted = decoded_bytes[1:].translate(_XOR_TABLES[xor_key])
             
             print(f"✅ 解密后长度: {len(decrypted)} 字节")
             